@@ -1,33 +1,141 @@
 import argparse
 import os
+import sys
 from nmigen import Fragment
 from nmigen.back import verilog
 from nmigen.sim import *
 from nmigen_boards.ice40_hx8k_b_evn import *
-from rv32.core import RV32, Top, read_prog
+from rv32.bench import append_history, kernels, run_bench
+from rv32.build import build_bitstream, compile_firmware, link_depths
+from rv32.bus import BusFormal
+from rv32.core import RV32, Top
+from rv32.cxxsim import CxxSimulator
+from rv32.dcache import DCache
+from rv32.elf import load_elf
+from rv32.icache import ICache
+from rv32.muldiv import MulDiv
+from rv32.pipeline import RV32Pipelined
+from rv32.predictor import StaticPredictor, BHTPredictor, BTBPredictor
+from rv32.riscv_formal import checks_config, run_checks
+from rv32.synth import check_baseline, format_report
+from rv32.runner import main as run_tests
+from rv32.trace import trace
+from wishbone.formal import assertFormal
 
+muldivs = ["single-cycle", "iterative"]
 
-def compile_prog(path):
-    os.system("mkdir -p build")
-    os.system("riscv32-elf-as %s -o build/bin.o" % path)
-    os.system("riscv32-elf-ld build/bin.o -o build/bin.ld.o -T progs/rv32.ld")
-    os.system("riscv32-elf-objcopy build/bin.ld.o build/bin -j .text -O binary")
-    os.system("riscv32-elf-objdump -d build/bin.ld.o -M no-aliases,numeric")
+backends = ["pysim", "cxxrtl"]
+
+predictors = {
+    'btfn': StaticPredictor,
+    'bht': BHTPredictor,
+    'btb': BTBPredictor,
+}
+
+
+def add_trace_arguments(parser):
+    parser.add_argument("--trace", nargs="?", const="vcd", help="write waveforms, to vcd/ or the given directory")
+    parser.add_argument("--trace-signals", help="comma separated patterns of the signals to trace, e.g. cpu.rvfi__*")
+    parser.add_argument("--trace-trigger", help="pattern of the signal that starts the trace window")
+    parser.add_argument("--trace-window", help="first:last cycle to trace, relative to the trigger")
+    parser.add_argument("--trace-compress", action="store_true", help="gzip the waveforms")
+
+
+def set_trace_env(args):
+    # The tests run in subprocesses, which pick the options up from the environment
+    if args.trace is None:
+        return
+    os.environ["RV32_TRACE"] = args.trace
+    for name, value in [("SIGNALS", args.trace_signals), ("TRIGGER", args.trace_trigger),
+                        ("WINDOW", args.trace_window)]:
+        if value is not None:
+            os.environ["RV32_TRACE_" + name] = value
+    if args.trace_compress:
+        os.environ["RV32_TRACE_COMPRESS"] = "1"
+
+
+def compile_prog(path, march="rv32i", listing=True):
+    # Only rebuilt when the source or the linker script changed
+    elf = compile_firmware(path, march)
+    if listing:
+        os.system("riscv32-elf-objdump -d %s -M no-aliases,numeric" % elf)
+    # .text goes into the rom, .data into the ram and _start is the reset address
+    return load_elf(elf)
+
+
+def ram_depth_for(path, ram_depth=None):
+    # Defaults to the ram region of the linker script, C programs keep their
+    # stack at its top and need all of it
+    link_ram_depth = link_depths()[1]
+    if ram_depth is None:
+        return link_ram_depth
+    if path.endswith(".c") and ram_depth < link_ram_depth:
+        raise ValueError("%s keeps its stack at the top of %d words of ram, not %d" %
+                         (path, link_ram_depth, ram_depth))
+    return ram_depth
+
+
+def make_predictor(name):
+    if name is None:
+        return None
+    return predictors[name]()
 
 
-def build_fpga(path):
-    compile_prog(path)
-    prog = read_prog('build/bin')
-    platform = ICE40HX8KBEVNPlatform()
-    platform.build(Top(prog))
+def make_dcache(policy):
+    if policy is None:
+        return None
+    # Top keeps the gpio registers out of the cache
+    return DCache(write_back=policy == 'write-back')
+
+
+def make_muldiv(muldiv, altops=False):
+    if muldiv is None:
+        return None
+    return MulDiv(single_cycle_mul=muldiv == 'single-cycle', altops=altops)
+
+
+def build_fpga(path, pipeline=False, predictor=None, icache=False, dcache=None, muldiv=None,
+               compressed=False, pipelined_bus=False, mem_latency=1, counters=False, ram_depth=None,
+               dual_port_rom=False, baseline="build/baseline.json", update_baseline=False):
+    ram_depth = ram_depth_for(path, ram_depth)
+    # Builds of the same configuration are compared with each other
+    config = " ".join("%s=%s" % option for option in [
+        ("pipeline", pipeline), ("predictor", predictor), ("icache", icache), ("dcache", dcache),
+        ("muldiv", muldiv), ("compressed", compressed), ("pipelined_bus", pipelined_bus),
+        ("mem_latency", mem_latency), ("counters", counters), ("ram_depth", ram_depth),
+        ("dual_port_rom", dual_port_rom)])
+    prog, data, entry = compile_prog(path, "rv32i" + ("m" if muldiv else "") +
+                                     ("c" if compressed else "") + ("_zicsr" if counters else ""))
+    def make_top(prog, data):
+        return Top(prog, pipeline=pipeline, predictor=make_predictor(predictor),
+                   icache=ICache() if icache else None, dcache=make_dcache(dcache),
+                   muldiv=make_muldiv(muldiv), with_c=compressed, pipelined_bus=pipelined_bus,
+                   mem_latency=mem_latency, with_csr=counters, data=data,
+                   reset_address=entry, ram_depth=ram_depth, dual_port_rom=dual_port_rom)
+    # A firmware change is patched into the cached bitstream of the same design,
+    # unless the memories are in logic because they have no latency
+    bitstream, report = build_bitstream(ICE40HX8KBEVNPlatform(), make_top, prog, data,
+                                        ram_depth=ram_depth, patchable=mem_latency != 0)
+    print(format_report(report))
+    for regression in check_baseline(report, config, baseline, update_baseline):
+        print("warning: regressed from the baseline, %s" % regression, file=sys.stderr)
 
 
 def flash():
     os.system("iceprog build/top.bin")
 
 
-def riscv_formal(path):
-    cpu = RV32(reset_address = 0x0000_0000, with_rvfi=True)
+def riscv_formal(path, pipeline=False, predictor=None, muldiv=None, pipelined_bus=False,
+                 checks=None, jobs=None):
+    # With a muldiv unit checks.cfg selects rv32im with the alternative M ops
+    muldiv = make_muldiv(muldiv, altops=True)
+    if pipeline:
+        cpu = RV32Pipelined(reset_address = 0x0000_0000, with_rvfi=True,
+                            predictor=make_predictor(predictor), muldiv=muldiv,
+                            pipelined_bus=pipelined_bus)
+    else:
+        cpu = RV32(reset_address = 0x0000_0000, with_rvfi=True, muldiv=muldiv,
+                   pipelined_bus=pipelined_bus)
     ports = [
         cpu.ibus.ack,
         cpu.ibus.adr,
@@ -40,6 +148,7 @@ def riscv_formal(path):
         cpu.ibus.stb,
         cpu.ibus.we,
         cpu.ibus.err,
+        cpu.ibus.stall,
 
         cpu.dbus.ack,
         cpu.dbus.adr,
@@ -52,6 +161,7 @@ def riscv_formal(path):
         cpu.dbus.stb,
         cpu.dbus.we,
         cpu.dbus.err,
+        cpu.dbus.stall,
 
         cpu.rvfi.valid,
         cpu.rvfi.order,
@@ -80,23 +190,73 @@ def riscv_formal(path):
     output = verilog.convert(fragment, name="rv32_cpu", ports=ports)
     with open('formal/rv32.v', 'w') as f:
         f.write(output)
+    with open('formal/checks.cfg', 'w') as f:
+        f.write(checks_config(with_m=muldiv is not None))
 
     os.chdir("formal")
     os.system("rm -rf checks")
     os.system("python3 ../%s/checks/genchecks.py" % path)
-    os.system("make -C checks -j$(nproc)")
+    # Checks that passed on the same core and configuration aren't proven again
+    failed = run_checks("checks", ["rv32.v", "wrapper.sv", "checks.cfg"], "report.json",
+                        checks, jobs)
+    return 1 if failed else 0
+
 
+def bus_formal(pipeline=False, prefetch_depth=0, depth=20):
+    # Checks the pipelined wishbone master properties of both buses
+    if pipeline:
+        cpu = RV32Pipelined(reset_address = 0x0000_0000, pipelined_bus=True)
+    else:
+        cpu = RV32(reset_address = 0x0000_0000, prefetch_depth=prefetch_depth, pipelined_bus=True)
+    os.system("mkdir -p build")
+    assertFormal('build', 'bus', BusFormal(cpu, depth, max(prefetch_depth, 1)),
+                 mode='bmc', depth=depth, multiclock=True)
 
-def run_tests():
-    os.system("mkdir -p vcd")
-    os.system("python3 -m rv32.alu")
-    os.system("python3 -m rv32.branch")
-    os.system("python3 -m rv32.core")
-    os.system("python3 -m rv32.decoder")
-    os.system("python3 -m rv32.loadstore")
-    os.system("python3 -m rv32.ram")
-    os.system("python3 -m rv32.regs")
-    os.system("python3 -m rv32.rom")
+
+def run_prog(path, backend="pysim", cycles=100000, pipeline=False, ram_depth=None):
+    ram_depth = ram_depth_for(path, ram_depth)
+    prog, data, entry = compile_prog(path)
+    top = Top(prog, with_rvfi=True, pipeline=pipeline, data=data, reset_address=entry,
+              ram_depth=ram_depth)
+    valid = top.cpu.rvfi.valid
+    if backend == "cxxrtl":
+        sim = CxxSimulator(top, ports=[valid])
+        cycles, retired = sim.run(cycles, count=valid)
+    else:
+        fragment = Fragment.get(top, None)
+        sim = Simulator(fragment)
+        counted = []
+        def proc():
+            retired = 0
+            for _ in range(cycles):
+                yield Settle()
+                retired += yield valid
+                yield Tick()
+            counted.append(retired)
+        sim.add_clock(1e-6, domain='sync')
+        sim.add_process(proc)
+        with trace(sim, fragment, 'run'):
+            sim.run()
+        retired = counted[0]
+    print("%d instructions in %d cycles, CPI %.2f" % (retired, cycles, cycles / max(retired, 1)))
+
+
+def bench(pattern=None, pipeline=False, predictor=None, muldiv=None, backend="pysim",
+          json_path="build/bench.json"):
+    # Runs of the same configuration are compared with each other
+    config = " ".join("%s=%s" % option for option in [
+        ("pipeline", pipeline), ("predictor", predictor), ("muldiv", muldiv)])
+    programs = {}
+    for path in kernels(pattern=pattern):
+        name = os.path.splitext(os.path.basename(path))[0]
+        programs[name] = compile_prog(path, "rv32i" + ("m" if muldiv else ""), listing=False)
+    ram_depth = link_depths()[1]
+    def make_top(prog, data, entry):
+        return Top(prog, with_rvfi=True, pipeline=pipeline, predictor=make_predictor(predictor),
+                   muldiv=make_muldiv(muldiv), data=data, reset_address=entry,
+                   ram_depth=ram_depth)
+    results = run_bench(programs, make_top, muldiv is not None, backend, ram_depth)
+    append_history(json_path, config, results)
 
 
 def main():
@@ -107,22 +267,79 @@ def main():
 
     p_fpga = p_action.add_parser("fpga", help="build for fpga")
     p_fpga.add_argument("--bin", help="binary to load")
+    p_fpga.add_argument("--pipeline", action="store_true", help="use the pipelined core")
+    p_fpga.add_argument("--predictor", choices=predictors, help="branch predictor of the pipelined core")
+    p_fpga.add_argument("--icache", action="store_true", help="add an instruction cache in front of the rom")
+    p_fpga.add_argument("--dcache", choices=["write-through", "write-back"], help="add a data cache with the given write policy")
+    p_fpga.add_argument("--muldiv", choices=muldivs, help="add the M extension with the given multiplier")
+    p_fpga.add_argument("--compressed", action="store_true", help="add the C extension")
+    p_fpga.add_argument("--pipelined-bus", action="store_true", help="use pipelined wishbone cycles")
+    p_fpga.add_argument("--mem-latency", type=int, choices=[0, 1], default=1, help="cycles until the rom and ram acknowledge, 0 saves a cycle per fetch and load but lowers fmax")
+    p_fpga.add_argument("--counters", action="store_true", help="add the cycle, instret and event counter csrs")
+    p_fpga.add_argument("--ram-depth", type=int, help="words of ram, up to 1024 below the gpio, the ram region of the linker script by default")
+    p_fpga.add_argument("--dual-port-rom", action="store_true", help="give loads their own copy of the rom instead of sharing it with the fetches")
+    p_fpga.add_argument("--baseline", default="build/baseline.json", help="area and fmax of earlier builds to compare with")
+    p_fpga.add_argument("--update-baseline", action="store_true", help="make this build the baseline of its configuration")
 
     p_formal = p_action.add_parser("formal", help="run formal verification")
     p_formal.add_argument("--riscv-formal-dir", help="path to riscv-formal dir")
+    p_formal.add_argument("--pipeline", action="store_true", help="use the pipelined core")
+    p_formal.add_argument("--predictor", choices=predictors, help="branch predictor of the pipelined core")
+    p_formal.add_argument("--muldiv", choices=muldivs, help="add the M extension with the given multiplier")
+    p_formal.add_argument("--pipelined-bus", action="store_true", help="use pipelined wishbone cycles")
+    p_formal.add_argument("--bus", action="store_true", help="check the pipelined wishbone buses instead of running riscv-formal")
+    p_formal.add_argument("--prefetch", type=int, default=0, help="prefetch depth of the core when checking the buses")
+    p_formal.add_argument("--checks", help="only run the riscv-formal checks matching the pattern, e.g. insn_add_*")
+    p_formal.add_argument("--jobs", type=int, help="checks to run at once, one per core by default")
 
     p_sim = p_action.add_parser("test", help="run tests")
+    p_sim.add_argument("--backend", choices=backends, default="pysim", help="simulator of the full core tests")
+    p_sim.add_argument("-k", dest="pattern", help="only run the tests matching the pattern, e.g. rv32.alu.*")
+    p_sim.add_argument("--jobs", type=int, help="worker processes, one per core by default")
+    p_sim.add_argument("--junit", help="write a junit xml report")
+    p_sim.add_argument("--json", help="write a json report")
+    add_trace_arguments(p_sim)
+
+    p_run = p_action.add_parser("run", help="run a program on the simulated soc")
+    p_run.add_argument("--bin", help="program to run")
+    p_run.add_argument("--backend", choices=backends, default="pysim", help="simulator to run on")
+    p_run.add_argument("--cycles", type=int, default=100000, help="clock cycles to run")
+    p_run.add_argument("--pipeline", action="store_true", help="use the pipelined core")
+    p_run.add_argument("--ram-depth", type=int, help="words of ram, up to 1024 below the gpio, the ram region of the linker script by default")
+    add_trace_arguments(p_run)
+
+    p_bench = p_action.add_parser("bench", help="run the benchmark kernels on the simulated soc")
+    p_bench.add_argument("-k", dest="pattern", help="only run the kernels matching the pattern, e.g. crc*")
+    p_bench.add_argument("--pipeline", action="store_true", help="use the pipelined core")
+    p_bench.add_argument("--predictor", choices=predictors, help="branch predictor of the pipelined core")
+    p_bench.add_argument("--muldiv", choices=muldivs, help="add the M extension with the given multiplier")
+    p_bench.add_argument("--backend", choices=backends, default="pysim", help="simulator to run on")
+    p_bench.add_argument("--json", default="build/bench.json", help="history of the results to append to")
+    add_trace_arguments(p_bench)
 
     p_flash = p_action.add_parser("flash", help="flash program onto fpga")
 
     args = parser.parse_args()
 
     if args.action == 'fpga':
-        build_fpga(args.bin)
+        build_fpga(args.bin, args.pipeline, args.predictor, args.icache, args.dcache,
+                   args.muldiv, args.compressed, args.pipelined_bus, args.mem_latency,
+                   args.counters, args.ram_depth, args.dual_port_rom, args.baseline,
+                   args.update_baseline)
     if args.action == 'formal':
-        riscv_formal(args.riscv_formal_dir)
+        if args.bus:
+            bus_formal(args.pipeline, args.prefetch)
+        else:
+            sys.exit(riscv_formal(args.riscv_formal_dir, args.pipeline, args.predictor,
+                                  args.muldiv, args.pipelined_bus, args.checks, args.jobs))
+    if args.action in ('test', 'run', 'bench'):
+        set_trace_env(args)
     if args.action == 'test':
-        run_tests()
+        sys.exit(run_tests(args.pattern, args.backend, args.jobs, args.junit, args.json))
+    if args.action == 'run':
+        run_prog(args.bin, args.backend, args.cycles, args.pipeline, args.ram_depth)
+    if args.action == 'bench':
+        bench(args.pattern, args.pipeline, args.predictor, args.muldiv, args.backend, args.json)
     if args.action == 'flash':
         flash()
 
@@ -1,38 +1,16 @@
 #!/usr/bin/env python3
 
-from Verilog_VCD.Verilog_VCD import parse_vcd
-from os import system
-from sys import argv
+import os
+from sys import argv, path
 
-rvfi_valid = None
-rvfi_order = None
-rvfi_insn = None
+path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-for netinfo in parse_vcd(argv[1]).values():
-    for net in netinfo['nets']:
-        # print(net["hier"], net["name"])
-        if net["hier"] == "rvfi_testbench.wrapper" and net["name"] == "rvfi_valid":
-            rvfi_valid = netinfo['tv']
-        if net["hier"] == "rvfi_testbench.wrapper" and net["name"] == "rvfi_order":
-            rvfi_order = netinfo['tv']
-        if net["hier"] == "rvfi_testbench.wrapper" and net["name"] == "rvfi_insn":
-            rvfi_insn = netinfo['tv']
+from rv32.disasm import disassemble, retired
 
-assert len(rvfi_valid) == len(rvfi_order)
-assert len(rvfi_valid) == len(rvfi_insn)
-
-prog = list()
-
-for tv_valid, tv_order, tv_insn in zip(rvfi_valid, rvfi_order, rvfi_insn):
-    if tv_valid[1] == '1':
-        prog.append((int(tv_order[1], 2), int(tv_insn[1], 2)))
-
-with open("disasm.s", "w") as f:
-    for tv_order, tv_insn in sorted(prog):
-        if tv_insn & 3 != 3 and tv_insn & 0xffff0000 == 0:
-            print(".hword 0x%04x # %d" % (tv_insn, tv_order), file=f)
+# Lists the instructions retired in a riscv-formal counterexample trace
+with open(argv[1]) as f:
+    for order, insn in retired(f):
+        if insn & 3 != 3 and insn & 0xffff0000 == 0:
+            print('%6d:     %04x  %s' % (order, insn, disassemble(insn)))
         else:
-            print(".word 0x%08x # %d" % (tv_insn, tv_order), file=f)
-
-system("riscv32-elf-as -march=rv32i disasm.s -o disasm.o")
-system("riscv32-elf-objdump -d disasm.o -M no-aliases,numeric")
+            print('%6d: %08x  %s' % (order, insn, disassemble(insn)))
@@ -5,9 +5,10 @@ module rvfi_wrapper (
 );
 	(* keep *) `rvformal_rand_reg [31:0] ibus_dat_r_randval;
 	(* keep *) `rvformal_rand_reg ibus_ack_randval;
+	(* keep *) `rvformal_rand_reg ibus_stall_randval;
 
         assign ibus_dat_r = ibus_dat_r_randval;
-        assign ibus_ack = ibus_ack_randval;
+        assign ibus_stall = ibus_stall_randval;
 
 	(* keep *) wire [29:0] ibus_adr;
 	(* keep *) wire [31:0] ibus_dat_w;
@@ -20,12 +21,14 @@ module rvfi_wrapper (
 	(* keep *) wire [ 2:0] ibus_cti;
 	(* keep *) wire [ 1:0] ibus_bte;
 	(* keep *) wire        ibus_err;
+	(* keep *) wire        ibus_stall;
 
 	(* keep *) `rvformal_rand_reg [31:0] dbus_dat_r_randval;
 	(* keep *) `rvformal_rand_reg dbus_ack_randval;
+	(* keep *) `rvformal_rand_reg dbus_stall_randval;
 
         assign dbus_dat_r = dbus_dat_r_randval;
-        assign dbus_ack = dbus_ack_randval;
+        assign dbus_stall = dbus_stall_randval;
 
 	(* keep *) wire [29:0] dbus_adr;
 	(* keep *) wire [31:0] dbus_dat_w;
@@ -38,6 +41,18 @@ module rvfi_wrapper (
 	(* keep *) wire [ 2:0] dbus_cti;
 	(* keep *) wire [ 1:0] dbus_bte;
 	(* keep *) wire        dbus_err;
+	(* keep *) wire        dbus_stall;
+
+	// Only acknowledge accepted requests, the cores keep at most one in flight
+	reg ibus_busy;
+	reg dbus_busy;
+	always @(posedge clock) begin
+		ibus_busy <= !reset && ((ibus_stb && !ibus_stall) || (ibus_busy && !ibus_ack));
+		dbus_busy <= !reset && ((dbus_stb && !dbus_stall) || (dbus_busy && !dbus_ack));
+	end
+
+	assign ibus_ack = ibus_ack_randval && ibus_busy;
+	assign dbus_ack = dbus_ack_randval && dbus_busy;
 
 	rv32_cpu uut (
 		.clk       (clock),
@@ -54,6 +69,7 @@ module rvfi_wrapper (
 		.ibus__cti          (ibus_cti),
 		.ibus__bte          (ibus_bte),
 		.ibus__err          (ibus_err),
+		.ibus__stall        (ibus_stall),
 
                 .dbus__adr          (dbus_adr),
 		.dbus__dat_w        (dbus_dat_w),
@@ -66,6 +82,7 @@ module rvfi_wrapper (
 		.dbus__cti          (dbus_cti),
 		.dbus__bte          (dbus_bte),
 		.dbus__err          (dbus_err),
+		.dbus__stall        (dbus_stall),
 
 		.rvfi__valid        (rvfi_valid),
 		.rvfi__order        (rvfi_order),
@@ -0,0 +1,65 @@
+# Bubble sorts xorshift numbers, then checks that they are in order and
+# that their sum didn't change
+.equ N, 32
+.global _start
+
+.section .text
+_start:
+    la a0, array
+    li a1, N
+    li t0, 2463534242
+    li a3, 0
+fill:
+    sw t0, 0(a0)
+    add a3, a3, t0
+    slli t1, t0, 13
+    xor t0, t0, t1
+    srli t1, t0, 17
+    xor t0, t0, t1
+    slli t1, t0, 5
+    xor t0, t0, t1
+    addi a0, a0, 4
+    addi a1, a1, -1
+    bnez a1, fill
+
+    # Passes over the array until nothing is swapped
+sort:
+    li a2, 0
+    la a0, array
+    li a1, N - 1
+sort_pair:
+    lw t0, 0(a0)
+    lw t1, 4(a0)
+    bgeu t1, t0, sort_next
+    sw t1, 0(a0)
+    sw t0, 4(a0)
+    li a2, 1
+sort_next:
+    addi a0, a0, 4
+    addi a1, a1, -1
+    bnez a1, sort_pair
+    bnez a2, sort
+
+    la a0, array
+    li a1, N - 1
+    lw t0, 0(a0)
+    mv a4, t0
+check:
+    lw t1, 4(a0)
+    bltu t1, t0, fail
+    add a4, a4, t1
+    mv t0, t1
+    addi a0, a0, 4
+    addi a1, a1, -1
+    bnez a1, check
+    bne a4, a3, fail
+
+    li a0, 0
+    ecall
+fail:
+    li a0, 1
+    ecall
+
+.section .bss
+array:
+    .space 4 * N
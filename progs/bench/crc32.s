@@ -0,0 +1,65 @@
+# Bitwise CRC-32 of the standard check string, read from the rom, and of a
+# buffer in the ram
+.equ BYTES, 128
+.equ POLY, 0xedb88320
+.global _start
+
+.section .text
+_start:
+    la a0, check
+    li a1, 9
+    call crc32
+    li t0, 0xcbf43926
+    bne a0, t0, fail
+
+    la a0, buf
+    li a1, BYTES
+    li t0, 0
+fill:
+    sb t0, 0(a0)
+    addi t0, t0, 1
+    addi a0, a0, 1
+    addi a1, a1, -1
+    bnez a1, fill
+
+    la a0, buf
+    li a1, BYTES
+    call crc32
+    li t0, 0x24650d57
+    bne a0, t0, fail
+
+    li a0, 0
+    ecall
+fail:
+    li a0, 1
+    ecall
+
+# a0 = crc32(a0 = address, a1 = length)
+crc32:
+    li a2, -1
+    li a3, POLY
+crc32_byte:
+    lbu t0, 0(a0)
+    xor a2, a2, t0
+    li t1, 8
+crc32_bit:
+    andi t2, a2, 1
+    srli a2, a2, 1
+    beqz t2, crc32_next
+    xor a2, a2, a3
+crc32_next:
+    addi t1, t1, -1
+    bnez t1, crc32_bit
+    addi a0, a0, 1
+    addi a1, a1, -1
+    bnez a1, crc32_byte
+    not a0, a2
+    ret
+
+.section .rodata
+check:
+    .ascii "123456789"
+
+.section .bss
+buf:
+    .space BYTES
@@ -0,0 +1,102 @@
+// A loop in the spirit of Dhrystone: assignments through record pointers,
+// string copies and compares, enums, and small procedure calls. The
+// strings come from the rom. Every run ends in the same state, which is
+// checked at the end.
+
+#define RUNS 20
+// The values the last run leaves behind
+#define CHECK_INT_2 6
+#define CHECK_GLOB_INT 215
+
+enum colour { RED, GREEN, BLUE, YELLOW };
+
+struct record {
+    struct record *next;
+    enum colour colour;
+    int value;
+    char name[32];
+};
+
+struct record first, second;
+char string_1[32], string_2[32];
+int glob_int;
+char glob_char;
+
+__attribute__((noinline)) static void copy_string(char *dst, const char *src)
+{
+    while ((*dst++ = *src++) != 0)
+        ;
+}
+
+__attribute__((noinline)) static int compare_strings(const char *a, const char *b)
+{
+    while (*a != 0 && *a == *b) {
+        a++;
+        b++;
+    }
+    return *a - *b;
+}
+
+__attribute__((noinline)) static enum colour next_colour(enum colour colour)
+{
+    switch (colour) {
+    case RED:
+        return GREEN;
+    case GREEN:
+        return BLUE;
+    case BLUE:
+        return YELLOW;
+    default:
+        return RED;
+    }
+}
+
+__attribute__((noinline)) static void proc_record(struct record *record)
+{
+    struct record *next = record->next;
+    next->colour = record->colour;
+    next->value = record->value + 3;
+    next->next = record;
+    copy_string(next->name, record->name);
+    record->colour = next_colour(record->colour);
+    if (next->colour == RED)
+        glob_int += next->value;
+}
+
+__attribute__((noinline)) static int proc_ints(int a, int b)
+{
+    int c = a * b;
+    return c / (a + 1) + c % 7;
+}
+
+int main(void)
+{
+    int int_1 = 0, int_2 = 0, int_3 = 0;
+
+    first.next = &second;
+    first.colour = RED;
+    first.value = 40;
+    copy_string(first.name, "DHRYSTONE PROGRAM, SOME STRING");
+
+    for (int run = 0; run < RUNS; run++) {
+        copy_string(string_1, "DHRYSTONE PROGRAM, 1'ST STRING");
+        copy_string(string_2, "DHRYSTONE PROGRAM, 2'ND STRING");
+        glob_char = compare_strings(string_1, string_2) < 0 ? 'A' : 'B';
+        int_1 = 2;
+        int_2 = 3;
+        while (int_1 < int_2) {
+            int_3 = 5 * int_1 - int_2;
+            int_1++;
+        }
+        int_2 = proc_ints(int_1 + run, int_3);
+        proc_record(&first);
+        first.value = second.value - 3;
+        string_2[8] = 'A' + run % 26;
+    }
+
+    return !(glob_char == 'A' && int_1 == 3 && int_3 == 7 &&
+             int_2 == CHECK_INT_2 && glob_int == CHECK_GLOB_INT &&
+             first.colour == (enum colour)(RUNS % 4) && second.value == 43 &&
+             compare_strings(second.name, first.name) == 0 &&
+             compare_strings(string_2, "DHRYSTONE PROGRAM, 2'ND STRING") != 0);
+}
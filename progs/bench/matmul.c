@@ -0,0 +1,52 @@
+// Multiplies two 8x8 matrices and checks a weighted sum of the product.
+// The inputs are globals, so their values aren't known when main is
+// compiled and the work can't be folded away.
+
+#define N 8
+#define CHECKSUM 87088
+
+int a[N][N] = {
+    {  3,  -1,   4,   1,  -5,   9,   2,  -6 },
+    {  5,   3,  -5,   8,   9,  -7,   9,   3 },
+    { -2,   3,   8,   4,  -6,   2,   6,   4 },
+    {  3,   3,  -8,   3,   2,   7,  -9,   5 },
+    {  0,   2,   8,  -8,   4,   1,   9,   7 },
+    {  1,  -6,   9,   3,   9,   9,   3,  -7 },
+    {  5,   1,   0,   5,  -8,   2,   0,   9 },
+    { -7,   4,   9,   4,   4,   5,  -9,   2 },
+};
+
+int b[N][N] = {
+    {  2,   7,  -1,   8,   2,   8,  -1,   8 },
+    {  2,  -8,   4,   5,   9,   0,  -4,   5 },
+    {  2,   3,   5,  -3,   6,   0,   2,   8 },
+    { -7,   4,   7,   1,   3,  -5,   2,   6 },
+    {  6,   2,  -4,   9,   7,   7,   5,  -7 },
+    {  2,   4,   7,   0,  -9,   3,   6,   9 },
+    { -9,   9,   3,   7,   5,   1,   0,   5 },
+    {  8,   2,  -1,   3,   2,   8,   6,  -4 },
+};
+
+int c[N][N];
+
+__attribute__((noinline)) static void matmul(int c[N][N], int a[N][N], int b[N][N])
+{
+    for (int i = 0; i < N; i++) {
+        for (int j = 0; j < N; j++) {
+            int sum = 0;
+            for (int k = 0; k < N; k++)
+                sum += a[i][k] * b[k][j];
+            c[i][j] = sum;
+        }
+    }
+}
+
+int main(void)
+{
+    matmul(c, a, b);
+    int checksum = 0;
+    for (int i = 0; i < N; i++)
+        for (int j = 0; j < N; j++)
+            checksum += (i * N + j + 1) * c[i][j];
+    return checksum != CHECKSUM;
+}
@@ -0,0 +1,82 @@
+# Copies a buffer a word at a time, then a byte at a time to an odd
+# address, and compares both copies with the original
+.equ WORDS, 128
+.global _start
+
+.section .text
+_start:
+    la a0, src
+    li a1, WORDS
+    li t0, 0x01234567
+    li t1, 0x9e3779b9
+fill:
+    sw t0, 0(a0)
+    add t0, t0, t1
+    addi a0, a0, 4
+    addi a1, a1, -1
+    bnez a1, fill
+
+    # Four words per iteration
+    la a0, dst
+    la a1, src
+    li a2, WORDS / 4
+copy_words:
+    lw t0, 0(a1)
+    lw t1, 4(a1)
+    lw t2, 8(a1)
+    lw t3, 12(a1)
+    sw t0, 0(a0)
+    sw t1, 4(a0)
+    sw t2, 8(a0)
+    sw t3, 12(a0)
+    addi a1, a1, 16
+    addi a0, a0, 16
+    addi a2, a2, -1
+    bnez a2, copy_words
+
+    la a0, dst
+    la a1, src
+    li a2, WORDS
+check_words:
+    lw t0, 0(a0)
+    lw t1, 0(a1)
+    bne t0, t1, fail
+    addi a0, a0, 4
+    addi a1, a1, 4
+    addi a2, a2, -1
+    bnez a2, check_words
+
+    la a0, dst + 1
+    la a1, src
+    li a2, 4 * WORDS - 4
+copy_bytes:
+    lbu t0, 0(a1)
+    sb t0, 0(a0)
+    addi a1, a1, 1
+    addi a0, a0, 1
+    addi a2, a2, -1
+    bnez a2, copy_bytes
+
+    la a0, dst + 1
+    la a1, src
+    li a2, 4 * WORDS - 4
+check_bytes:
+    lbu t0, 0(a0)
+    lbu t1, 0(a1)
+    bne t0, t1, fail
+    addi a0, a0, 1
+    addi a1, a1, 1
+    addi a2, a2, -1
+    bnez a2, check_bytes
+
+    li a0, 0
+    ecall
+fail:
+    li a0, 1
+    ecall
+
+.section .bss
+src:
+    .space 4 * WORDS
+dst:
+    .space 4 * WORDS
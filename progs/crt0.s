@@ -0,0 +1,10 @@
+# Startup of the C programs: the stack grows down from the top of the ram,
+# main's result is left in a0 for whoever watches the trap. .bss needs no
+# clearing, the elf loader puts zeros into the initial ram contents.
+.global _start
+
+.section .text
+_start:
+    la sp, _stack_top
+    call main
+    ecall
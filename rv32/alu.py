@@ -1,5 +1,6 @@
 from nmigen import *
 from nmigen.sim import *
+from .trace import trace
 
 
 class Funct4:
@@ -49,31 +50,62 @@ class ALU(Elaboratable):
         return m
 
 
-def test_alu(funct4, in1, in2, expected):
+def test_alu(cases):
+    # All cases run in one simulation, the alu is combinational
     dut = ALU()
-    sim = Simulator(dut)
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
 
-    with sim.write_vcd('vcd/alu.vcd'):
-        def proc():
+    def proc():
+        for funct4, in1, in2, expected in cases:
             yield dut.funct4.eq(funct4)
             yield dut.in1.eq(in1)
             yield dut.in2.eq(in2)
             yield Settle()
             out = yield dut.out
             if out != expected:
-                raise ValueError('expected %s but got %s' % (expected, out))
+                raise ValueError('%s: expected %s but got %s' % (funct4, expected, out))
 
     sim.add_process(proc)
-    sim.run()
+    with trace(sim, fragment, 'alu'):
+        sim.run()
+
+def test():
+    test_alu([
+        (Funct4.ADD, 3, 4, 7),
+        (Funct4.SUB, 3, -4, 7),
+        (Funct4.SLL, 0b1111, 4, 0b11110000),
+        (Funct4.SLT, -1, 1, 1),
+        (Funct4.SLTU, -1, 1, 0),
+        (Funct4.XOR, 0b0011, 0b0101, 0b0110),
+        (Funct4.SRL, -1, 4, 0x0fff_ffff),
+        (Funct4.SRA, -1, 4, -1),
+        (Funct4.OR, 0b0011, 0b0101, 0b0111),
+        (Funct4.AND, 0b0011, 0b0101, 0b0001),
+    ])
+
+def test_random(count=4096, seed=0, backend='pysim'):
+    import numpy as np
+    from .vectors import check_vectors
+
+    signed = lambda x: x.view(np.int32)
+    checked = check_vectors(ALU, 'funct4', {
+        Funct4.ADD:  lambda a, b: a + b,
+        Funct4.SUB:  lambda a, b: a - b,
+        Funct4.SLL:  lambda a, b: a << (b & 31),
+        Funct4.SLT:  lambda a, b: signed(a) < signed(b),
+        Funct4.SLTU: lambda a, b: a < b,
+        Funct4.XOR:  lambda a, b: a ^ b,
+        Funct4.SRL:  lambda a, b: a >> (b & 31),
+        Funct4.SRA:  lambda a, b: signed(a) >> (b & 31),
+        Funct4.OR:   lambda a, b: a | b,
+        Funct4.AND:  lambda a, b: a & b,
+    }, count, seed, backend, 'alu_random')
+    print('ok: %d vectors' % checked)
 
 if __name__ == '__main__':
-    test_alu(Funct4.ADD, 3, 4, 7)
-    test_alu(Funct4.SUB, 3, -4, 7)
-    test_alu(Funct4.SLL, 0b1111, 4, 0b11110000)
-    test_alu(Funct4.SLT, -1, 1, 1)
-    test_alu(Funct4.SLTU, -1, 1, 0)
-    test_alu(Funct4.XOR, 0b0011, 0b0101, 0b0110)
-    test_alu(Funct4.SRL, -1, 4, 0x0fff_ffff)
-    test_alu(Funct4.SRA, -1, 4, -1)
-    test_alu(Funct4.OR, 0b0011, 0b0101, 0b0111)
-    test_alu(Funct4.AND, 0b0011, 0b0101, 0b0001)
+    import sys
+
+    test()
+    # python3 -m rv32.alu 100000 checks 100000 operand pairs per function
+    test_random(*map(int, sys.argv[1:2]))
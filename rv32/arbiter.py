@@ -0,0 +1,143 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc.memory import *
+from nmigen_soc.wishbone import *
+from .trace import trace
+
+# Shares the rom between the instruction and the data bus of a core. A
+# request is granted until it is acknowledged, and the data bus goes first
+# when both ask at once: the core is waiting on a load or store, while a
+# fetch is often ahead of it. Only one request is outstanding at a time,
+# like on the buses of the cores.
+
+class Arbiter(Elaboratable):
+    def __init__(self, target):
+        self.target = target
+        self.pipelined = "stall" in target.features
+        self.ibus = Interface(data_width = 32, granularity = 8, addr_width = target.addr_width,
+                              features = target.features, name = 'ibus')
+        self.dbus = Interface(data_width = 32, granularity = 8, addr_width = target.addr_width,
+                              features = target.features, name = 'dbus')
+        self.dbus.memory_map = MemoryMap(data_width = 8, addr_width = target.addr_width + 2,
+                                         alignment = 0)
+
+    def elaborate(self, platform):
+        m = Module()
+        bus = self.target
+        busy = Signal()
+        owner = Signal()
+        grant = Signal()
+        free = Signal()
+        # A pipelined request may be issued as the last one is acknowledged.
+        # A classic request holds stb until its ack, only new grants wait.
+        if self.pipelined:
+            m.d.comb += [
+                free.eq(~busy | bus.ack),
+                bus.stb.eq(Mux(grant, self.dbus.stb, self.ibus.stb) & free),
+            ]
+        else:
+            m.d.comb += [
+                free.eq(~busy),
+                bus.stb.eq(Mux(grant, self.dbus.stb, self.ibus.stb)),
+            ]
+        m.d.comb += grant.eq(Mux(free, self.dbus.cyc & self.dbus.stb, owner))
+        m.d.comb += [
+            bus.cyc.eq(self.ibus.cyc | self.dbus.cyc),
+            bus.adr.eq(Mux(grant, self.dbus.adr, self.ibus.adr)),
+            bus.dat_w.eq(Mux(grant, self.dbus.dat_w, self.ibus.dat_w)),
+            bus.sel.eq(Mux(grant, self.dbus.sel, self.ibus.sel)),
+            bus.we.eq(Mux(grant, self.dbus.we, self.ibus.we)),
+            self.ibus.dat_r.eq(bus.dat_r),
+            self.dbus.dat_r.eq(bus.dat_r),
+        ]
+        if self.pipelined:
+            # The ack answers the request accepted before it
+            m.d.comb += [
+                self.ibus.stall.eq(grant | ~free | bus.stall),
+                self.dbus.stall.eq(~grant | ~free | bus.stall),
+                self.ibus.ack.eq(bus.ack & ~owner),
+                self.dbus.ack.eq(bus.ack & owner),
+            ]
+            with m.If(bus.stb & ~bus.stall):
+                m.d.sync += [
+                    busy.eq(1),
+                    owner.eq(grant),
+                ]
+            with m.Elif(bus.ack):
+                m.d.sync += busy.eq(0)
+        else:
+            m.d.comb += [
+                self.ibus.ack.eq(bus.ack & ~grant),
+                self.dbus.ack.eq(bus.ack & grant),
+            ]
+            m.d.sync += [
+                busy.eq(bus.stb & ~bus.ack),
+                owner.eq(grant),
+            ]
+        return m
+
+def initiator(bus, pipelined, addresses, log):
+    # Reads the addresses back to back and logs (cycle, data) of every ack
+    def proc():
+        yield bus.cyc.eq(1)
+        cycle = 0
+        issued = 0
+        while len(log) < len(addresses):
+            yield bus.stb.eq(issued < len(addresses))
+            yield bus.adr.eq(addresses[min(issued, len(addresses) - 1)])
+            yield Settle()
+            if pipelined:
+                accepted = issued < len(addresses) and not (yield bus.stall)
+            else:
+                accepted = (yield bus.ack)
+            if (yield bus.ack):
+                log.append((cycle, (yield bus.dat_r)))
+            if accepted:
+                issued += 1
+            yield Tick()
+            cycle += 1
+        yield bus.stb.eq(0)
+    return proc
+
+def monitor(bus, acks):
+    # Counts the acks, a classic slave may only ack a request with stb held
+    def proc():
+        yield Passive()
+        while True:
+            yield Settle()
+            if (yield bus.ack):
+                assert((yield bus.stb))
+                acks.append(1)
+            yield Tick()
+    return proc
+
+def test():
+    from .rom import ROM
+    data = [0x0123_4567, 0x89AB_CDEF, 0x0C0F_FEE0, 0xDEC0_FFEE]
+    for kwargs in [{}, {'latency': 0}, {'pipelined': True}]:
+        rom = ROM(data, **kwargs)
+        dut = Arbiter(rom)
+        m = Module()
+        m.submodules.rom = rom
+        m.submodules.arbiter = dut
+        fragment = Fragment.get(m, None)
+        sim = Simulator(fragment)
+        fetches = []
+        loads = []
+        sim.add_sync_process(initiator(dut.ibus, rom.pipelined, [0, 1, 2, 3], fetches))
+        sim.add_sync_process(initiator(dut.dbus, rom.pipelined, [3, 2], loads))
+        acks = []
+        if not rom.pipelined:
+            sim.add_process(monitor(rom, acks))
+        sim.add_clock(1e-6)
+        with trace(sim, fragment, 'arbiter'):
+            sim.run()
+        assert([word for cycle, word in fetches] == data)
+        assert([word for cycle, word in loads] == [data[3], data[2]])
+        assert(rom.pipelined or len(acks) == 6)
+        # Loads go first, and don't keep fetches waiting once they are done
+        assert(loads[-1][0] < fetches[0][0])
+        assert(fetches[0][0] - loads[-1][0] <= 2)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,118 @@
+import json
+import os
+import time
+from fnmatch import fnmatchcase
+from .build import link_depths
+from .cosim import cosim
+from .iss import ISS
+
+# Runs the kernels in progs/bench on a simulated Top in lock step with the
+# ISS, which also checks them: a kernel traps with 0 in a0 once it computed
+# what it should. Reports the cycles, the instructions retired and the CPI
+# of every kernel, and appends them to a history of runs.
+
+KERNELS_DIR = 'progs/bench'
+
+
+def kernels(directory=KERNELS_DIR, pattern=None):
+    paths = []
+    for file in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(file)
+        if extension in ('.s', '.c') and (pattern is None or fnmatchcase(name, pattern)):
+            paths.append(os.path.join(directory, file))
+    return paths
+
+
+def run_kernel(name, top, prog, data, entry, ram_depth, with_m=False, limit=1_000_000,
+               backend='pysim'):
+    iss = ISS(prog, entry, ram_depth=ram_depth, with_m=with_m, data=data)
+    retired, cycles = cosim(top, iss, limit, name='bench_' + name, backend=backend)
+    if not iss.trap:
+        raise ValueError('%s didn\'t finish in %d cycles' % (name, limit))
+    if iss.x[10] != 0:
+        raise ValueError('%s failed its check with %d' % (name, iss.x[10]))
+    return {'cycles': cycles, 'retired': retired, 'cpi': cycles / retired}
+
+
+def run_bench(programs, make_top, with_m=False, backend='pysim', ram_depth=None):
+    # programs maps the kernel names to (prog, data, entry), make_top(prog,
+    # data, entry) returns a Top with rvfi and ram_depth words of ram. That
+    # defaults to the whole ram of the linker script, the C kernels keep
+    # their stack at its top.
+    if ram_depth is None:
+        ram_depth = link_depths()[1]
+    results = {}
+    print('%-16s %10s %10s %6s' % ('kernel', 'cycles', 'retired', 'CPI'))
+    for name, (prog, data, entry) in programs.items():
+        result = run_kernel(name, make_top(prog, data, entry), prog, data, entry, ram_depth,
+                            with_m, backend=backend)
+        results[name] = result
+        print('%-16s %10d %10d %6.2f' % (name, result['cycles'], result['retired'],
+                                         result['cpi']), flush=True)
+    return results
+
+
+def append_history(path, config, results):
+    # Every run is kept, the configuration tells apart the runs to compare
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    history.append({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': config,
+        'kernels': results,
+    })
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def test():
+    import tempfile
+    from .core import Top
+
+    # Sums 1..10 and checks the result, then the same with a wrong check
+    def program(expected):
+        return [
+            0x0000_0293, # addi  x5,x0,0
+            0x00a0_0313, # addi  x6,x0,10
+            0x0062_82b3, # add   x5,x5,x6
+            0xfff3_0313, # addi  x6,x6,-1
+            0xfe03_1ce3, # bne   x6,x0,.-8
+            0x0000_0513 | (55 + expected) << 20 & 0xfff0_0000, # addi x10,x0,55+expected
+            0x40a2_8533, # sub   x10,x5,x10
+            0x0000_0073, # ecall
+        ]
+
+    def make_top(prog, data, entry):
+        return Top(prog, with_rvfi=True, data=data, reset_address=entry,
+                   ram_depth=link_depths()[1])
+
+    results = run_bench({'sum': (program(0), [], 0x8000_0000)}, make_top)
+    # 2 + 3 per iteration of the loop + 2, the ecall traps instead of retiring
+    assert(results['sum']['retired'] == 34)
+    assert(results['sum']['cpi'] == results['sum']['cycles'] / 34)
+    try:
+        run_bench({'sum': (program(1), [], 0x8000_0000)}, make_top)
+    except ValueError as e:
+        assert('check' in str(e))
+    else:
+        raise ValueError('expected the check to fail')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.json')
+        append_history(path, 'default', results)
+        append_history(path, 'pipeline', results)
+        with open(path) as f:
+            history = json.load(f)
+        assert([run['config'] for run in history] == ['default', 'pipeline'])
+        assert(history[0]['kernels'] == results)
+
+    assert([os.path.basename(path) for path in kernels(pattern='c*')] == ['crc32.s'])
+
+if __name__ == '__main__':
+    test()
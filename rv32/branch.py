@@ -34,3 +34,25 @@ class Branch(Elaboratable):
             with m.Case(Funct3.BGEU):
                 m.d.comb += self.out.eq(Cat(0, self.in1) >= Cat(0, self.in2))
         return m
+
+
+def test_random(count=4096, seed=0, backend='pysim'):
+    import numpy as np
+    from .vectors import check_vectors
+
+    signed = lambda x: x.view(np.int32)
+    checked = check_vectors(Branch, 'funct3', {
+        Funct3.BEQ:  lambda a, b: a == b,
+        Funct3.BNE:  lambda a, b: a != b,
+        Funct3.BLT:  lambda a, b: signed(a) < signed(b),
+        Funct3.BGE:  lambda a, b: signed(a) >= signed(b),
+        Funct3.BLTU: lambda a, b: a < b,
+        Funct3.BGEU: lambda a, b: a >= b,
+    }, count, seed, backend, 'branch_random')
+    print('ok: %d vectors' % checked)
+
+if __name__ == '__main__':
+    import sys
+
+    # python3 -m rv32.branch 100000 checks 100000 operand pairs per function
+    test_random(*map(int, sys.argv[1:2]))
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+from array import array
+from math import ceil, log2
+from .synth import read_report
+
+# Content addressed build cache. Firmware is keyed on its sources, the
+# linker script and the march. Bitstreams are built with random placeholder
+# contents in the rom and ram, so their key is the build plan of the design
+# alone, and the firmware is patched into a cached bitstream with icebram,
+# which skips synthesis and place and route when only the firmware changed.
+
+CACHE_DIR = 'build/cache'
+LINKER_SCRIPT = 'progs/rv32.ld'
+
+REGION = re.compile(r'^\s*(?P<name>\w+)\s*(?:\([^)]*\))?\s*:\s*ORIGIN\s*=\s*(?P<origin>\w+)\s*,'
+                    r'\s*LENGTH\s*=\s*(?P<length>\w+)', re.MULTILINE)
+
+# C is compiled freestanding. Loops that look like memcpy or memset stay
+# loops, there is no libc to call, and nothing is addressed relative to gp.
+CFLAGS = ['-O2', '-ffreestanding', '-fno-builtin', '-fno-tree-loop-distribute-patterns',
+          '-msmall-data-limit=0']
+
+
+def memory_regions(linker_script=LINKER_SCRIPT):
+    # Returns the (origin, length) in bytes of the MEMORY regions by name
+    with open(linker_script) as f:
+        text = f.read()
+    regions = {}
+    for match in REGION.finditer(text):
+        length = match.group('length')
+        scale = {'K': 1 << 10, 'M': 1 << 20}.get(length[-1].upper(), 1)
+        if scale != 1:
+            length = length[:-1]
+        regions[match.group('name')] = (int(match.group('origin'), 0), int(length, 0) * scale)
+    return regions
+
+
+def link_depths(linker_script=LINKER_SCRIPT):
+    # Words of rom and ram the programs are linked for
+    regions = memory_regions(linker_script)
+    return regions['ROM'][1] // 4, regions['RAM'][1] // 4
+
+
+def firmware_key(sources, linker_script, march):
+    hasher = hashlib.sha256()
+    for name in list(sources) + [linker_script]:
+        with open(name, 'rb') as f:
+            hasher.update(f.read())
+    hasher.update(march.encode())
+    return hasher.hexdigest()[:32]
+
+
+def compile_firmware(path, march='rv32i', linker_script=LINKER_SCRIPT, cache_dir=CACHE_DIR,
+                     startup='progs/crt0.s'):
+    # Returns the path of the linked executable. A C program is linked
+    # behind the startup code, with libgcc for the multiplications and
+    # divisions the march may not have.
+    sources = [startup, path] if path.endswith('.c') else [path]
+    directory = os.path.join(cache_dir, 'firmware')
+    elf = os.path.join(directory, firmware_key(sources, linker_script, march) + '.elf')
+    if os.path.exists(elf):
+        return elf
+    os.makedirs(directory, exist_ok=True)
+    objects = []
+    for i, source in enumerate(sources):
+        obj = elf[:-len('.elf')] + '.%d.o' % i
+        if source.endswith('.c'):
+            subprocess.check_call(['riscv32-elf-gcc', '-march=%s' % march, '-mabi=ilp32'] + CFLAGS +
+                                  ['-c', source, '-o', obj])
+        else:
+            subprocess.check_call(['riscv32-elf-as', '-march=%s' % march, source, '-o', obj])
+        objects.append(obj)
+    # Linked next to the cache entry and renamed, a failed link leaves no entry
+    if path.endswith('.c'):
+        subprocess.check_call(['riscv32-elf-gcc', '-march=%s' % march, '-mabi=ilp32', '-nostdlib',
+                               '-T', linker_script, '-o', elf + '.tmp'] + objects + ['-lgcc'])
+    else:
+        subprocess.check_call(['riscv32-elf-ld'] + objects + ['-o', elf + '.tmp', '-T', linker_script])
+    os.replace(elf + '.tmp', elf)
+    for obj in objects:
+        os.remove(obj)
+    return elf
+
+
+def placeholder(depth, seed):
+    # icebram finds the memories by their contents, the words have to be
+    # unlikely to show up anywhere else and the same on every build
+    rng = random.Random(seed)
+    return array('I', (rng.getrandbits(32) for _ in range(depth)))
+
+
+def pad(words, depth):
+    if len(words) > depth:
+        raise ValueError('%d words don\'t fit into %d' % (len(words), depth))
+    return array('I', words) + array('I', [0]) * (depth - len(words))
+
+
+def write_hex(path, words):
+    with open(path, 'w') as f:
+        f.writelines('%08x\n' % word for word in words)
+
+
+def build_bitstream(platform, make_top, prog, data, rom_depth=None, ram_depth=None,
+                    patchable=True, name='top', build_dir='build', cache_dir=CACHE_DIR,
+                    linker_script=LINKER_SCRIPT):
+    # make_top(prog, data) returns the design with the given rom and ram
+    # contents. Memories without a read latency end up in logic instead of
+    # block rams, which icebram can't patch, so the firmware is part of the
+    # design then. Returns the path of the bitstream and the synthesis report,
+    # which is also written next to the bitstream. The memories default to
+    # the regions of the linker script, so every program linked for them
+    # patches into the same bitstream.
+    link_rom_depth, link_ram_depth = link_depths(linker_script)
+    if rom_depth is None:
+        rom_depth = link_rom_depth
+    if ram_depth is None:
+        ram_depth = link_ram_depth
+    rom_depth = max(rom_depth, 1 << ceil(log2(max(len(prog), 2))))
+    prog = pad(prog, rom_depth)
+    data = pad(data, ram_depth)
+    if patchable:
+        rom_init = placeholder(rom_depth, 'rom')
+        ram_init = placeholder(ram_depth, 'ram')
+    else:
+        rom_init, ram_init = prog, data
+
+    plan = platform.build(make_top(rom_init, ram_init), name=name, do_build=False)
+    cached = os.path.join(cache_dir, 'bitstream', plan.digest(16).hex())
+    if not os.path.exists(cached):
+        shutil.rmtree(cached + '.tmp', ignore_errors=True)
+        plan.execute_local(cached + '.tmp')
+        os.replace(cached + '.tmp', cached)
+
+    os.makedirs(build_dir, exist_ok=True)
+    report = read_report(cached, name)
+    with open(os.path.join(build_dir, name + '_report.json'), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    bitstream = os.path.join(build_dir, name + '.bin')
+    if not patchable:
+        shutil.copy(os.path.join(cached, name + '.bin'), bitstream)
+        return bitstream, report
+
+    asc = os.path.join(cached, name + '.asc')
+    for memory, placeholder_words, words in [('rom', rom_init, prog), ('ram', ram_init, data)]:
+        write_hex(os.path.join(build_dir, memory + '_placeholder.hex'), placeholder_words)
+        write_hex(os.path.join(build_dir, memory + '.hex'), words)
+        patched = os.path.join(build_dir, '%s_%s.asc' % (name, memory))
+        with open(asc) as f_in, open(patched, 'w') as f_out:
+            subprocess.check_call(['icebram', os.path.join(build_dir, memory + '_placeholder.hex'),
+                                   os.path.join(build_dir, memory + '.hex')],
+                                  stdin=f_in, stdout=f_out)
+        asc = patched
+    subprocess.check_call(['icepack', asc, bitstream])
+    return bitstream, report
+
+
+def test():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'prog.s')
+        script = os.path.join(directory, 'prog.ld')
+        with open(source, 'w') as f:
+            f.write('ecall\n')
+        with open(script, 'w') as f:
+            f.write('SECTIONS {}\n')
+        key = firmware_key([source], script, 'rv32i')
+        assert(key == firmware_key([source], script, 'rv32i'))
+        assert(key != firmware_key([source], script, 'rv32im'))
+        # A C program also depends on its startup code
+        assert(key != firmware_key([script, source], script, 'rv32i'))
+        with open(script, 'a') as f:
+            f.write('\n')
+        assert(key != firmware_key([source], script, 'rv32i'))
+
+        with open(script, 'w') as f:
+            f.write('MEMORY\n{\n    ROM : ORIGIN = 0x80000000, LENGTH = 4K\n'
+                    '    RAM (rw) : ORIGIN =     0x4000, LENGTH = 0x800\n}\n')
+        assert(memory_regions(script) == {'ROM': (0x8000_0000, 0x1000), 'RAM': (0x4000, 0x800)})
+        assert(link_depths(script) == (1024, 512))
+
+        hex_file = os.path.join(directory, 'rom.hex')
+        write_hex(hex_file, [0x13, 0xdead_beef])
+        with open(hex_file) as f:
+            assert(f.read() == '00000013\ndeadbeef\n')
+
+    # The placeholders are stable and distinct, so the bitstream key is too
+    assert(placeholder(256, 'rom') == placeholder(256, 'rom'))
+    assert(placeholder(32, 'ram') != placeholder(32, 'rom'))
+    assert(len(set(placeholder(256, 'rom'))) == 256)
+    assert(list(pad([1, 2], 4)) == [1, 2, 0, 0])
+    try:
+        pad([1, 2], 1)
+    except ValueError:
+        pass
+    else:
+        raise ValueError('expected the firmware not to fit')
+    assert(link_depths() == (1024, 1024))
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,68 @@
+from nmigen import *
+from nmigen.asserts import *
+from wishbone.formal import WbMasterFormal
+
+
+def bus_started(m):
+    # A pipelined master keeps the bus idle on the cycle following a reset.
+    started = Signal()
+    m.d.sync += started.eq(1)
+    return started
+
+
+def bus_request(m, bus, req, pipelined):
+    # A classic request holds stb until it is acknowledged, a pipelined one
+    # only until the slave stops stalling. cyc then stays up until the
+    # request has been acknowledged.
+    if pipelined:
+        waiting = Signal()
+        m.d.comb += [
+            bus.stb.eq(req & ~waiting & bus_started(m)),
+            bus.cyc.eq(bus.stb | waiting),
+        ]
+        with m.If(bus.stb & ~bus.stall):
+            m.d.sync += waiting.eq(1)
+        with m.If(bus.ack):
+            m.d.sync += waiting.eq(0)
+    else:
+        m.d.comb += [
+            bus.stb.eq(req),
+            bus.cyc.eq(1),
+        ]
+
+
+class BusFormal(Elaboratable):
+    def __init__(self, cpu, bmc_depth, max_outstanding=1):
+        self.cpu = cpu
+        self.bmc_depth = bmc_depth
+        self.max_outstanding = max_outstanding
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.cpu = self.cpu
+
+        # Both buses of the core are checked against the wishbone master
+        # properties, every slave response is left to the solver.
+        for name in ('ibus', 'dbus'):
+            bus = getattr(self.cpu, name)
+            formal = WbMasterFormal(32, 32, self.bmc_depth, self.max_outstanding)
+            m.submodules[name] = formal
+            m.d.comb += [
+                formal.wb.cyc.eq(bus.cyc),
+                formal.wb.stb.eq(bus.stb),
+                formal.wb.adr.eq(bus.adr),
+                formal.wb.we.eq(bus.we),
+                formal.wb.sel.eq(bus.sel),
+                formal.wb.dat_w.eq(bus.dat_w),
+                bus.dat_r.eq(formal.wb.dat_r),
+                bus.stall.eq(formal.wb.stall),
+                bus.ack.eq(formal.wb.ack),
+                bus.err.eq(formal.wb.err),
+            ]
+
+        with m.If(Initial()):
+            m.d.comb += ResetSignal().eq(1)
+        with m.Else():
+            m.d.comb += ResetSignal().eq(0)
+
+        return m
@@ -0,0 +1,329 @@
+from nmigen import *
+from nmigen.sim import *
+from .decoder import Opcode
+from .trace import trace
+
+
+def r_type(funct7, rs2, rs1, funct3, rd, opcode):
+    return Cat(Const(opcode, 7), rd, Const(funct3, 3), rs1, rs2, Const(funct7, 7))
+
+def i_type(imm, rs1, funct3, rd, opcode):
+    return Cat(Const(opcode, 7), rd, Const(funct3, 3), rs1, imm[:12])
+
+def s_type(imm, rs2, rs1, funct3):
+    return Cat(Const(Opcode.STORE, 7), imm[:5], Const(funct3, 3), rs1, rs2, imm[5:12])
+
+def b_type(imm, rs1, funct3):
+    return Cat(Const(Opcode.BRANCH, 7), imm[11], imm[1:5], Const(funct3, 3), rs1,
+               Const(0, 5), imm[5:11], imm[12])
+
+def j_type(imm, rd):
+    return Cat(Const(Opcode.JAL, 7), Const(rd, 5), imm[12:20], imm[11], imm[1:11], imm[20])
+
+def u_type(imm, rd, opcode):
+    return Cat(Const(opcode, 7), rd, imm[12:32])
+
+
+class Expander(Elaboratable):
+    def __init__(self):
+        self.inst = Signal(32)
+        self.out = Signal(32)
+        self.compressed = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        inst = self.inst
+        op = inst[:2]
+        funct3 = inst[13:16]
+
+        # Full and compressed register fields
+        rd = inst[7:12]
+        rs2 = inst[2:7]
+        rd_c = Cat(inst[2:5], Const(0b01, 2))
+        rs1_c = Cat(inst[7:10], Const(0b01, 2))
+        x0 = Const(0, 5)
+        x1 = Const(1, 5)
+        x2 = Const(2, 5)
+
+        # Sign extended immediates of the different formats
+        imm_ci = Cat(inst[2:7], Repl(inst[12], 27))
+        uimm_lw = Cat(Const(0, 2), inst[6], inst[10:13], inst[5], Const(0, 25))
+        uimm_lwsp = Cat(Const(0, 2), inst[4:7], inst[12], inst[2:4], Const(0, 24))
+        uimm_swsp = Cat(Const(0, 2), inst[9:13], inst[7:9], Const(0, 24))
+        nzuimm_4spn = Cat(Const(0, 2), inst[6], inst[5], inst[11:13], inst[7:11], Const(0, 22))
+        nzimm_16sp = Cat(Const(0, 4), inst[6], inst[2], inst[5], inst[3:5], Repl(inst[12], 23))
+        nzimm_lui = Cat(Const(0, 12), inst[2:7], Repl(inst[12], 15))
+        imm_j = Cat(Const(0, 1), inst[3:6], inst[11], inst[2], inst[7], inst[6], inst[9:11],
+                    inst[8], Repl(inst[12], 21))
+        imm_b = Cat(Const(0, 1), inst[3:5], inst[10:12], inst[2], inst[5:7], Repl(inst[12], 24))
+
+        m.d.comb += self.compressed.eq(op != 0b11)
+
+        # Reserved and unsupported encodings expand to 0, which the decoder
+        # traps on.
+        with m.Switch(Cat(op, funct3)):
+            with m.Case('000' '00'):
+                # c.addi4spn
+                with m.If(inst[5:13] != 0):
+                    m.d.comb += self.out.eq(i_type(nzuimm_4spn, x2, 0b000, rd_c, Opcode.IMM))
+            with m.Case('010' '00'):
+                # c.lw
+                m.d.comb += self.out.eq(i_type(uimm_lw, rs1_c, 0b010, rd_c, Opcode.LOAD))
+            with m.Case('110' '00'):
+                # c.sw
+                m.d.comb += self.out.eq(s_type(uimm_lw, rd_c, rs1_c, 0b010))
+            with m.Case('000' '01'):
+                # c.addi, c.nop
+                m.d.comb += self.out.eq(i_type(imm_ci, rd, 0b000, rd, Opcode.IMM))
+            with m.Case('001' '01'):
+                # c.jal
+                m.d.comb += self.out.eq(j_type(imm_j, 1))
+            with m.Case('010' '01'):
+                # c.li
+                m.d.comb += self.out.eq(i_type(imm_ci, x0, 0b000, rd, Opcode.IMM))
+            with m.Case('011' '01'):
+                with m.If(rd == 2):
+                    # c.addi16sp
+                    with m.If(nzimm_16sp != 0):
+                        m.d.comb += self.out.eq(i_type(nzimm_16sp, x2, 0b000, x2, Opcode.IMM))
+                with m.Elif(nzimm_lui != 0):
+                    # c.lui
+                    m.d.comb += self.out.eq(u_type(nzimm_lui, rd, Opcode.LUI))
+            with m.Case('100' '01'):
+                with m.Switch(Cat(inst[5:7], inst[10:13])):
+                    with m.Case('000--'):
+                        # c.srli
+                        m.d.comb += self.out.eq(r_type(0b0000000, inst[2:7], rs1_c, 0b101, rs1_c, Opcode.IMM))
+                    with m.Case('001--'):
+                        # c.srai
+                        m.d.comb += self.out.eq(r_type(0b0100000, inst[2:7], rs1_c, 0b101, rs1_c, Opcode.IMM))
+                    with m.Case('-10--'):
+                        # c.andi
+                        m.d.comb += self.out.eq(i_type(imm_ci, rs1_c, 0b111, rs1_c, Opcode.IMM))
+                    with m.Case('01100'):
+                        # c.sub
+                        m.d.comb += self.out.eq(r_type(0b0100000, rd_c, rs1_c, 0b000, rs1_c, Opcode.REG))
+                    with m.Case('01101'):
+                        # c.xor
+                        m.d.comb += self.out.eq(r_type(0b0000000, rd_c, rs1_c, 0b100, rs1_c, Opcode.REG))
+                    with m.Case('01110'):
+                        # c.or
+                        m.d.comb += self.out.eq(r_type(0b0000000, rd_c, rs1_c, 0b110, rs1_c, Opcode.REG))
+                    with m.Case('01111'):
+                        # c.and
+                        m.d.comb += self.out.eq(r_type(0b0000000, rd_c, rs1_c, 0b111, rs1_c, Opcode.REG))
+            with m.Case('101' '01'):
+                # c.j
+                m.d.comb += self.out.eq(j_type(imm_j, 0))
+            with m.Case('110' '01'):
+                # c.beqz
+                m.d.comb += self.out.eq(b_type(imm_b, rs1_c, 0b000))
+            with m.Case('111' '01'):
+                # c.bnez
+                m.d.comb += self.out.eq(b_type(imm_b, rs1_c, 0b001))
+            with m.Case('000' '10'):
+                # c.slli
+                with m.If(~inst[12]):
+                    m.d.comb += self.out.eq(r_type(0b0000000, inst[2:7], rd, 0b001, rd, Opcode.IMM))
+            with m.Case('010' '10'):
+                # c.lwsp
+                with m.If(rd != 0):
+                    m.d.comb += self.out.eq(i_type(uimm_lwsp, x2, 0b010, rd, Opcode.LOAD))
+            with m.Case('100' '10'):
+                with m.If(~inst[12] & (rs2 == 0)):
+                    # c.jr
+                    with m.If(rd != 0):
+                        m.d.comb += self.out.eq(i_type(Const(0, 12), rd, 0b000, x0, Opcode.JALR))
+                with m.Elif(~inst[12]):
+                    # c.mv
+                    m.d.comb += self.out.eq(r_type(0b0000000, rs2, x0, 0b000, rd, Opcode.REG))
+                with m.Elif(rs2 == 0):
+                    # c.jalr, c.ebreak isn't supported
+                    with m.If(rd != 0):
+                        m.d.comb += self.out.eq(i_type(Const(0, 12), rd, 0b000, x1, Opcode.JALR))
+                with m.Else():
+                    # c.add
+                    m.d.comb += self.out.eq(r_type(0b0000000, rs2, rd, 0b000, rd, Opcode.REG))
+            with m.Case('110' '10'):
+                # c.swsp
+                m.d.comb += self.out.eq(s_type(uimm_swsp, rs2, x2, 0b010))
+            with m.Case('---' '11'):
+                m.d.comb += self.out.eq(inst)
+
+        return m
+
+
+# The same expansion on ints, for the instruction set simulator
+
+def encode_r(funct7, rs2, rs1, funct3, rd, opcode):
+    return funct7 << 25 | rs2 << 20 | rs1 << 15 | funct3 << 12 | rd << 7 | opcode
+
+def encode_i(imm, rs1, funct3, rd, opcode):
+    return (imm & 0xfff) << 20 | rs1 << 15 | funct3 << 12 | rd << 7 | opcode
+
+def encode_s(imm, rs2, rs1, funct3):
+    return ((imm >> 5 & 0x7f) << 25 | rs2 << 20 | rs1 << 15 | funct3 << 12 |
+            (imm & 0x1f) << 7 | Opcode.STORE)
+
+def encode_b(imm, rs1, funct3):
+    return ((imm >> 12 & 1) << 31 | (imm >> 5 & 0x3f) << 25 | rs1 << 15 | funct3 << 12 |
+            (imm >> 1 & 0xf) << 8 | (imm >> 11 & 1) << 7 | Opcode.BRANCH)
+
+def encode_j(imm, rd):
+    return ((imm >> 20 & 1) << 31 | (imm >> 1 & 0x3ff) << 21 | (imm >> 11 & 1) << 20 |
+            (imm >> 12 & 0xff) << 12 | rd << 7 | Opcode.JAL)
+
+def encode_u(imm, rd, opcode):
+    return imm & 0xffff_f000 | rd << 7 | opcode
+
+
+def expand(inst):
+    if inst & 3 == 3:
+        return inst
+
+    def field(start, stop):
+        return inst >> start & ((1 << (stop - start)) - 1)
+
+    op = field(0, 2)
+    funct3 = field(13, 16)
+    rd = field(7, 12)
+    rs2 = field(2, 7)
+    rd_c = field(2, 5) | 0b01000
+    rs1_c = field(7, 10) | 0b01000
+    # Negative for the sign extended immediates
+    sign = -field(12, 13)
+
+    imm_ci = field(2, 7) | sign << 5
+    uimm_lw = field(6, 7) << 2 | field(10, 13) << 3 | field(5, 6) << 6
+    uimm_lwsp = field(4, 7) << 2 | field(12, 13) << 5 | field(2, 4) << 6
+    uimm_swsp = field(9, 13) << 2 | field(7, 9) << 6
+    nzuimm_4spn = field(6, 7) << 2 | field(5, 6) << 3 | field(11, 13) << 4 | field(7, 11) << 6
+    nzimm_16sp = (field(6, 7) << 4 | field(2, 3) << 5 | field(5, 6) << 6 | field(3, 5) << 7 |
+                  sign << 9)
+    nzimm_lui = field(2, 7) << 12 | sign << 17
+    imm_j = (field(3, 6) << 1 | field(11, 12) << 4 | field(2, 3) << 5 | field(7, 8) << 6 |
+             field(6, 7) << 7 | field(9, 11) << 8 | field(8, 9) << 10 | sign << 11)
+    imm_b = field(3, 5) << 1 | field(10, 12) << 3 | field(2, 3) << 5 | field(5, 7) << 6 | sign << 8
+
+    if (funct3, op) == (0b000, 0b00):
+        # c.addi4spn
+        if field(5, 13) != 0:
+            return encode_i(nzuimm_4spn, 2, 0b000, rd_c, Opcode.IMM)
+    elif (funct3, op) == (0b010, 0b00):
+        # c.lw
+        return encode_i(uimm_lw, rs1_c, 0b010, rd_c, Opcode.LOAD)
+    elif (funct3, op) == (0b110, 0b00):
+        # c.sw
+        return encode_s(uimm_lw, rd_c, rs1_c, 0b010)
+    elif (funct3, op) == (0b000, 0b01):
+        # c.addi, c.nop
+        return encode_i(imm_ci, rd, 0b000, rd, Opcode.IMM)
+    elif (funct3, op) == (0b001, 0b01):
+        # c.jal
+        return encode_j(imm_j, 1)
+    elif (funct3, op) == (0b010, 0b01):
+        # c.li
+        return encode_i(imm_ci, 0, 0b000, rd, Opcode.IMM)
+    elif (funct3, op) == (0b011, 0b01):
+        if rd == 2:
+            # c.addi16sp
+            if nzimm_16sp != 0:
+                return encode_i(nzimm_16sp, 2, 0b000, 2, Opcode.IMM)
+        elif nzimm_lui != 0:
+            # c.lui
+            return encode_u(nzimm_lui, rd, Opcode.LUI)
+    elif (funct3, op) == (0b100, 0b01):
+        select = field(10, 13)
+        if select == 0b000:
+            # c.srli
+            return encode_r(0b0000000, rs2, rs1_c, 0b101, rs1_c, Opcode.IMM)
+        if select == 0b001:
+            # c.srai
+            return encode_r(0b0100000, rs2, rs1_c, 0b101, rs1_c, Opcode.IMM)
+        if select & 0b011 == 0b010:
+            # c.andi
+            return encode_i(imm_ci, rs1_c, 0b111, rs1_c, Opcode.IMM)
+        if select == 0b011:
+            # c.sub, c.xor, c.or, c.and
+            funct7, funct3 = [(0b0100000, 0b000), (0, 0b100), (0, 0b110), (0, 0b111)][field(5, 7)]
+            return encode_r(funct7, rd_c, rs1_c, funct3, rs1_c, Opcode.REG)
+    elif (funct3, op) == (0b101, 0b01):
+        # c.j
+        return encode_j(imm_j, 0)
+    elif (funct3, op) == (0b110, 0b01):
+        # c.beqz
+        return encode_b(imm_b, rs1_c, 0b000)
+    elif (funct3, op) == (0b111, 0b01):
+        # c.bnez
+        return encode_b(imm_b, rs1_c, 0b001)
+    elif (funct3, op) == (0b000, 0b10):
+        # c.slli
+        if not field(12, 13):
+            return encode_r(0b0000000, rs2, rd, 0b001, rd, Opcode.IMM)
+    elif (funct3, op) == (0b010, 0b10):
+        # c.lwsp
+        if rd != 0:
+            return encode_i(uimm_lwsp, 2, 0b010, rd, Opcode.LOAD)
+    elif (funct3, op) == (0b100, 0b10):
+        if not field(12, 13) and rs2 == 0:
+            # c.jr
+            if rd != 0:
+                return encode_i(0, rd, 0b000, 0, Opcode.JALR)
+        elif not field(12, 13):
+            # c.mv
+            return encode_r(0b0000000, rs2, 0, 0b000, rd, Opcode.REG)
+        elif rs2 == 0:
+            # c.jalr, c.ebreak isn't supported
+            if rd != 0:
+                return encode_i(0, rd, 0b000, 1, Opcode.JALR)
+        else:
+            # c.add
+            return encode_r(0b0000000, rs2, rd, 0b000, rd, Opcode.REG)
+    elif (funct3, op) == (0b110, 0b10):
+        # c.swsp
+        return encode_s(uimm_swsp, rs2, 2, 0b010)
+    return 0
+
+
+def test_expander(cases):
+    dut = Expander()
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+
+    def proc():
+        for inst, expected in cases:
+            yield dut.inst.eq(inst)
+            yield Settle()
+            out = yield dut.out
+            if out != expected:
+                raise ValueError('%s: expected %s but got %s' % (hex(inst), hex(expected), hex(out)))
+
+    sim.add_process(proc)
+    with trace(sim, fragment, 'compressed'):
+        sim.run()
+
+def test():
+    cases = [
+        (0x0001, 0x0000_0013), # c.nop
+        (0x0085, 0x0010_8093), # c.addi x1, 1
+        (0x557d, 0xfff0_0513), # c.li a0, -1
+        (0x7139, 0xfc01_0113), # c.addi16sp sp, -64
+        (0x40c0, 0x0044_a403), # c.lw s0, 4(s1)
+        (0x50f2, 0x03c1_2083), # c.lwsp ra, 60(sp)
+        (0xde06, 0x0211_2e23), # c.swsp ra, 60(sp)
+        (0x852e, 0x00b0_0533), # c.mv a0, a1
+        (0x8082, 0x0000_8067), # c.ret
+        (0x0000, 0x0000_0000), # illegal
+        (0x0011_0463, 0x0011_0463), # beq x2, x1, 8
+    ]
+    test_expander(cases)
+    for inst, expected in cases:
+        assert(expand(inst) == expected)
+    print('ok')
+
+    # The model agrees with the hardware on every compressed instruction
+    test_expander([(inst, expand(inst)) for inst in range(1 << 16) if inst & 3 != 3])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -3,87 +3,99 @@ from nmigen.hdl.rec import *
 from nmigen.sim import *
 from nmigen_soc import wishbone
 from .alu import ALU
+from .arbiter import Arbiter
 from .branch import Branch
+from .bus import bus_request
+from .compressed import Expander
+from .csr import CSRFile, Event
 from .decoder import Decoder, PcOp
+from .elf import words
 from .gpio import Gpio
+from .icache import ICache
+from .layouts import ROM_BASE, RAM_BASE, GPIO_BASE, GPIO_SIZE, wishbone_layout, rvfi_layout
 from .loadstore import LoadStore
+from .pipeline import RV32Pipelined
+from .prefetch import Prefetch
 from .regs import Registers
 from .ram import RAM
 from .rom import ROM
 
-wishbone_layout = [
-    ("adr",   30, DIR_FANOUT),
-    ("dat_w", 32, DIR_FANOUT),
-    ("dat_r", 32, DIR_FANIN),
-    ("sel",    4, DIR_FANOUT),
-    ("cyc",    1, DIR_FANOUT),
-    ("stb",    1, DIR_FANOUT),
-    ("ack",    1, DIR_FANIN),
-    ("we",     1, DIR_FANOUT),
-    ("cti",    3, DIR_FANOUT),
-    ("bte",    2, DIR_FANOUT),
-    ("err",    1, DIR_FANIN)
-]
-
-# RISC-V Formal Interface
-# https://github.com/SymbioticEDA/riscv-formal/blob/master/docs/rvfi.md
-
-rvfi_layout = [
-    ("valid",      1, DIR_FANOUT),
-    ("order",     64, DIR_FANOUT),
-    ("insn",      32, DIR_FANOUT),
-    ("trap",       1, DIR_FANOUT),
-    ("halt",       1, DIR_FANOUT),
-    ("intr",       1, DIR_FANOUT),
-    ("mode",       2, DIR_FANOUT),
-    ("ixl",        2, DIR_FANOUT),
-
-    ("rs1_addr",   5, DIR_FANOUT),
-    ("rs2_addr",   5, DIR_FANOUT),
-    ("rs1_rdata", 32, DIR_FANOUT),
-    ("rs2_rdata", 32, DIR_FANOUT),
-    ("rd_addr",    5, DIR_FANOUT),
-    ("rd_wdata",  32, DIR_FANOUT),
-
-    ("pc_rdata",  32, DIR_FANOUT),
-    ("pc_wdata",  32, DIR_FANOUT),
-
-    ("mem_addr",  32, DIR_FANOUT),
-    ("mem_rmask",  4, DIR_FANOUT),
-    ("mem_wmask",  4, DIR_FANOUT),
-    ("mem_rdata", 32, DIR_FANOUT),
-    ("mem_wdata", 32, DIR_FANOUT)
-]
-
 class RV32(Elaboratable):
-    def __init__(self, reset_address=0x8000_0000, with_rvfi=False):
+    def __init__(self, reset_address=0x8000_0000, with_rvfi=False, prefetch_depth=0, muldiv=None,
+                 with_c=False, pipelined_bus=False, with_csr=False):
+        if with_c and prefetch_depth:
+            raise ValueError('compressed instructions can\'t be prefetched')
         self.reset_address = reset_address
         self.with_rvfi = with_rvfi
+        self.prefetch_depth = prefetch_depth
+        self.muldiv = muldiv
+        self.with_c = with_c
+        self.pipelined_bus = pipelined_bus
+        self.csr = CSRFile() if with_csr else None
 
         self.ibus = Record(wishbone_layout)
         self.dbus = Record(wishbone_layout)
+        # A fence asks the data cache to write back and drop its lines, and
+        # retires once it isn't busy anymore
+        self.flush = Signal()
+        self.flush_busy = Signal()
         if with_rvfi:
             self.rvfi = Record(rvfi_layout)
 
     def elaborate(self, platform):
         m = Module()
 
-        decoder   = m.submodules.decoder   = Decoder()
-        regs      = m.submodules.regs      = Registers()
+        decoder   = m.submodules.decoder   = Decoder(with_m = self.muldiv is not None,
+                                                     with_csr = self.csr is not None)
+        # The registers are addressed by the instruction as it is fetched, and
+        # written on the last cycle of an instruction, when nothing reads them
+        regs      = m.submodules.regs      = Registers(transparent = False)
         alu       = m.submodules.alu       = ALU()
         branch    = m.submodules.branch    = Branch()
         loadstore = m.submodules.loadstore = LoadStore()
+        muldiv    = self.muldiv
+        if muldiv is not None:
+            m.submodules.muldiv = muldiv
+            m.d.comb += [
+                muldiv.funct3.eq(decoder.funct3),
+                muldiv.in1.eq(regs.rs1_data),
+                muldiv.in2.eq(regs.rs2_data),
+            ]
+        csr       = self.csr
+        events    = Signal(Event.COUNT)
+        if csr is not None:
+            m.submodules.csr = csr
+            m.d.comb += [
+                csr.funct3.eq(decoder.funct3),
+                csr.addr.eq(decoder.imm[:12]),
+                csr.rs1.eq(decoder.inst[15:20]),
+                csr.in1.eq(regs.rs1_data),
+                csr.events.eq(events),
+            ]
 
         pc = Signal(32, reset=self.reset_address)
         pc_next = Signal(32)
         pc_next_temp = Signal(32)
-        pc_4 = Signal(32)
+        pc_inc = Signal(32)
         inst = Signal(32)
-        m.d.comb += pc_4.eq(pc + 4)
+        raw_inst = Signal(32)
+        if self.with_c:
+            expander = m.submodules.expander = Expander()
+            m.d.comb += [
+                expander.inst.eq(raw_inst),
+                decoder.inst.eq(expander.out),
+                pc_inc.eq(pc + Mux(expander.compressed, 2, 4)),
+            ]
+        else:
+            m.d.comb += [
+                decoder.inst.eq(raw_inst),
+                pc_inc.eq(pc + 4),
+            ]
         rs1_en = Signal()
         rs2_en = Signal()
         rd_en = Signal()
         mem_addr = Signal(32)
+        pc_en = Signal()
 
         inst_addr_missaligned = Signal()
         illegal_inst = Signal()
@@ -91,10 +103,28 @@ class RV32(Elaboratable):
         valid = Signal()
         trap = Signal()
 
+        buf_valid = Signal()
+        buf_adr = Signal(30)
+        buf_word = Signal(32)
+
+        ibus_req = Signal()
+        dbus_req = Signal()
+        if not self.prefetch_depth:
+            bus_request(m, self.ibus, ibus_req, self.pipelined_bus)
+        bus_request(m, self.dbus, dbus_req, self.pipelined_bus)
+
+        if self.prefetch_depth:
+            prefetch = m.submodules.prefetch = Prefetch(self.reset_address, self.prefetch_depth,
+                                                        self.pipelined_bus)
+            m.d.comb += [
+                prefetch.ibus.connect(self.ibus),
+                prefetch.flush_pc.eq(pc_next),
+            ]
+        else:
+            m.d.comb += self.ibus.adr.eq(pc[2:])
+
         m.d.comb += [
-            self.ibus.adr.eq(pc[2:]),
-            self.ibus.cyc.eq(1),
-            decoder.inst.eq(self.ibus.dat_r),
+            raw_inst.eq(self.ibus.dat_r),
             regs.rs1_addr.eq(decoder.rs1),
             regs.rs2_addr.eq(decoder.rs2),
             regs.rd_addr.eq(decoder.rd),
@@ -110,14 +140,18 @@ class RV32(Elaboratable):
             self.dbus.adr.eq(mem_addr[2:]),
             self.dbus.sel.eq(loadstore.sel),
             self.dbus.dat_w.eq(loadstore.value_out),
-            self.dbus.cyc.eq(1),
             illegal_inst.eq(decoder.trap),
-            inst_addr_missaligned.eq(pc_next_temp[0] | pc_next_temp[1]),
             mem_addr_missaligned.eq(loadstore.trap),
             trap.eq(inst_addr_missaligned | illegal_inst | mem_addr_missaligned),
             pc_next.eq(Mux(trap, pc, pc_next_temp)),
             rd_en.eq(decoder.rd_en & ~decoder.mem_op_en),
         ]
+        if self.with_c:
+            m.d.comb += inst_addr_missaligned.eq(pc_next_temp[0])
+        else:
+            m.d.comb += inst_addr_missaligned.eq(pc_next_temp[0] | pc_next_temp[1])
+        if csr is not None:
+            m.d.comb += illegal_inst.eq(decoder.trap | (decoder.csr_op_en & csr.illegal))
 
         with m.Switch(decoder.pc_op):
             with m.Case(PcOp.NEXT):
@@ -125,7 +159,7 @@ class RV32(Elaboratable):
                     alu.funct4.eq(Cat(decoder.funct1, decoder.funct3)),
                     rs1_en.eq(decoder.rs1_en),
                     rs2_en.eq(decoder.rs2_en),
-                    pc_next_temp.eq(pc_4),
+                    pc_next_temp.eq(pc_inc),
                     regs.rd_data.eq(alu.out),
                 ]
                 with m.If(decoder.mem_op_en):
@@ -138,50 +172,141 @@ class RV32(Elaboratable):
                     rs1_en.eq(0),
                     rs2_en.eq(0),
                     pc_next_temp.eq(alu.out),
-                    regs.rd_data.eq(pc_4),
+                    regs.rd_data.eq(pc_inc),
                 ]
             with m.Case(PcOp.JALR):
                 m.d.comb += [
                     rs1_en.eq(1),
                     rs2_en.eq(0),
                     pc_next_temp.eq(alu.out),
-                    regs.rd_data.eq(pc_4),
+                    regs.rd_data.eq(pc_inc),
                 ]
             with m.Case(PcOp.BRANCH):
                 m.d.comb += [
                     alu.funct4.eq(0),
                     rs1_en.eq(0),
                     rs2_en.eq(0),
-                    pc_next_temp.eq(Mux(branch.out, alu.out, pc_4)),
+                    pc_next_temp.eq(Mux(branch.out, alu.out, pc_inc)),
                 ]
 
         with m.FSM():
             with m.State('FETCH'):
-                m.d.comb += self.ibus.stb.eq(1)
-                with m.If(self.ibus.ack):
-                    m.next = 'EXECUTE'
-                    m.d.sync += inst.eq(self.ibus.dat_r)
-                    m.d.comb += decoder.inst.eq(self.ibus.dat_r)
+                if self.prefetch_depth:
+                    m.d.comb += raw_inst.eq(prefetch.inst)
+                    with m.If(prefetch.valid):
+                        m.next = 'EXECUTE'
+                        m.d.sync += inst.eq(prefetch.inst)
+                        m.d.comb += prefetch.ready.eq(1)
+                    with m.Else():
+                        m.d.comb += events[Event.FETCH_STALL].eq(1)
+                elif self.with_c:
+                    # The last fetched word is kept, so the second half of a
+                    # word doesn't go over the bus again.
+                    word = Signal(32)
+                    half = Signal(16)
+                    buffered = Signal()
+                    m.d.comb += [
+                        buffered.eq(buf_valid & (buf_adr == pc[2:])),
+                        ibus_req.eq(~buffered),
+                        word.eq(Mux(buffered, buf_word, self.ibus.dat_r)),
+                        half.eq(Mux(pc[1], word[16:], word[:16])),
+                        raw_inst.eq(Mux(half[:2] != 0b11, half, word)),
+                    ]
+                    with m.If(self.ibus.ack):
+                        m.d.sync += [
+                            buf_valid.eq(1),
+                            buf_adr.eq(pc[2:]),
+                            buf_word.eq(self.ibus.dat_r),
+                        ]
+                    with m.If(buffered | self.ibus.ack):
+                        with m.If((half[:2] != 0b11) | ~pc[1]):
+                            m.next = 'EXECUTE'
+                            m.d.sync += inst.eq(raw_inst)
+                        with m.Else():
+                            m.next = 'FETCH_HI'
+                            m.d.sync += inst.eq(half)
+                    with m.Else():
+                        m.d.comb += events[Event.FETCH_STALL].eq(1)
+                else:
+                    m.d.comb += ibus_req.eq(1)
+                    with m.If(self.ibus.ack):
+                        m.next = 'EXECUTE'
+                        m.d.sync += inst.eq(self.ibus.dat_r)
+                        m.d.comb += raw_inst.eq(self.ibus.dat_r)
+                    with m.Else():
+                        m.d.comb += events[Event.FETCH_STALL].eq(1)
+            if self.with_c:
+                # A 32-bit instruction straddling two words
+                with m.State('FETCH_HI'):
+                    m.d.comb += [
+                        self.ibus.adr.eq(pc[2:] + 1),
+                        ibus_req.eq(1),
+                        raw_inst.eq(Cat(inst[:16], self.ibus.dat_r[:16])),
+                    ]
+                    with m.If(self.ibus.ack):
+                        m.next = 'EXECUTE'
+                        m.d.sync += [
+                            inst.eq(raw_inst),
+                            buf_valid.eq(1),
+                            buf_adr.eq(pc[2:] + 1),
+                            buf_word.eq(self.ibus.dat_r),
+                        ]
+                    with m.Else():
+                        m.d.comb += events[Event.FETCH_STALL].eq(1)
             with m.State('EXECUTE'):
-                m.d.comb += decoder.inst.eq(inst)
+                m.d.comb += raw_inst.eq(inst)
                 with m.If(trap):
                     m.next = 'FETCH'
                     m.d.comb += valid.eq(0)
-                    m.d.sync += pc.eq(pc_next)
+                    m.d.comb += pc_en.eq(1)
+                    m.d.comb += events[Event.TRAP].eq(1)
                 with m.Elif(decoder.mem_op_en):
                     m.next = 'WRITE'
+                with m.Elif(decoder.muldiv_op_en):
+                    # Stay in execute until the multiplier or divider is done
+                    if muldiv is not None:
+                        m.d.comb += [
+                            muldiv.en.eq(1),
+                            muldiv.ack.eq(muldiv.ready),
+                            regs.rd_data.eq(muldiv.out),
+                        ]
+                        with m.If(muldiv.ready):
+                            m.next = 'FETCH'
+                            m.d.comb += [
+                                regs.rd_we.eq(1),
+                                valid.eq(1),
+                                pc_en.eq(1),
+                            ]
+                with m.Elif(decoder.fence_op_en):
+                    m.next = 'FENCE'
+                    m.d.comb += self.flush.eq(1)
                 with m.Else():
                     m.next = 'FETCH'
                     m.d.comb += [
                         regs.rd_we.eq(1),
                         valid.eq(1),
                     ]
-                    m.d.sync += pc.eq(pc_next)
+                    m.d.comb += pc_en.eq(1)
+                    if csr is not None:
+                        m.d.comb += csr.en.eq(decoder.csr_op_en)
+                        with m.If(decoder.csr_op_en):
+                            m.d.comb += regs.rd_data.eq(csr.out)
+            with m.State('FENCE'):
+                # The cache raises busy the cycle after the flush
+                m.d.comb += raw_inst.eq(inst)
+                with m.If(~self.flush_busy):
+                    m.next = 'FETCH'
+                    m.d.comb += [
+                        valid.eq(1),
+                        pc_en.eq(1),
+                    ]
+                with m.Else():
+                    m.d.comb += events[Event.MEM_STALL].eq(1)
             with m.State('WRITE'):
                 m.d.comb += [
-                    decoder.inst.eq(inst),
+                    raw_inst.eq(inst),
                     mem_addr.eq(alu.out),
-                    self.dbus.stb.eq(1),
+                    dbus_req.eq(1),
                     self.dbus.we.eq(decoder.mem_op_store),
                 ]
                 with m.If(self.dbus.ack):
@@ -191,7 +316,18 @@ class RV32(Elaboratable):
                         regs.rd_we.eq(~decoder.mem_op_store),
                         regs.rd_data.eq(loadstore.value_out),
                     ]
-                    m.d.sync += pc.eq(pc_next)
+                    m.d.comb += pc_en.eq(1)
+                with m.Else():
+                    m.d.comb += events[Event.MEM_STALL].eq(1)
+
+        m.d.comb += events[Event.BRANCH_TAKEN].eq(valid & (decoder.pc_op == PcOp.BRANCH) & branch.out)
+        if csr is not None:
+            m.d.comb += csr.retire.eq(valid)
+
+        with m.If(pc_en):
+            m.d.sync += pc.eq(pc_next)
+        if self.prefetch_depth:
+            m.d.comb += prefetch.flush.eq(pc_en & (pc_next != pc_inc))
 
         if hasattr(self, 'rvfi'):
             m.d.comb += [
@@ -227,12 +363,39 @@ class RV32(Elaboratable):
 
 
 class Top(Elaboratable):
-    def __init__(self, prog, with_rvfi=False):
-        self.cpu = RV32(with_rvfi=with_rvfi)
-        self.bus = wishbone.Decoder(addr_width = 32, data_width = 32)
-        self.rom = ROM(prog)
-        self.ram = RAM(32)
-        self.gpio = Gpio()
+    def __init__(self, prog, with_rvfi=False, pipeline=False, prefetch_depth=0, predictor=None,
+                 icache=None, dcache=None, muldiv=None, with_c=False, pipelined_bus=False,
+                 mem_latency=1, with_csr=False, data=None, reset_address=0x8000_0000,
+                 ram_depth=32, spram=False, dual_port_rom=False):
+        if pipeline and with_c:
+            raise ValueError('the pipelined core doesn\'t support compressed instructions')
+        if pipelined_bus and (icache is not None or dcache is not None):
+            raise ValueError('the caches only support classic bus cycles')
+        if 4 * ram_depth > GPIO_BASE - RAM_BASE:
+            raise ValueError('%d words of ram overlap the gpio' % ram_depth)
+        # Stores to the gpio have to reach it, whichever cache is given
+        if dcache is not None and not any(base <= GPIO_BASE and GPIO_BASE + GPIO_SIZE <= base + size
+                                          for base, size in dcache.uncached):
+            dcache.uncached = [*dcache.uncached, (GPIO_BASE, GPIO_SIZE)]
+        if pipeline:
+            self.cpu = RV32Pipelined(reset_address, with_rvfi=with_rvfi, predictor=predictor,
+                                     muldiv=muldiv, pipelined_bus=pipelined_bus,
+                                     with_csr=with_csr)
+        else:
+            self.cpu = RV32(reset_address, with_rvfi=with_rvfi, prefetch_depth=prefetch_depth,
+                            muldiv=muldiv, with_c=with_c, pipelined_bus=pipelined_bus,
+                            with_csr=with_csr)
+        self.pipelined_bus = pipelined_bus
+        self.bus = wishbone.Decoder(addr_width = 32, data_width = 32, granularity = 8,
+                                    features = {"stall"} if pipelined_bus else frozenset())
+        self.rom = ROM(prog, pipelined_bus, mem_latency, dual_port_rom)
+        # Loads reach the rom through its second port, or share the first one
+        # with the fetches
+        self.arbiter = None if dual_port_rom else Arbiter(self.rom)
+        self.ram = RAM(ram_depth, pipelined_bus, mem_latency, data, spram)
+        self.gpio = Gpio(pipelined_bus)
+        self.icache = icache
+        self.dcache = dcache
         self.clk = Signal()
 
     def elaborate(self, platform):
@@ -243,8 +406,32 @@ class Top(Elaboratable):
         m.submodules.rom  = self.rom
         m.submodules.ram  = self.ram
 
-        self.bus.add(self.ram, addr = 0x4000 >> 2)
-        self.bus.add(self.gpio, addr = 0x5000 >> 2)
+        rom = self.rom
+        if self.arbiter is not None:
+            m.submodules.arbiter = self.arbiter
+            rom = self.arbiter.ibus
+            self.bus.add(self.arbiter.dbus, addr = ROM_BASE)
+        else:
+            self.bus.add(self.rom.port_b, addr = ROM_BASE)
+
+        ibus = self.cpu.ibus
+        if self.icache is not None:
+            m.submodules.icache = self.icache
+            m.d.comb += self.cpu.ibus.connect(self.icache.cpu)
+            ibus = self.icache.mem
+
+        dbus = self.cpu.dbus
+        if self.dcache is not None:
+            m.submodules.dcache = self.dcache
+            m.d.comb += [
+                self.cpu.dbus.connect(self.dcache.cpu),
+                self.dcache.flush.eq(self.cpu.flush),
+                self.cpu.flush_busy.eq(self.dcache.busy),
+            ]
+            dbus = self.dcache.mem
+
+        self.bus.add(self.ram, addr = RAM_BASE)
+        self.bus.add(self.gpio, addr = GPIO_BASE)
         bus = self.bus.bus
 
         #por = ClockDomain(reset_less=True)
@@ -259,20 +446,26 @@ class Top(Elaboratable):
             #ClockSignal().eq(por.clk),
             #ResetSignal().eq(delay != 0),
 
-            self.rom.cyc.eq(self.cpu.ibus.cyc),
-            self.rom.stb.eq(self.cpu.ibus.stb),
-            self.rom.adr.eq(self.cpu.ibus.adr),
-            self.cpu.ibus.ack.eq(self.rom.ack),
-            self.cpu.ibus.dat_r.eq(self.rom.dat_r),
-
-            bus.cyc.eq(self.cpu.dbus.cyc),
-            bus.stb.eq(self.cpu.dbus.stb),
-            bus.adr.eq(self.cpu.dbus.adr),
-            bus.dat_w.eq(self.cpu.dbus.dat_w),
-            bus.we.eq(self.cpu.dbus.we),
-            self.cpu.dbus.ack.eq(bus.ack),
-            self.cpu.dbus.dat_r.eq(bus.dat_r),
+            rom.cyc.eq(ibus.cyc),
+            rom.stb.eq(ibus.stb),
+            rom.adr.eq(ibus.adr),
+            ibus.ack.eq(rom.ack),
+            ibus.dat_r.eq(rom.dat_r),
+
+            bus.cyc.eq(dbus.cyc),
+            bus.stb.eq(dbus.stb),
+            bus.adr.eq(dbus.adr),
+            bus.dat_w.eq(dbus.dat_w),
+            bus.sel.eq(dbus.sel),
+            bus.we.eq(dbus.we),
+            dbus.ack.eq(bus.ack),
+            dbus.dat_r.eq(bus.dat_r),
         ]
+        if self.pipelined_bus:
+            m.d.comb += [
+                ibus.stall.eq(rom.stall),
+                dbus.stall.eq(bus.stall),
+            ]
 
         #if platform is not None:
         #    clk = platform.request('clk12')
@@ -281,17 +474,11 @@ class Top(Elaboratable):
         return m
 
 def read_prog(path):
-    prog = []
+    # A raw binary, executables are loaded with rv32.elf.load_elf
     with open(path, 'rb') as f:
-        while True:
-            b = f.read(4)
-            if b == b'':
-                break
-            i = int.from_bytes(b, byteorder='little', signed=False)
-            prog.append(i)
-    return prog
+        return words(f.read())
 
-if __name__ == '__main__':
+def test():
     prog = [
         0xdead_c0b7, # lui   x1, 0xdeadc
         0xeef0_8093, # addi  x1, x1,-273
@@ -302,105 +489,126 @@ if __name__ == '__main__':
         0x0011_0463, # beq   x2,x1,80000020
         0x0000_0073, # ecall
         0x0000_0013, # addi x0,x0,0
+        0x0000_0073, # ecall
     ]
 
-    dut = Top(prog, with_rvfi=True)
-    sim = Simulator(dut)
-    rvfi = dut.cpu.rvfi
-    assert_en = False
-    with sim.write_vcd('vcd/rv32.vcd'):
-        def step():
-            clock = 0
-            yield Tick()
-            yield Settle()
-            while (yield rvfi.valid) != 1 and clock < 5:
-                assert(yield rvfi.trap != 1)
-                clock += 1
-                yield Tick()
-                yield Settle()
-            assert(clock < 8)
+    from .cosim import cosim
+    from .dcache import DCache
+    from .iss import ISS
+
+    for kwargs in [{}, {'prefetch_depth': 2}, {'with_c': True}, {'pipelined_bus': True}]:
+        retired, cycles = cosim(Top(prog, with_rvfi=True, **kwargs),
+                                ISS(prog, with_c='with_c' in kwargs), name='rv32')
+        assert(retired == 8)
+
+    # Compressed instructions, a 32-bit one straddling two words and a jump
+    # to a halfword
+    prog = [
+        0x147d_4415, # c.li  x8,5            c.addi x8,-1
+        0x8513_84a2, # c.mv  x9,x8           addi  x10,x9,16 ...
+        0x2011_0104, # ...                   c.jal .+4
+        0x9526_4501, # c.li  x10,0           c.add x10,x9
+        0xc188_6591, # c.lui x11,0x4         c.sw  x10,0(x11)
+        0x0001_4190, # c.lw  x12,0(x11)      c.nop
+        0x0000_0073, # ecall
+    ]
+    for kwargs in [{}, {'pipelined_bus': True}]:
+        iss = ISS(prog, with_c=True)
+        retired, cycles = cosim(Top(prog, with_rvfi=True, with_c=True, **kwargs), iss,
+                                name='rv32_compressed')
+        assert(retired == 10)
+        assert(iss.x[12] == 24 and iss.x[1] == 0x8000_000c)
+
+    # sb and sh merge into the stored word, past the default 32 words of ram,
+    # and a byte with its top bit set isn't sign extended into the other lanes
+    prog = [
+        0x0000_40b7, # lui   x1,0x4
+        0xdead_c137, # lui   x2,0xdeadc
+        0xeef1_0113, # addi  x2,x2,-273
+        0x7e20_ae23, # sw    x2,2044(x1)
+        0x7e20_8e23, # sb    x2,2044(x1)
+        0x7e00_8ea3, # sb    x0,2045(x1)
+        0x7e10_9f23, # sh    x1,2046(x1)
+        0x7fc0_a183, # lw    x3,2044(x1)
+        0x0000_0073, # ecall
+    ]
+    for kwargs in [{}, {'pipelined_bus': True}, {'mem_latency': 0}]:
+        iss = ISS(prog, ram_depth=1024)
+        cosim(Top(prog, with_rvfi=True, ram_depth=1024, **kwargs), iss, name='rv32_bytes')
+        assert(iss.x[3] == 0x4000_00ef)
 
+    # Loads read constants from the rom
+    prog = [
+        0x0000_0097, # auipc x1,0x0
+        0x0140_a103, # lw    x2,20(x1)
+        0x0170_c183, # lbu   x3,23(x1)
+        0x0180_a203, # lw    x4,24(x1)
+        0x0000_0073, # ecall
+        0xdead_beef,
+        0x0c0f_fee0,
+    ]
+    for kwargs in [{}, {'dual_port_rom': True}, {'pipelined_bus': True},
+                   {'pipelined_bus': True, 'dual_port_rom': True}, {'mem_latency': 0},
+                   {'pipeline': True}, {'pipeline': True, 'pipelined_bus': True},
+                   {'icache': ICache()}, {'dcache': DCache()}]:
+        iss = ISS(prog)
+        retired, cycles = cosim(Top(prog, with_rvfi=True, **kwargs), iss, name='rv32_rom')
+        assert(retired == 4)
+        assert(iss.x[2:5] == [0xdead_beef, 0xde, 0x0c0f_fee0])
+
+    # A store stays in a write-back cache until a fence flushes it
+    def stored(fence, **kwargs):
+        prog = [
+            0x0000_40b7, # lui   x1,0x4
+            0x0050_0113, # addi  x2,x0,5
+            0x0020_a023, # sw    x2,0(x1)
+        ] + [0x0ff0_000f] * fence + [ # fence
+            0x0000_0073, # ecall
+        ]
+        retired, cycles = cosim(Top(prog, with_rvfi=True, dcache=DCache(write_back=True),
+                                    **kwargs), ISS(prog), name='rv32_fence')
+        assert(retired == 3 + fence)
+        top = Top(prog, dcache=DCache(write_back=True), **kwargs)
+        sim = Simulator(top)
+        word = []
         def proc():
-            yield from step()
-            reset_address = 0x8000_0000
-            if assert_en:
-                assert(yield rvfi.pc_rdata == reset_address)
-                assert(yield rvfi.pc_wdata == reset_address + 4)
-                assert(yield rvfi.insn == prog[0])
-                assert(yield rvfi.rs1_addr == 0)
-                assert(yield rvfi.rs1_rdata == 0)
-                assert(yield rvfi.rs2_addr == 0)
-                assert(yield rvfi.rs2_rdata == 0)
-                assert(yield rvfi.rd_addr == 1)
-                assert(yield rvfi.rd_wdata == 0xdeadc000)
-
-            yield from step()
-            if assert_en:
-                assert(yield rvfi.insn == prog[1])
-                assert(yield rvfi.rs1_addr == 1)
-                assert(yield rvfi.rs1_rdata == 0xdeadc000)
-                assert(yield rvfi.rs2_addr == 0)
-                assert(yield rvfi.rs2_rdata == 0)
-                assert(yield rvfi.rd_addr == 1)
-                assert(yield rvfi.rd_wdata == 0xdeadbeef)
-
-            yield from step()
-            if assert_en:
-                assert(yield rvfi.insn == prog[2])
-                assert(yield rvfi.rs1_addr == 0)
-                assert(yield rvfi.rs1_rdata == 0)
-                assert(yield rvfi.rs2_addr == 0)
-                assert(yield rvfi.rs2_rdata == 0)
-                assert(yield rvfi.rd_addr == 3)
-                assert(yield rvfi.rd_wdata == 0x4008)
-
-            yield from step()
-            if assert_en:
-                assert(yield rvfi.insn == prog[3])
-                assert(yield rvfi.rs2_addr == 1)
-                assert(yield rvfi.rs2_rdata == 0xdeadbeef)
-                assert(yield rvfi.mem_addr == 0x4000)
-                assert(yield rvfi.mem_wdata == 0xdead_beef)
-
-            yield from step()
-            if assert_en:
-                assert(yield rvfi.insn == prog[4])
-                assert(yield rvfi.rs1_addr == 0)
-                assert(yield rvfi.rs1_rdata == 0)
-                assert(yield rvfi.rs2_addr == 0)
-                assert(yield rvfi.rs2_rdata == 0)
-                assert(yield rvfi.rd_addr == 2)
-                assert(yield rvfi.rd_wdata == 0x4010)
-
-            yield from step()
-            if assert_en:
-                assert(yield rvfi.insn == prog[5])
-                assert(yield rvfi.rd_addr == 2)
-                assert(yield rvfi.rd_wdata == 0xdeadbeef)
-                assert(yield rvfi.mem_addr == 0x4000)
-                assert(yield rvfi.mem_rdata == 0xdead_beef)
-
-            yield from step()
-            if assert_en:
-                assert(yield rvfi.insn == prog[6])
-                assert(yield rvfi.rs1_addr == 2)
-                assert(yield rvfi.rs1_rdata == 0xdeadbeef)
-                assert(yield rvfi.rs2_addr == 1)
-                assert(yield rvfi.rs2_rdata == 0xdeadbeef)
-                assert(yield rvfi.rd_addr == 0)
-                assert(yield rvfi.rd_wdata == 0)
-                assert(yield rvfi.pc_wdata == reset_address + 32)
-
-            yield from step()
-            if assert_en:
-                assert(yield rvfi.insn == prog[8])
-
-            yield Tick()
-            yield Tick()
-            yield Tick()
-            yield Tick()
-            yield Settle()
+            for _ in range(cycles + 10):
+                yield Tick()
+            word.append((yield top.ram.data[0]))
+        sim.add_clock(1e-6, domain='sync')
+        sim.add_process(proc)
+        sim.run()
+        return word[0]
+    for kwargs in [{}, {'pipeline': True}]:
+        assert(stored(False, **kwargs) == 0)
+        assert(stored(True, **kwargs) == 5)
 
+    # The gpio bypasses a write-back cache that wasn't told about it
+    prog = [
+        0x0000_50b7, # lui   x1,0x5
+        0x0050_0113, # addi  x2,x0,5
+        0x0020_a023, # sw    x2,0(x1)
+        0x0000_0073, # ecall
+    ]
+    for kwargs in [{}, {'pipeline': True}]:
+        top = Top(prog, dcache=DCache(write_back=True), **kwargs)
+        sim = Simulator(top)
+        leds = []
+        def proc():
+            for _ in range(30):
+                yield Tick()
+            leds.append((yield top.gpio.leds))
         sim.add_clock(1e-6, domain='sync')
-        sim.add_sync_process(proc)
+        sim.add_process(proc)
         sim.run()
+        assert(leds[0] == 5)
+
+    try:
+        Top(prog, ram_depth=2048)
+    except ValueError:
+        pass
+    else:
+        raise ValueError('expected the ram to overlap the gpio')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,185 @@
+from nmigen import Fragment
+from nmigen.sim import *
+from .iss import ISS
+from .trace import trace
+
+# Retirement fields compared between the core and the simulator
+FIELDS = [
+    'order',
+    'insn',
+    'pc_rdata',
+    'pc_wdata',
+    'rs1_addr',
+    'rs1_rdata',
+    'rs2_addr',
+    'rs2_rdata',
+    'rd_addr',
+    'rd_wdata',
+    'mem_addr',
+    'mem_rmask',
+    'mem_wmask',
+    'mem_rdata',
+    'mem_wdata',
+]
+
+
+def diff(rtl, iss):
+    lines = ['diverged at order %d, pc %s, insn %s' % (
+        iss['order'], hex(iss['pc_rdata']), hex(iss['insn']))]
+    for field in FIELDS:
+        if rtl[field] != iss[field]:
+            lines.append('  %-10s rtl %-12s iss %s' % (field, hex(rtl[field]), hex(iss[field])))
+    return '\n'.join(lines)
+
+
+class LockStep:
+    def __init__(self, iss, drain):
+        self.iss = iss
+        self.drain = drain
+        self.expected = iss.step()
+        self.retired = 0
+        self.stop = None
+
+    def done(self, cycle):
+        return self.stop is not None and cycle >= self.stop
+
+    def retire(self, rtl, cycle):
+        expected = self.expected
+        if self.stop is not None:
+            raise ValueError('retired after the simulator trapped\n' + diff(rtl, expected))
+        if any(rtl[field] != expected[field] for field in FIELDS):
+            raise ValueError(diff(rtl, expected))
+        self.retired += 1
+        self.expected = self.iss.step()
+        if self.expected['trap']:
+            self.stop = cycle + self.drain
+
+    def result(self, cycle):
+        return self.retired, cycle - self.drain if self.stop is not None else cycle
+
+
+def cosim(dut, iss, cycles=10000, drain=50, name='cosim', backend='pysim'):
+    # Runs a Top with rvfi in lock step with the instruction set simulator
+    # and raises on the first retirement that differs. Once the simulator
+    # traps, the core may not retire anything for drain cycles. Returns the
+    # number of retired instructions and the cycles taken.
+    cpu = dut.cpu
+    # The counters depend on the timing of the core, which the simulator
+    # doesn't model
+    if getattr(cpu, 'csr', None) is not None:
+        raise ValueError('the simulator has no counter csrs')
+    if getattr(cpu, 'with_c', False) != iss.with_c:
+        raise ValueError('the core and the simulator disagree on compressed instructions')
+    rvfi = cpu.rvfi
+    lockstep = LockStep(iss, drain)
+
+    if backend == 'cxxrtl':
+        from .cxxsim import CxxSimulator
+
+        sim = CxxSimulator(dut, ports=[rvfi.valid] + [getattr(rvfi, field) for field in FIELDS])
+        cycle = 0
+        while cycle < cycles and not lockstep.done(cycle):
+            # Cycles without a retirement don't leave the compiled model
+            limit = cycles if lockstep.stop is None else min(cycles, lockstep.stop)
+            ran, _ = sim.run(limit - cycle, stop=rvfi.valid)
+            cycle += ran
+            if cycle == limit:
+                break
+            rtl = {field: sim.get(getattr(rvfi, field)) for field in FIELDS}
+            sim.tick()
+            cycle += 1
+            lockstep.retire(rtl, cycle)
+        return lockstep.result(cycle)
+    if backend != 'pysim':
+        raise ValueError('unknown backend %s' % backend)
+
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    result = []
+
+    def proc():
+        cycle = 0
+        while cycle < cycles and not lockstep.done(cycle):
+            # Sampled ahead of the edge, so the first cycle isn't missed
+            yield Settle()
+            valid = yield rvfi.valid
+            rtl = {}
+            if valid:
+                for field in FIELDS:
+                    rtl[field] = yield getattr(rvfi, field)
+            yield Tick()
+            cycle += 1
+            if valid:
+                lockstep.retire(rtl, cycle)
+        result.append(lockstep.result(cycle))
+
+    sim.add_clock(1e-6, domain='sync')
+    sim.add_process(proc)
+    with trace(sim, fragment, name):
+        sim.run()
+    return result[0]
+
+
+def test_cosim(backend='pysim'):
+    from .core import Top
+    from .muldiv import MulDiv
+    from .predictor import BTBPredictor
+
+    # Fills the ram with a byte pattern, sums it up and shows it on the leds
+    prog = [
+        0x0000_40b7, # lui   x1, 0x4
+        0x0200_0113, # addi  x2, x0, 32
+        0x0000_0193, # addi  x3, x0, 0
+        0x0030_8023, # sb    x3, 0(x1)
+        0x0000_a203, # lw    x4, 0(x1)
+        0x0041_81b3, # add   x3, x3, x4
+        0x0040_8093, # addi  x1, x1, 4
+        0xfff1_0113, # addi  x2, x2, -1
+        0xfe01_16e3, # bne   x2, x0, 8000000c
+        0x0000_5237, # lui   x4, 0x5
+        0x0032_2023, # sw    x3, 0(x4)
+        0x0002_2283, # lw    x5, 0(x4)
+        0x0230_0333, # mul   x6, x0, x3
+        0x0000_0073, # ecall
+    ]
+
+    for kwargs in [
+        {},
+        {'prefetch_depth': 2},
+        {'pipelined_bus': True},
+        {'mem_latency': 0},
+        {'pipeline': True},
+        {'pipeline': True, 'predictor': BTBPredictor(), 'muldiv': MulDiv()},
+        {'pipeline': True, 'pipelined_bus': True},
+    ]:
+        retired, cycles = cosim(Top(prog, with_rvfi=True, **kwargs),
+                                ISS(prog, with_m='muldiv' in kwargs),
+                                backend=backend)
+        if 'muldiv' not in kwargs:
+            assert(retired == 3 + 6 * 32 + 3)
+        print('ok: %d instructions in %d cycles' % (retired, cycles))
+
+    # A simulator running a different program catches the first difference
+    other = list(prog)
+    other[5] = 0x0041_01b3 # add   x3, x2, x4
+    try:
+        cosim(Top(prog, with_rvfi=True), ISS(other), backend=backend)
+    except ValueError as e:
+        assert('rs1_addr' in str(e))
+        print('ok')
+    else:
+        raise ValueError('expected a divergence')
+
+    # Configurations the simulator can't follow are rejected
+    for kwargs, iss_kwargs, message in [({'with_csr': True}, {}, 'csrs'),
+                                        ({'with_c': True}, {}, 'compressed'),
+                                        ({}, {'with_c': True}, 'compressed')]:
+        try:
+            cosim(Top(prog, with_rvfi=True, **kwargs), ISS(prog, **iss_kwargs), backend=backend)
+        except ValueError as e:
+            assert(message in str(e))
+        else:
+            raise ValueError('expected %s to be rejected' % (kwargs or iss_kwargs))
+
+if __name__ == '__main__':
+    test_cosim()
@@ -0,0 +1,168 @@
+from nmigen import *
+from nmigen.sim import *
+from .trace import trace
+
+
+class CsrFunct3:
+    CSRRW  = 0b001
+    CSRRS  = 0b010
+    CSRRC  = 0b011
+    CSRRWI = 0b101
+    CSRRSI = 0b110
+    CSRRCI = 0b111
+
+
+class CsrAddr:
+    MCYCLE        = 0xb00
+    MINSTRET      = 0xb02
+    MHPMCOUNTER3  = 0xb03
+    MCYCLEH       = 0xb80
+    MINSTRETH     = 0xb82
+    MHPMCOUNTER3H = 0xb83
+    CYCLE         = 0xc00
+    INSTRET       = 0xc02
+    HPMCOUNTER3   = 0xc03
+    CYCLEH        = 0xc80
+    INSTRETH      = 0xc82
+    HPMCOUNTER3H  = 0xc83
+
+
+# Events counted by mhpmcounter3 and up
+class Event:
+    FETCH_STALL  = 0
+    MEM_STALL    = 1
+    BRANCH_TAKEN = 2
+    TRAP         = 3
+
+    COUNT        = 4
+
+
+class CSRFile(Elaboratable):
+    def __init__(self):
+        self.funct3 = Signal(3)
+        self.addr = Signal(12)
+        # rs1 is the register index or the immediate, in1 the register value
+        self.rs1 = Signal(5)
+        self.in1 = Signal(32)
+        self.out = Signal(32)
+        self.illegal = Signal()
+
+        # en commits the access of the instruction that leaves execute
+        self.en = Signal()
+        self.retire = Signal()
+        self.events = Signal(Event.COUNT)
+
+        self.cycle = Signal(64)
+        self.instret = Signal(64)
+        self.hpmcounters = [Signal(64, name='hpmcounter%d' % (3 + i))
+                            for i in range(Event.COUNT)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Counter n lives at 0xb00 + n, its upper half at 0xb80 + n and the
+        # read-only user copies at 0xc00 + n and 0xc80 + n. There is no time
+        # counter and mhpmcounters past the implemented ones read as zero.
+        counters = [self.cycle, None, self.instret] + self.hpmcounters
+        index = self.addr[:5]
+        high = self.addr[7]
+        read_only = self.addr[10:12] == 0b11
+
+        mapped = Signal()
+        with m.Switch(Cat(self.addr[5:7], self.addr[8:12])):
+            with m.Case('1011' '00', '1100' '00'):
+                m.d.comb += mapped.eq(index != 1)
+
+        old = Signal(32)
+        with m.Switch(index):
+            for i, counter in enumerate(counters):
+                if counter is not None:
+                    with m.Case(i):
+                        m.d.comb += old.eq(Mux(high, counter[32:], counter[:32]))
+
+        # csrrs and csrrc with x0 or a zero immediate only read
+        src = Signal(32)
+        write = Signal()
+        data = Signal(32)
+        m.d.comb += [
+            src.eq(Mux(self.funct3[2], self.rs1, self.in1)),
+            write.eq((self.funct3[:2] == 0b01) | (self.rs1 != 0)),
+            self.out.eq(old),
+            self.illegal.eq(~mapped | (write & read_only)),
+        ]
+        with m.Switch(self.funct3[:2]):
+            with m.Case(0b01):
+                m.d.comb += data.eq(src)
+            with m.Case(0b10):
+                m.d.comb += data.eq(old | src)
+            with m.Case(0b11):
+                m.d.comb += data.eq(old & ~src)
+
+        increments = [1, 0, self.retire] + [self.events[i] for i in range(Event.COUNT)]
+        for i, (counter, inc) in enumerate(zip(counters, increments)):
+            if counter is None:
+                continue
+            with m.If(self.en & write & ~self.illegal & (index == i)):
+                with m.If(high):
+                    m.d.sync += counter[32:].eq(data)
+                with m.Else():
+                    m.d.sync += counter[:32].eq(data)
+            with m.Elif(inc):
+                m.d.sync += counter.eq(counter + 1)
+
+        return m
+
+
+def test_csr(accesses):
+    dut = CSRFile()
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+
+    def proc():
+        for funct3, addr, rs1, in1, expected in accesses:
+            yield dut.funct3.eq(funct3)
+            yield dut.addr.eq(addr)
+            yield dut.rs1.eq(rs1)
+            yield dut.in1.eq(in1)
+            yield dut.en.eq(1)
+            yield dut.retire.eq(1)
+            yield dut.events.eq(1 << Event.BRANCH_TAKEN)
+            yield Settle()
+            if expected is None:
+                assert((yield dut.illegal))
+            else:
+                assert(not (yield dut.illegal))
+                out = yield dut.out
+                if out != expected:
+                    raise ValueError('expected %s but got %s' % (hex(expected), hex(out)))
+            yield Tick()
+
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    with trace(sim, fragment, 'csr'):
+        sim.run()
+
+def test():
+    test_csr([
+        # mcycle counts every cycle and a write takes precedence
+        (CsrFunct3.CSRRS,  CsrAddr.MCYCLE,   0, 0, 1),
+        (CsrFunct3.CSRRS,  CsrAddr.CYCLE,    0, 0, 2),
+        (CsrFunct3.CSRRW,  CsrAddr.MCYCLE,   1, 0xffff_fffe, 3),
+        (CsrFunct3.CSRRS,  CsrAddr.MCYCLE,   0, 0, 0xffff_fffe),
+        (CsrFunct3.CSRRS,  CsrAddr.MCYCLEH,  0, 0, 0),
+        (CsrFunct3.CSRRSI, CsrAddr.CYCLEH,   0, 0, 1),
+        # minstret and the taken branch counter increment every cycle here
+        (CsrFunct3.CSRRCI, CsrAddr.MINSTRET, 0b11, 0, 6),
+        (CsrFunct3.CSRRS,  CsrAddr.INSTRET,  0, 0, 4),
+        (CsrFunct3.CSRRS,  CsrAddr.HPMCOUNTER3 + Event.BRANCH_TAKEN, 0, 0, 8),
+        (CsrFunct3.CSRRS,  CsrAddr.HPMCOUNTER3 + Event.TRAP, 0, 0, 0),
+        (CsrFunct3.CSRRS,  CsrAddr.MHPMCOUNTER3 + 20, 0, 0, 0),
+        # read-only and unimplemented csrs trap
+        (CsrFunct3.CSRRW,  CsrAddr.CYCLE,    1, 0, None),
+        (CsrFunct3.CSRRS,  CsrAddr.CYCLE + 1, 0, 0, None),
+        (CsrFunct3.CSRRS,  0x300,            0, 0, None),
+    ])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
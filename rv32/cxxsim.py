@@ -0,0 +1,199 @@
+import ctypes
+import hashlib
+import os
+import subprocess
+from nmigen import *
+from nmigen.back import cxxrtl
+
+# A thin C interface over the cxxrtl C api. Objects are looked up by name,
+# so it doesn't depend on the layout of cxxrtl_object, and whole runs of
+# clock cycles stay on the C++ side.
+DRIVER = """
+#define CXXRTL_INCLUDE_CAPI_IMPL
+#include "top.cc"
+
+static cxxrtl_object *lookup(cxxrtl_handle handle, const char *name) {
+    return name ? cxxrtl_get(handle, name) : nullptr;
+}
+
+static void clock(cxxrtl_handle handle, cxxrtl_object *clk) {
+    clk->next[0] = 0;
+    cxxrtl_step(handle);
+    clk->next[0] = 1;
+    cxxrtl_step(handle);
+}
+
+extern "C" {
+
+void *sim_create() {
+    cxxrtl_handle handle = cxxrtl_create(cxxrtl_design_create());
+    cxxrtl_step(handle);
+    return handle;
+}
+
+void sim_destroy(void *handle) {
+    cxxrtl_destroy((cxxrtl_handle)handle);
+}
+
+int sim_width(void *handle, const char *name) {
+    cxxrtl_object *object = lookup((cxxrtl_handle)handle, name);
+    return object ? object->width : -1;
+}
+
+void sim_get(void *handle, const char *name, uint32_t *value) {
+    cxxrtl_object *object = lookup((cxxrtl_handle)handle, name);
+    for (size_t i = 0; i < (object->width + 31) / 32; i++)
+        value[i] = object->curr[i];
+}
+
+void sim_set(void *handle, const char *name, const uint32_t *value) {
+    cxxrtl_object *object = lookup((cxxrtl_handle)handle, name);
+    for (size_t i = 0; i < (object->width + 31) / 32; i++)
+        object->next[i] = value[i];
+    cxxrtl_step((cxxrtl_handle)handle);
+}
+
+// Runs up to cycles clock cycles and returns how many ran. count is bumped
+// on every cycle the signal named by count_name is high ahead of the edge,
+// and the run stops early once stop_name goes high.
+uint64_t sim_run(void *handle, uint64_t cycles, const char *count_name, uint64_t *count,
+                 const char *stop_name) {
+    cxxrtl_object *clk = lookup((cxxrtl_handle)handle, "clk");
+    cxxrtl_object *counted = lookup((cxxrtl_handle)handle, count_name);
+    cxxrtl_object *stop = lookup((cxxrtl_handle)handle, stop_name);
+    uint64_t cycle;
+    for (cycle = 0; cycle < cycles; cycle++) {
+        if (stop && stop->curr[0])
+            break;
+        if (counted && counted->curr[0])
+            (*count)++;
+        clock((cxxrtl_handle)handle, clk);
+    }
+    return cycle;
+}
+
+}
+"""
+
+
+def yosys_include_dir():
+    datdir = subprocess.check_output(["yosys-config", "--datdir"]).decode().strip()
+    return os.path.join(datdir, "include")
+
+
+def write_atomic(path, text):
+    with open(path + '.%d' % os.getpid(), 'w') as f:
+        f.write(text)
+    os.replace(path + '.%d' % os.getpid(), path)
+
+
+def build_library(source, build_dir='build/cxxsim'):
+    # dlopen hands back the library already loaded from a path, so every
+    # design is built in a directory of its own named after its source. A
+    # design that was built before is reused, and test workers running in
+    # parallel only ever replace a file with an identical one.
+    digest = hashlib.sha256((source + DRIVER).encode()).hexdigest()
+    directory = os.path.join(build_dir, digest)
+    library = os.path.join(directory, 'top.so')
+    if os.path.exists(library):
+        return library
+    os.makedirs(directory, exist_ok=True)
+    write_atomic(os.path.join(directory, 'top.cc'), source)
+    write_atomic(os.path.join(directory, 'driver.cc'), DRIVER)
+    partial = library + '.%d' % os.getpid()
+    subprocess.check_call(["c++", "-std=c++14", "-O2", "-shared", "-fPIC",
+                           "-I", yosys_include_dir(), "-I", directory,
+                           os.path.join(directory, 'driver.cc'), "-o", partial])
+    os.replace(partial, library)
+    return library
+
+
+class CxxSimulator:
+    def __init__(self, top, ports=(), build_dir='build/cxxsim'):
+        # Signals that aren't ports may be optimized away by cxxrtl, the ones
+        # a testbench needs to see are passed in ports.
+        fragment = Fragment.get(top, None).prepare(ports=list(ports))
+        source, self.name_map = cxxrtl.convert_fragment(fragment, name="top")
+        self.library = build_library(source, build_dir)
+
+        self.lib = ctypes.CDLL(os.path.abspath(self.library))
+        self.lib.sim_create.restype = ctypes.c_void_p
+        self.lib.sim_destroy.argtypes = [ctypes.c_void_p]
+        self.lib.sim_width.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        self.lib.sim_get.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p]
+        self.lib.sim_set.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p]
+        self.lib.sim_run.restype = ctypes.c_uint64
+        self.lib.sim_run.argtypes = [ctypes.c_void_p, ctypes.c_uint64, ctypes.c_char_p,
+                                     ctypes.POINTER(ctypes.c_uint64), ctypes.c_char_p]
+        self.handle = ctypes.c_void_p(self.lib.sim_create())
+        self.names = {}
+
+    def __del__(self):
+        if hasattr(self, 'handle'):
+            self.lib.sim_destroy(self.handle)
+
+    def lookup(self, signal):
+        # cxxrtl names are the rtlil hierarchy below top, separated by spaces
+        name = self.names.get(signal)
+        if name is None:
+            if signal not in self.name_map:
+                raise ValueError('%s is not part of the design' % signal.name)
+            name = ' '.join(self.name_map[signal][1:]).encode()
+            if self.lib.sim_width(self.handle, name) < 0:
+                raise ValueError('%s was optimized away, pass it in ports' % signal.name)
+            self.names[signal] = name
+        return name
+
+    def get(self, signal):
+        words = (ctypes.c_uint32 * ((len(signal) + 31) // 32))()
+        self.lib.sim_get(self.handle, self.lookup(signal), words)
+        value = 0
+        for i, word in enumerate(words):
+            value |= word << (32 * i)
+        return value
+
+    def set(self, signal, value):
+        words = (ctypes.c_uint32 * ((len(signal) + 31) // 32))()
+        for i in range(len(words)):
+            words[i] = value >> (32 * i) & 0xffff_ffff
+        self.lib.sim_set(self.handle, self.lookup(signal), words)
+
+    def run(self, cycles, count=None, stop=None):
+        # Returns the cycles that ran and how often count was high
+        counted = ctypes.c_uint64(0)
+        ran = self.lib.sim_run(self.handle, cycles,
+                               self.lookup(count) if count is not None else None,
+                               ctypes.byref(counted),
+                               self.lookup(stop) if stop is not None else None)
+        return ran, counted.value
+
+    def tick(self):
+        self.run(1)
+
+
+def test():
+    # Two designs in one process each run their own library, and building
+    # the first again reuses it
+    class Adder(Elaboratable):
+        def __init__(self, k):
+            self.k = k
+            self.a = Signal(8)
+            self.out = Signal(8)
+
+        def elaborate(self, platform):
+            m = Module()
+            m.d.comb += self.out.eq(self.a + self.k)
+            return m
+
+    libraries = []
+    for k in [1, 2, 1]:
+        dut = Adder(k)
+        sim = CxxSimulator(dut, ports=[dut.a, dut.out])
+        sim.set(dut.a, 5)
+        assert(sim.get(dut.out) == 5 + k)
+        libraries.append(sim.library)
+    assert(libraries[0] != libraries[1] and libraries[0] == libraries[2])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
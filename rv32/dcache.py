@@ -0,0 +1,372 @@
+from math import ceil, log2
+from nmigen import *
+from nmigen.hdl.rec import *
+from nmigen.sim import *
+from .icache import Cti
+from .layouts import wishbone_layout
+from .trace import trace
+
+
+class DCache(Elaboratable):
+    def __init__(self, line_words=4, lines=16, write_back=False, uncached=()):
+        if line_words & (line_words - 1) or lines & (lines - 1):
+            raise ValueError('line size and number of lines must be powers of 2')
+        self.line_words = line_words
+        self.lines = lines
+        self.write_back = write_back
+        # (base, size) byte address windows that go straight to the bus
+        self.uncached = uncached
+
+        # Slave port towards the core and master port towards the bus
+        self.cpu = Record(wishbone_layout)
+        self.mem = Record(wishbone_layout)
+
+        # Write back dirty lines and invalidate everything / only invalidate.
+        # The cores flush on a fence, invalidate drops dirty lines and is
+        # left to whatever knows another master wrote the ram.
+        self.flush = Signal()
+        self.invalidate = Signal()
+        self.busy = Signal()
+
+        self.hits = Signal(32)
+        self.misses = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        offset_bits = ceil(log2(self.line_words))
+        index_bits = ceil(log2(self.lines))
+        tag_bits = 30 - offset_bits - index_bits
+
+        offset = self.cpu.adr[:offset_bits]
+        cpu_index = self.cpu.adr[offset_bits:offset_bits + index_bits]
+        cpu_tag = self.cpu.adr[offset_bits + index_bits:]
+
+        # Tag memory holds the valid and dirty bits and the tag
+        tags = Memory(width = 2 + tag_bits, depth = self.lines)
+        data = Memory(width = 32, depth = self.lines * self.line_words)
+        tr = m.submodules.tag_r = tags.read_port()
+        tw = m.submodules.tag_w = tags.write_port()
+        dr = m.submodules.data_r = data.read_port()
+        dw = m.submodules.data_w = data.write_port(granularity = 8)
+
+        index = Signal(index_bits)
+        flush_index = Signal(index_bits)
+        flushing = Signal()
+        m.d.comb += [
+            index.eq(Mux(flushing, flush_index, cpu_index)),
+            tr.addr.eq(index),
+            dr.addr.eq(Cat(offset, index)),
+        ]
+
+        line_valid = Signal()
+        line_dirty = Signal()
+        line_tag = Signal(tag_bits)
+        hit = Signal()
+        m.d.comb += [
+            line_valid.eq(tr.data[0]),
+            line_dirty.eq(tr.data[1]),
+            line_tag.eq(tr.data[2:]),
+            hit.eq(line_valid & (line_tag == cpu_tag)),
+        ]
+
+        uncached = Signal()
+        address = Cat(Const(0, 2), self.cpu.adr)
+        m.d.comb += uncached.eq(Cat(*[(address >= base) & (address < base + size)
+                                      for base, size in self.uncached]).any())
+
+        # The memories read synchronously, so a lookup is valid once the
+        # address has been held for a cycle.
+        pending = Signal()
+        lookup = Signal()
+        m.d.comb += lookup.eq(pending & self.cpu.cyc & self.cpu.stb)
+
+        flush_req = Signal()
+        invalidate_req = Signal()
+        with m.If(self.flush):
+            m.d.sync += flush_req.eq(1)
+        with m.If(self.invalidate):
+            m.d.sync += invalidate_req.eq(1)
+        m.d.comb += self.busy.eq(flush_req | invalidate_req | flushing)
+
+        write_hit = Signal()
+        beat = Signal(max(offset_bits, 1))
+        last = Signal()
+        m.d.comb += last.eq(beat == self.line_words - 1)
+
+        with m.FSM():
+            with m.State('LOOKUP'):
+                m.d.sync += pending.eq(self.cpu.cyc & self.cpu.stb & ~self.cpu.ack)
+                with m.If((flush_req | invalidate_req) & ~lookup):
+                    m.next = 'FLUSH_READ'
+                    m.d.sync += [
+                        flushing.eq(1),
+                        flush_index.eq(0),
+                    ]
+                with m.Elif(lookup & uncached):
+                    m.next = 'BYPASS'
+                with m.Elif(lookup & hit & ~self.cpu.we):
+                    m.d.comb += [
+                        self.cpu.ack.eq(1),
+                        self.cpu.dat_r.eq(dr.data),
+                    ]
+                    m.d.sync += self.hits.eq(self.hits + 1)
+                with m.Elif(lookup & self.cpu.we & (hit if self.write_back else 1)):
+                    if self.write_back:
+                        m.d.comb += [
+                            self.cpu.ack.eq(1),
+                            dw.addr.eq(Cat(offset, index)),
+                            dw.data.eq(self.cpu.dat_w),
+                            dw.en.eq(self.cpu.sel),
+                            tw.addr.eq(index),
+                            tw.data.eq(Cat(1, 1, line_tag)),
+                            tw.en.eq(1),
+                        ]
+                        m.d.sync += self.hits.eq(self.hits + 1)
+                    else:
+                        # Write through, without allocating on a miss
+                        m.next = 'WRITE'
+                        m.d.sync += write_hit.eq(hit)
+                        with m.If(hit):
+                            m.d.sync += self.hits.eq(self.hits + 1)
+                        with m.Else():
+                            m.d.sync += self.misses.eq(self.misses + 1)
+                with m.Elif(lookup):
+                    m.d.sync += [
+                        self.misses.eq(self.misses + 1),
+                        beat.eq(0),
+                    ]
+                    if self.write_back:
+                        with m.If(line_valid & line_dirty):
+                            m.next = 'WRITEBACK_READ'
+                        with m.Else():
+                            m.next = 'REFILL'
+                    else:
+                        m.next = 'REFILL'
+
+            with m.State('BYPASS'):
+                m.d.comb += [
+                    self.mem.cyc.eq(1),
+                    self.mem.stb.eq(1),
+                    self.mem.adr.eq(self.cpu.adr),
+                    self.mem.we.eq(self.cpu.we),
+                    self.mem.sel.eq(self.cpu.sel),
+                    self.mem.dat_w.eq(self.cpu.dat_w),
+                    self.cpu.ack.eq(self.mem.ack),
+                    self.cpu.dat_r.eq(self.mem.dat_r),
+                ]
+                with m.If(self.mem.ack):
+                    m.next = 'LOOKUP'
+                    m.d.sync += pending.eq(0)
+
+            with m.State('WRITE'):
+                m.d.comb += [
+                    self.mem.cyc.eq(1),
+                    self.mem.stb.eq(1),
+                    self.mem.adr.eq(self.cpu.adr),
+                    self.mem.we.eq(1),
+                    self.mem.sel.eq(self.cpu.sel),
+                    self.mem.dat_w.eq(self.cpu.dat_w),
+                    self.cpu.ack.eq(self.mem.ack),
+                ]
+                with m.If(self.mem.ack):
+                    m.next = 'LOOKUP'
+                    m.d.sync += pending.eq(0)
+                    with m.If(write_hit):
+                        m.d.comb += [
+                            dw.addr.eq(Cat(offset, index)),
+                            dw.data.eq(self.cpu.dat_w),
+                            dw.en.eq(self.cpu.sel),
+                        ]
+
+            with m.State('REFILL'):
+                m.d.comb += [
+                    self.mem.cyc.eq(1),
+                    self.mem.stb.eq(1),
+                    self.mem.adr.eq(Cat(beat[:offset_bits], index, cpu_tag)),
+                    self.mem.sel.eq(0b1111),
+                    self.mem.cti.eq(Mux(last, Cti.END_BURST, Cti.INCR_BURST)),
+                ]
+                with m.If(self.mem.ack):
+                    m.d.sync += beat.eq(beat + 1)
+                    m.d.comb += [
+                        dw.addr.eq(Cat(beat[:offset_bits], index)),
+                        dw.data.eq(self.mem.dat_r),
+                        dw.en.eq(0b1111),
+                    ]
+                    with m.If(last):
+                        m.next = 'LOOKUP'
+                        m.d.sync += pending.eq(0)
+                        m.d.comb += [
+                            tw.addr.eq(index),
+                            tw.data.eq(Cat(1, 0, cpu_tag)),
+                            tw.en.eq(1),
+                        ]
+
+            # The data memory output lags its address by a cycle, so the first
+            # word is read before the burst starts and every ack reads ahead.
+            with m.State('WRITEBACK_READ'):
+                m.next = 'WRITEBACK'
+                m.d.comb += dr.addr.eq(Cat(Const(0, offset_bits), index))
+
+            with m.State('WRITEBACK'):
+                m.d.comb += [
+                    self.mem.cyc.eq(1),
+                    self.mem.stb.eq(1),
+                    self.mem.adr.eq(Cat(beat[:offset_bits], index, line_tag)),
+                    self.mem.we.eq(1),
+                    self.mem.sel.eq(0b1111),
+                    self.mem.dat_w.eq(dr.data),
+                    self.mem.cti.eq(Mux(last, Cti.END_BURST, Cti.INCR_BURST)),
+                    dr.addr.eq(Cat(beat[:offset_bits], index)),
+                ]
+                with m.If(self.mem.ack):
+                    m.d.sync += beat.eq(beat + 1)
+                    m.d.comb += dr.addr.eq(Cat((beat + 1)[:offset_bits], index))
+                    with m.If(last):
+                        m.d.sync += beat.eq(0)
+                        with m.If(flushing):
+                            m.next = 'FLUSH_CHECK'
+                        with m.Else():
+                            m.next = 'REFILL'
+
+            with m.State('FLUSH_READ'):
+                m.next = 'FLUSH_CHECK'
+
+            with m.State('FLUSH_CHECK'):
+                if self.write_back:
+                    dirty = flush_req & line_valid & line_dirty
+                else:
+                    dirty = 0
+                with m.If(dirty):
+                    m.next = 'WRITEBACK_READ'
+                    m.d.sync += beat.eq(0)
+                    # Drop the dirty bit so the line is invalidated next time
+                    m.d.comb += [
+                        tw.addr.eq(index),
+                        tw.data.eq(Cat(line_valid, 0, line_tag)),
+                        tw.en.eq(1),
+                    ]
+                with m.Else():
+                    m.d.comb += [
+                        tw.addr.eq(index),
+                        tw.data.eq(0),
+                        tw.en.eq(1),
+                    ]
+                    m.d.sync += flush_index.eq(flush_index + 1)
+                    with m.If(flush_index == self.lines - 1):
+                        m.next = 'LOOKUP'
+                        m.d.sync += [
+                            flushing.eq(0),
+                            flush_req.eq(0),
+                            invalidate_req.eq(0),
+                            pending.eq(0),
+                        ]
+                    with m.Else():
+                        m.next = 'FLUSH_READ'
+
+        return m
+
+
+def test_dcache(dut, accesses, memory):
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    bus = []
+
+    def mem():
+        yield Passive()
+        ack = 0
+        while True:
+            yield Settle()
+            stb = yield dut.mem.stb
+            adr = yield dut.mem.adr
+            if stb and not ack:
+                if (yield dut.mem.we):
+                    sel = yield dut.mem.sel
+                    dat_w = yield dut.mem.dat_w
+                    mask = sum(0xff << (8 * i) for i in range(4) if sel & (1 << i))
+                    memory[adr] = memory.get(adr, 0) & ~mask | dat_w & mask
+                    bus.append(('w', adr))
+                else:
+                    bus.append(('r', adr))
+            yield Tick()
+            ack = stb and not ack
+            yield dut.mem.ack.eq(ack)
+            yield dut.mem.dat_r.eq(memory.get(adr, 0))
+
+    def proc():
+        for access in accesses:
+            if access == 'flush':
+                yield dut.flush.eq(1)
+                yield Tick()
+                yield dut.flush.eq(0)
+                yield Tick()
+                while (yield dut.busy):
+                    yield Tick()
+                continue
+            we, adr, sel, value = access
+            yield dut.cpu.cyc.eq(1)
+            yield dut.cpu.stb.eq(1)
+            yield dut.cpu.we.eq(we)
+            yield dut.cpu.adr.eq(adr)
+            yield dut.cpu.sel.eq(sel)
+            yield dut.cpu.dat_w.eq(value)
+            yield Tick()
+            yield Settle()
+            while not (yield dut.cpu.ack):
+                yield Tick()
+                yield Settle()
+            data = yield dut.cpu.dat_r
+            if not we and data != value:
+                raise ValueError('expected %s but got %s' % (value, data))
+            # Hits ack combinationally, so hold the request over the edge
+            yield Tick()
+            yield dut.cpu.stb.eq(0)
+
+    sim.add_clock(1e-6)
+    sim.add_process(mem)
+    sim.add_sync_process(proc)
+    with trace(sim, fragment, 'dcache'):
+        sim.run()
+    return bus
+
+def test():
+    accesses = [
+        (0, 0x00, 0b1111, 0x00000000),
+        (1, 0x00, 0b0010, 0x0000ab00),
+        (0, 0x00, 0b1111, 0x0000ab00),
+        (1, 0x01, 0b1111, 0xdeadbeef),
+        (0, 0x01, 0b1111, 0xdeadbeef),
+        (0, 0x10, 0b1111, 0x00000000),
+        (0, 0x00, 0b1111, 0x0000ab00),
+        (1, 0x1400, 0b1111, 0x12345678),
+        (0, 0x1400, 0b1111, 0x12345678),
+    ]
+    uncached = [(0x5000, 0x1000)]
+
+    memory = {}
+    bus = test_dcache(DCache(lines=4, uncached=uncached), accesses, memory)
+    assert(memory == {0x00: 0x0000ab00, 0x01: 0xdeadbeef, 0x1400: 0x12345678})
+    assert(bus.count(('r', 0x1400)) == 1)
+
+    # Stores stay in the cache until the line is written back
+    memory = {}
+    accesses = [
+        (1, 0x00, 0b0010, 0x0000ab00),
+        (1, 0x01, 0b1111, 0xdeadbeef),
+        (0, 0x00, 0b1111, 0x0000ab00),
+        (0, 0x10, 0b1111, 0x00000000),
+        (1, 0x11, 0b1100, 0x12340000),
+        'flush',
+    ]
+    bus = test_dcache(DCache(lines=4, write_back=True), accesses, memory)
+    assert(bus[:4] == [('r', 0x00), ('r', 0x01), ('r', 0x02), ('r', 0x03)])
+    assert(bus[4:8] == [('w', 0x00), ('w', 0x01), ('w', 0x02), ('w', 0x03)])
+    assert(bus[-4:] == [('w', 0x10), ('w', 0x11), ('w', 0x12), ('w', 0x13)])
+    assert(memory[0x00] == 0x0000ab00)
+    assert(memory[0x01] == 0xdeadbeef)
+    assert(memory[0x11] == 0x12340000)
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -1,17 +1,20 @@
 from nmigen import *
 from nmigen.sim import *
+from .trace import trace
 
 
 class Opcode:
-    LUI    = 0b0110111
-    AUIPC  = 0b0010111
-    JAL    = 0b1101111
-    JALR   = 0b1100111
-    BRANCH = 0b1100011
-    LOAD   = 0b0000011
-    STORE  = 0b0100011
-    IMM    = 0b0010011
-    REG    = 0b0110011
+    LUI      = 0b0110111
+    AUIPC    = 0b0010111
+    JAL      = 0b1101111
+    JALR     = 0b1100111
+    BRANCH   = 0b1100011
+    LOAD     = 0b0000011
+    STORE    = 0b0100011
+    IMM      = 0b0010011
+    REG      = 0b0110011
+    MISC_MEM = 0b0001111
+    SYSTEM   = 0b1110011
 
 class PcOp:
     NEXT   = 0b00
@@ -20,7 +23,9 @@ class PcOp:
     JALR   = 0b11
 
 class Decoder(Elaboratable):
-    def __init__(self):
+    def __init__(self, with_m=False, with_csr=False):
+        self.with_m = with_m
+        self.with_csr = with_csr
         self.inst = Signal(32)
 
         self.rs1 = Signal(5)
@@ -35,6 +40,9 @@ class Decoder(Elaboratable):
         self.pc_op = Signal(2)
         self.mem_op_en = Signal()
         self.mem_op_store = Signal()
+        self.muldiv_op_en = Signal()
+        self.csr_op_en = Signal()
+        self.fence_op_en = Signal()
         self.funct3 = Signal(3)
         self.funct1 = Signal()
 
@@ -67,6 +75,7 @@ class Decoder(Elaboratable):
 
         funct1 = Signal()
         funct1_valid = Signal()
+        muldiv = Signal()
         m.d.comb += [
             self.pc_op.eq(PcOp.NEXT),
             self.rs1.eq(Mux(self.rs1_en, rs1, 0)),
@@ -86,6 +95,12 @@ class Decoder(Elaboratable):
                     funct1.eq(0),
                     funct1_valid.eq(1),
                 ]
+            with m.Case('0000001'):
+                m.d.comb += [
+                    funct1.eq(0),
+                    funct1_valid.eq(0),
+                    muldiv.eq(self.with_m),
+                ]
             with m.Default():
                 m.d.comb += [
                     funct1.eq(0),
@@ -183,7 +198,7 @@ class Decoder(Elaboratable):
                     self.rd_en.eq(1),
                 ]
             with m.Case(Opcode.REG):
-                with m.If(~funct1_valid):
+                with m.If(~funct1_valid & ~muldiv):
                     m.d.comb += self.trap.eq(1)
                 m.d.comb += [
                     self.rs1_en.eq(1),
@@ -191,30 +206,61 @@ class Decoder(Elaboratable):
                     self.rd_en.eq(1),
                     self.imm.eq(0),
                     self.funct1.eq(funct1),
+                    self.muldiv_op_en.eq(muldiv),
                 ]
+            with m.Case(Opcode.MISC_MEM):
+                # fence waits for the data cache to write back and drop its
+                # lines, fence.i isn't supported
+                with m.If(funct3 != 0):
+                    m.d.comb += self.trap.eq(1)
+                m.d.comb += [
+                    self.rs1_en.eq(0),
+                    self.rs2_en.eq(0),
+                    self.rd_en.eq(0),
+                    self.imm.eq(0),
+                    self.fence_op_en.eq(1),
+                ]
+            if self.with_csr:
+                with m.Case(Opcode.SYSTEM):
+                    # The csr address is in imm[:12], immediate forms take
+                    # their operand from the rs1 field.
+                    with m.Switch(funct3):
+                        with m.Case('-00'):
+                            m.d.comb += self.trap.eq(1)
+                    m.d.comb += [
+                        self.rs1_en.eq(~funct3[2]),
+                        self.rs2_en.eq(0),
+                        self.rd_en.eq(1),
+                        self.imm.eq(imm_i),
+                        self.csr_op_en.eq(1),
+                    ]
             with m.Default():
                 m.d.comb += self.trap.eq(1)
 
         return m
 
 
-def test_decoder(inst, funct4):
-    dut = Decoder()
-    sim = Simulator(dut)
+def test_decoder(inst, funct4, with_m=False, muldiv=False, with_csr=False, csr=False, fence=False):
+    dut = Decoder(with_m, with_csr)
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
 
-    with sim.write_vcd('vcd/decoder.vcd'):
-        def proc():
-            yield dut.inst.eq(inst)
-            yield Settle()
-            assert(yield ~dut.trap)
-            out = yield Cat(dut.funct1, dut.funct3)
-            if out != funct4:
-                raise ValueError('expected %s but got %s' % (funct4, out))
+    def proc():
+        yield dut.inst.eq(inst)
+        yield Settle()
+        assert(yield ~dut.trap)
+        out = yield Cat(dut.funct1, dut.funct3)
+        if out != funct4:
+            raise ValueError('expected %s but got %s' % (funct4, out))
+        assert((yield dut.muldiv_op_en) == muldiv)
+        assert((yield dut.csr_op_en) == csr)
+        assert((yield dut.fence_op_en) == fence)
 
     sim.add_process(proc)
-    sim.run()
+    with trace(sim, fragment, 'decoder'):
+        sim.run()
 
-if __name__ == '__main__':
+def test():
     from .alu import Funct4
     inst = 0b000000000001_00000_000_00001_0010011 # addi x1, x0, 1
     test_decoder(inst, Funct4.ADD)
@@ -222,3 +268,15 @@ if __name__ == '__main__':
     inst = 0b000000000000_00000_111_00001_0110011 # and x1, x0, x0
     test_decoder(inst, Funct4.AND)
     print('ok')
+    inst = 0b0000001_00010_00001_100_00011_0110011 # div x3, x1, x2
+    test_decoder(inst, 0b1000, with_m=True, muldiv=True)
+    print('ok')
+    inst = 0b101100000000_00000_010_00001_1110011 # csrr x1, mcycle
+    test_decoder(inst, 0b0100, with_csr=True, csr=True)
+    print('ok')
+    inst = 0b0000_1111_1111_00000_000_00000_0001111 # fence
+    test_decoder(inst, 0b0000, fence=True)
+    print('ok')
+
+if __name__ == '__main__':
+    test()
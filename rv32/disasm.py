@@ -0,0 +1,258 @@
+from .decoder import Opcode
+from .iss import sext
+
+# RV32IM and Zicsr in the syntax of objdump -M no-aliases,numeric. Branch
+# and jump targets are printed relative to the instruction, like .+8, since
+# a listing of retired instructions doesn't know where they were placed.
+
+BRANCHES = {0b000: 'beq', 0b001: 'bne', 0b100: 'blt', 0b101: 'bge', 0b110: 'bltu', 0b111: 'bgeu'}
+
+LOADS = {0b000: 'lb', 0b001: 'lh', 0b010: 'lw', 0b100: 'lbu', 0b101: 'lhu'}
+
+STORES = {0b000: 'sb', 0b001: 'sh', 0b010: 'sw'}
+
+IMM_OPS = {0b000: 'addi', 0b010: 'slti', 0b011: 'sltiu', 0b100: 'xori', 0b110: 'ori', 0b111: 'andi'}
+
+# Keyed by (funct7, funct3), the shifts by an immediate add an i
+OPS = {
+    (0b0000000, 0b000): 'add',
+    (0b0100000, 0b000): 'sub',
+    (0b0000000, 0b001): 'sll',
+    (0b0000000, 0b010): 'slt',
+    (0b0000000, 0b011): 'sltu',
+    (0b0000000, 0b100): 'xor',
+    (0b0000000, 0b101): 'srl',
+    (0b0100000, 0b101): 'sra',
+    (0b0000000, 0b110): 'or',
+    (0b0000000, 0b111): 'and',
+    (0b0000001, 0b000): 'mul',
+    (0b0000001, 0b001): 'mulh',
+    (0b0000001, 0b010): 'mulhsu',
+    (0b0000001, 0b011): 'mulhu',
+    (0b0000001, 0b100): 'div',
+    (0b0000001, 0b101): 'divu',
+    (0b0000001, 0b110): 'rem',
+    (0b0000001, 0b111): 'remu',
+}
+
+CSR_OPS = {0b001: 'csrrw', 0b010: 'csrrs', 0b011: 'csrrc',
+           0b101: 'csrrwi', 0b110: 'csrrsi', 0b111: 'csrrci'}
+
+UNKNOWN = str.maketrans('xXzZ', '0000')
+
+
+def offset(imm):
+    return '.%+d' % imm
+
+
+def disassemble(inst):
+    if inst & 3 != 3:
+        return '.2byte 0x%04x' % (inst & 0xffff)
+    opcode = inst & 0x7f
+    rd = inst >> 7 & 0x1f
+    funct3 = inst >> 12 & 0x7
+    rs1 = inst >> 15 & 0x1f
+    rs2 = inst >> 20 & 0x1f
+    funct7 = inst >> 25
+    imm_i = sext(inst >> 20, 12)
+    imm_s = sext(funct7 << 5 | rd, 12)
+
+    if opcode == Opcode.LUI:
+        return 'lui x%d,0x%x' % (rd, inst >> 12)
+    if opcode == Opcode.AUIPC:
+        return 'auipc x%d,0x%x' % (rd, inst >> 12)
+    if opcode == Opcode.JAL:
+        imm = sext((inst >> 31) << 20 | (inst >> 12 & 0xff) << 12 |
+                   (inst >> 20 & 1) << 11 | (inst >> 21 & 0x3ff) << 1, 21)
+        return 'jal x%d,%s' % (rd, offset(imm))
+    if opcode == Opcode.JALR and funct3 == 0:
+        return 'jalr x%d,%d(x%d)' % (rd, imm_i, rs1)
+    if opcode == Opcode.BRANCH and funct3 in BRANCHES:
+        imm = sext((inst >> 31) << 12 | (inst >> 7 & 1) << 11 |
+                   (inst >> 25 & 0x3f) << 5 | (inst >> 8 & 0xf) << 1, 13)
+        return '%s x%d,x%d,%s' % (BRANCHES[funct3], rs1, rs2, offset(imm))
+    if opcode == Opcode.LOAD and funct3 in LOADS:
+        return '%s x%d,%d(x%d)' % (LOADS[funct3], rd, imm_i, rs1)
+    if opcode == Opcode.STORE and funct3 in STORES:
+        return '%s x%d,%d(x%d)' % (STORES[funct3], rs2, imm_s, rs1)
+    if opcode == Opcode.IMM:
+        if funct3 == 0b001 or funct3 == 0b101:
+            # The M extension has no immediate forms
+            op = OPS.get((funct7, funct3)) if funct7 in (0b0000000, 0b0100000) else None
+            if op is not None:
+                return '%si x%d,x%d,0x%x' % (op, rd, rs1, rs2)
+        else:
+            return '%s x%d,x%d,%d' % (IMM_OPS[funct3], rd, rs1, imm_i)
+    if opcode == Opcode.REG and (funct7, funct3) in OPS:
+        return '%s x%d,x%d,x%d' % (OPS[(funct7, funct3)], rd, rs1, rs2)
+    if opcode == Opcode.MISC_MEM and funct3 == 0:
+        return 'fence'
+    if opcode == Opcode.SYSTEM:
+        if inst == 0x0000_0073:
+            return 'ecall'
+        if inst == 0x0010_0073:
+            return 'ebreak'
+        if funct3 in CSR_OPS:
+            if funct3 & 0b100:
+                return '%s x%d,0x%x,%d' % (CSR_OPS[funct3], rd, inst >> 20, rs1)
+            return '%s x%d,0x%x,x%d' % (CSR_OPS[funct3], rd, inst >> 20, rs1)
+    return '.4byte 0x%08x' % inst
+
+
+def tokens(lines):
+    for line in lines:
+        yield from line.split()
+
+
+def read_vcd(lines, scope, names):
+    # Reads a vcd in a single pass and yields (time, values) at the end of
+    # every time step, values maps the names of the vars in scope that are
+    # traced to their value. Nothing else in the trace is kept. x and z
+    # read as 0.
+    stream = tokens(lines)
+    hierarchy = []
+    ids = {}
+    for token in stream:
+        if token == '$scope':
+            next(stream)
+            hierarchy.append(next(stream))
+        elif token == '$upscope':
+            hierarchy.pop()
+        elif token == '$var':
+            var_type, size, code, name = (next(stream) for _ in range(4))
+            if '.'.join(hierarchy) == scope and name in names:
+                ids.setdefault(code, []).append(name)
+        elif token == '$enddefinitions':
+            break
+    missing = set(names) - {name for found in ids.values() for name in found}
+    if missing:
+        raise ValueError('%s not found in %s' % (', '.join(sorted(missing)), scope))
+
+    values = dict.fromkeys(names, 0)
+    time = None
+    for token in stream:
+        first = token[0]
+        if first == '#':
+            if time is not None:
+                yield time, values
+            time = int(token[1:])
+        elif first in 'bBrR':
+            code = next(stream)
+            if first in 'bB' and code in ids:
+                value = int(token[1:].translate(UNKNOWN), 2)
+                for name in ids[code]:
+                    values[name] = value
+        elif first in '01xXzZ':
+            code = token[1:]
+            if code in ids:
+                for name in ids[code]:
+                    values[name] = int(first == '1')
+        elif token == '$comment':
+            for token in stream:
+                if token == '$end':
+                    break
+    if time is not None:
+        yield time, values
+
+
+def retired(lines, scope='rvfi_testbench.wrapper'):
+    # Returns (order, insn) of the instructions retired in an rvfi trace
+    prog = {}
+    for time, values in read_vcd(lines, scope, ('rvfi_valid', 'rvfi_order', 'rvfi_insn')):
+        if values['rvfi_valid']:
+            prog[values['rvfi_order']] = values['rvfi_insn']
+    return sorted(prog.items())
+
+
+def test():
+    # Against the listings of objdump -M no-aliases,numeric
+    for inst, expected in [
+        (0xdead_c0b7, 'lui x1,0xdeadc'),
+        (0xeef0_8093, 'addi x1,x1,-273'),
+        (0x8000_4197, 'auipc x3,0x80004'),
+        (0xfe11_ac23, 'sw x1,-8(x3)'),
+        (0xff01_2103, 'lw x2,-16(x2)'),
+        (0x0011_0463, 'beq x2,x1,.+8'),
+        (0xfe01_16e3, 'bne x2,x0,.-20'),
+        (0x0100_00ef, 'jal x1,.+16'),
+        (0x0000_8067, 'jalr x0,0(x1)'),
+        (0x0011_4283, 'lbu x5,1(x2)'),
+        (0x0031_00a3, 'sb x3,1(x2)'),
+        (0x4040_d093, 'srai x1,x1,0x4'),
+        (0xfff0_b093, 'sltiu x1,x1,-1'),
+        (0x4020_80b3, 'sub x1,x1,x2'),
+        (0x0230_c3b3, 'div x7,x1,x3'),
+        (0xb020_2173, 'csrrs x2,0xb02,x0'),
+        (0xb002_d0f3, 'csrrwi x1,0xb00,5'),
+        (0x0ff0_000f, 'fence'),
+        (0x0000_0073, 'ecall'),
+        (0x0010_0073, 'ebreak'),
+        (0x0000_8082, '.2byte 0x8082'),
+        (0x0000_0033 | 1 << 26, '.4byte 0x04000033'),
+        (0x0200_9093, '.4byte 0x02009093'),
+        (0x0200_d093, '.4byte 0x0200d093'),
+        (0x4010_9093, '.4byte 0x40109093'),
+    ]:
+        out = disassemble(inst)
+        if out != expected:
+            raise ValueError('%s: expected %s but got %s' % (hex(inst), expected, out))
+
+    # Steps with only a clock edge repeat the last retirement, x reads as 0
+    # and the other scopes and vars aren't kept
+    trace = """
+$timescale 1ns $end
+$scope module rvfi_testbench $end
+$var wire 1 ! clock $end
+$scope module wrapper $end
+$var wire 1 " rvfi_valid $end
+$var wire 64 # rvfi_order $end
+$var wire 32 $ rvfi_insn $end
+$var wire 32 $ rvfi_insn_alias $end
+$upscope $end
+$scope module other $end
+$var wire 1 % rvfi_valid $end
+$upscope $end
+$upscope $end
+$enddefinitions $end
+#0
+$dumpvars
+0!
+0"
+b0 #
+bx $
+1%
+$end
+#5
+1!
+#10
+0!
+1"
+b1 #
+b11111110000000010001011011100011 $
+#15
+1!
+#20
+$comment
+  nothing retires
+$end
+0!
+0"
+#30
+1"
+b10 #
+b1110011 $
+""".splitlines()
+    listing = retired(trace)
+    assert(listing == [(1, 0xfe01_16e3), (2, 0x0000_0073)])
+    assert([disassemble(insn) for order, insn in listing] == ['bne x2,x0,.-20', 'ecall'])
+
+    try:
+        retired(trace, 'rvfi_testbench')
+    except ValueError as e:
+        assert('rvfi_insn' in str(e))
+    else:
+        raise ValueError('expected the vars to be missing')
+    print('ok')
+
+if __name__ == '__main__':
+    test()
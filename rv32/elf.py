@@ -0,0 +1,114 @@
+import struct
+import sys
+from array import array
+from .layouts import ROM_BASE, RAM_BASE, GPIO_BASE
+
+# Loads the PT_LOAD segments of a little endian RV32 executable. Segments
+# linked into the rom window become the rom contents, the ones in the ram
+# window the initial ram contents, and the entry point is the reset
+# address. The file is only copied once, into the images.
+
+EM_RISCV = 0xf3
+PT_LOAD = 1
+
+HEADER = struct.Struct('<16sHHIIIIIHHHHHH')
+PROGRAM_HEADER = struct.Struct('<IIIIIIII')
+
+
+def words(data):
+    # Little endian words, the last one zero padded
+    image = array('I')
+    image.frombytes(data)
+    if len(data) % 4:
+        image.frombytes(bytes(4 - len(data) % 4))
+    if sys.byteorder == 'big':
+        image.byteswap()
+    return image
+
+
+def read_elf(data):
+    # Returns the rom and ram images and the entry point of the elf in data
+    data = memoryview(data)
+    (ident, e_type, machine, version, entry, phoff, shoff, flags, ehsize,
+     phentsize, phnum, shentsize, shnum, shstrndx) = HEADER.unpack_from(data)
+    if ident[:4] != b'\x7fELF':
+        raise ValueError('not an elf file')
+    if ident[4] != 1 or ident[5] != 1 or machine != EM_RISCV:
+        raise ValueError('expected a little endian rv32 elf')
+
+    images = {ROM_BASE: bytearray(), RAM_BASE: bytearray()}
+    for i in range(phnum):
+        (p_type, offset, vaddr, paddr, filesz, memsz, p_flags,
+         align) = PROGRAM_HEADER.unpack_from(data, phoff + i * phentsize)
+        if p_type != PT_LOAD or memsz == 0:
+            continue
+        if paddr >= ROM_BASE:
+            base = ROM_BASE
+        elif RAM_BASE <= paddr and paddr + memsz <= GPIO_BASE:
+            base = RAM_BASE
+        else:
+            raise ValueError('segment at %s is outside of the rom and ram' % hex(paddr))
+        image = images[base]
+        start = paddr - base
+        if len(image) < start + memsz:
+            image.extend(bytes(start + memsz - len(image)))
+        # memsz past filesz is bss and stays zero
+        image[start:start + filesz] = data[offset:offset + filesz]
+    return words(images[ROM_BASE]), words(images[RAM_BASE]), entry
+
+
+def load_elf(path):
+    with open(path, 'rb') as f:
+        return read_elf(f.read())
+
+
+def test():
+    from .core import Top
+    from .cosim import cosim
+    from .iss import ISS
+
+    # The entry point isn't the start of the rom and the loaded word comes
+    # from .data, followed by some .bss
+    text = [
+        0x0000_0073, # ecall
+        0x0000_40b7, # lui   x1, 0x4
+        0x0040_a103, # lw    x2, 4(x1)
+        0x0080_a183, # lw    x3, 8(x1)
+        0x0000_0073, # ecall
+    ]
+    segments = [
+        (ROM_BASE, array('I', text).tobytes(), 4 * len(text)),
+        (RAM_BASE, array('I', [0x1111_1111, 0xdead_beef]).tobytes(), 16),
+    ]
+    headers = b''
+    contents = b''
+    offset = HEADER.size + PROGRAM_HEADER.size * len(segments)
+    for paddr, content, memsz in segments:
+        headers += PROGRAM_HEADER.pack(PT_LOAD, offset + len(contents), paddr, paddr,
+                                       len(content), memsz, 0, 4)
+        contents += content
+    header = HEADER.pack(b'\x7fELF\x01\x01\x01'.ljust(16, b'\0'), 2, EM_RISCV, 1, ROM_BASE + 4,
+                         HEADER.size, 0, 0, HEADER.size, PROGRAM_HEADER.size, len(segments),
+                         0, 0, 0)
+
+    prog, data, entry = read_elf(header + headers + contents)
+    assert(list(prog) == text)
+    assert(list(data) == [0x1111_1111, 0xdead_beef, 0, 0])
+    assert(entry == ROM_BASE + 4)
+
+    iss = ISS(prog, entry, data=data)
+    retired, cycles = cosim(Top(prog, with_rvfi=True, data=data, reset_address=entry), iss,
+                            name='elf')
+    assert(retired == 3)
+    assert(iss.x[2] == 0xdead_beef and iss.x[3] == 0)
+
+    try:
+        read_elf(header[:18] + struct.pack('<H', 0x3e) + header[20:])
+    except ValueError as e:
+        assert('rv32' in str(e))
+    else:
+        raise ValueError('expected a machine mismatch')
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -5,23 +5,32 @@ from nmigen_soc.wishbone import *
 
 
 class Gpio(Elaboratable, Interface):
-    def __init__(self):
-        Interface.__init__(self, data_width = 32, addr_width = 1)
-        self.memory_map = MemoryMap(data_width = 32, addr_width = 1, alignment = 0)
+    def __init__(self, pipelined=False):
+        self.pipelined = pipelined
+        Interface.__init__(self, data_width = 32, granularity = 8, addr_width = 1,
+                           features = {"stall"} if pipelined else frozenset())
+        self.memory_map = MemoryMap(data_width = 8, addr_width = 3, alignment = 0)
+        self.leds = Signal(8)
 
     def elaborate(self, platform):
         m = Module()
-        leds = Signal(8)
         m.d.sync += self.ack.eq(0)
-        m.d.comb += self.dat_r.eq(leds)
-        with m.If(self.cyc):
-            m.d.sync += self.ack.eq(self.stb)
-            with m.If(self.we):
-                m.d.sync += leds.eq(self.dat_w),
+        m.d.comb += self.dat_r.eq(self.leds)
+        if self.pipelined:
+            m.d.comb += self.stall.eq(0)
+            with m.If(self.cyc & self.stb):
+                m.d.sync += self.ack.eq(1)
+                with m.If(self.we):
+                    m.d.sync += self.leds.eq(self.dat_w)
+        else:
+            with m.If(self.cyc):
+                m.d.sync += self.ack.eq(self.stb & ~self.ack)
+                with m.If(self.we):
+                    m.d.sync += self.leds.eq(self.dat_w),
 
         if platform is not None:
             for i in range(8):
                 led = platform.request("led", i)
-                m.d.comb += led.o.eq(leds[i])
+                m.d.comb += led.o.eq(self.leds[i])
 
         return m
@@ -0,0 +1,208 @@
+from math import ceil, log2
+from nmigen import *
+from nmigen.hdl.rec import *
+from nmigen.sim import *
+from .layouts import wishbone_layout
+from .trace import trace
+
+
+class Cti:
+    CLASSIC     = 0b000
+    CONST_BURST = 0b001
+    INCR_BURST  = 0b010
+    END_BURST   = 0b111
+
+
+class ICache(Elaboratable):
+    def __init__(self, line_words=4, lines=32, ways=1):
+        if ways not in (1, 2):
+            raise ValueError('expected 1 or 2 ways but got %s' % ways)
+        if line_words & (line_words - 1) or lines & (lines - 1):
+            raise ValueError('line size and number of lines must be powers of 2')
+        if lines % ways != 0:
+            raise ValueError('%s lines can\'t be split into %s ways' % (lines, ways))
+        self.line_words = line_words
+        self.lines = lines
+        self.ways = ways
+
+        # Slave port towards the core and master port towards the memory
+        self.cpu = Record(wishbone_layout)
+        self.mem = Record(wishbone_layout)
+
+        self.hits = Signal(32)
+        self.misses = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        sets = self.lines // self.ways
+        offset_bits = ceil(log2(self.line_words))
+        index_bits = ceil(log2(sets))
+        tag_bits = 30 - offset_bits - index_bits
+
+        offset = self.cpu.adr[:offset_bits]
+        index = self.cpu.adr[offset_bits:offset_bits + index_bits]
+        tag = self.cpu.adr[offset_bits + index_bits:]
+
+        tag_r = []
+        tag_w = []
+        data_r = []
+        data_w = []
+        hit = []
+        for way in range(self.ways):
+            # Tag memory holds the valid bit and the tag
+            tags = Memory(width = 1 + tag_bits, depth = sets)
+            data = Memory(width = 32, depth = sets * self.line_words)
+            tr = tags.read_port()
+            tw = tags.write_port()
+            dr = data.read_port()
+            dw = data.write_port()
+            m.submodules['tag_r%d' % way] = tr
+            m.submodules['tag_w%d' % way] = tw
+            m.submodules['data_r%d' % way] = dr
+            m.submodules['data_w%d' % way] = dw
+            m.d.comb += [
+                tr.addr.eq(index),
+                dr.addr.eq(Cat(offset, index)),
+            ]
+            tag_r.append(tr)
+            tag_w.append(tw)
+            data_r.append(dr)
+            data_w.append(dw)
+            hit.append(tr.data[0] & (tr.data[1:] == tag))
+
+        # The memories read synchronously, so a lookup is valid once the
+        # address has been held for a cycle.
+        pending = Signal()
+        lookup = Signal()
+        any_hit = Signal()
+        m.d.comb += [
+            lookup.eq(pending & self.cpu.cyc & self.cpu.stb),
+            any_hit.eq(Cat(*hit).any()),
+        ]
+
+        lru = Signal(sets)
+        victim = Signal()
+        if self.ways == 2:
+            with m.If(~tag_r[0].data[0]):
+                m.d.comb += victim.eq(0)
+            with m.Elif(~tag_r[1].data[0]):
+                m.d.comb += victim.eq(1)
+            with m.Else():
+                m.d.comb += victim.eq(lru.bit_select(index, 1))
+        refill_way = Signal()
+
+        beat = Signal(max(offset_bits, 1))
+        last = Signal()
+        m.d.comb += last.eq(beat == self.line_words - 1)
+
+        with m.FSM():
+            with m.State('LOOKUP'):
+                m.d.sync += pending.eq(self.cpu.cyc & self.cpu.stb & ~self.cpu.ack)
+                with m.If(lookup & any_hit):
+                    m.d.comb += self.cpu.ack.eq(1)
+                    m.d.sync += self.hits.eq(self.hits + 1)
+                    for way in range(self.ways):
+                        with m.If(hit[way]):
+                            m.d.comb += self.cpu.dat_r.eq(data_r[way].data)
+                            if self.ways == 2:
+                                m.d.sync += lru.bit_select(index, 1).eq(1 - way)
+                with m.Elif(lookup):
+                    m.next = 'REFILL'
+                    m.d.sync += [
+                        self.misses.eq(self.misses + 1),
+                        refill_way.eq(victim),
+                        beat.eq(0),
+                    ]
+            with m.State('REFILL'):
+                m.d.comb += [
+                    self.mem.cyc.eq(1),
+                    self.mem.stb.eq(1),
+                    self.mem.adr.eq(Cat(beat[:offset_bits], index, tag)),
+                    self.mem.sel.eq(0b1111),
+                    self.mem.cti.eq(Mux(last, Cti.END_BURST, Cti.INCR_BURST)),
+                    self.mem.bte.eq(0),
+                ]
+                with m.If(self.mem.ack):
+                    m.d.sync += beat.eq(beat + 1)
+                    for way in range(self.ways):
+                        with m.If(refill_way == way):
+                            m.d.comb += [
+                                data_w[way].addr.eq(Cat(beat[:offset_bits], index)),
+                                data_w[way].data.eq(self.mem.dat_r),
+                                data_w[way].en.eq(1),
+                            ]
+                    with m.If(last):
+                        m.next = 'LOOKUP'
+                        m.d.sync += pending.eq(0)
+                        if self.ways == 2:
+                            m.d.sync += lru.bit_select(index, 1).eq(~refill_way)
+                        for way in range(self.ways):
+                            with m.If(refill_way == way):
+                                m.d.comb += [
+                                    tag_w[way].addr.eq(index),
+                                    tag_w[way].data.eq(Cat(1, tag)),
+                                    tag_w[way].en.eq(1),
+                                ]
+
+        return m
+
+
+def test_icache(dut, addresses):
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    bursts = []
+
+    def memory():
+        yield Passive()
+        while True:
+            yield Settle()
+            if (yield dut.mem.stb):
+                if (yield dut.mem.cti) != Cti.INCR_BURST:
+                    bursts.append((yield dut.mem.adr))
+                # Each word holds its own word address
+                yield dut.mem.dat_r.eq((yield dut.mem.adr))
+                yield dut.mem.ack.eq(1)
+                yield Tick()
+                yield dut.mem.ack.eq(0)
+            yield Tick()
+
+    def proc():
+        for address in addresses:
+            yield dut.cpu.cyc.eq(1)
+            yield dut.cpu.stb.eq(1)
+            yield dut.cpu.adr.eq(address)
+            yield Tick()
+            yield Settle()
+            while not (yield dut.cpu.ack):
+                yield Tick()
+                yield Settle()
+            data = yield dut.cpu.dat_r
+            if data != address:
+                raise ValueError('expected %s but got %s' % (address, data))
+            yield dut.cpu.stb.eq(0)
+            yield Tick()
+
+    sim.add_clock(1e-6)
+    sim.add_process(memory)
+    sim.add_sync_process(proc)
+    with trace(sim, fragment, 'icache'):
+        sim.run()
+    return bursts
+
+def test():
+    # Sequential code refills every line once
+    bursts = test_icache(ICache(line_words=4, lines=4), list(range(16)) * 2)
+    assert(bursts == [3, 7, 11, 15])
+
+    # Two addresses mapping to the same set thrash a direct mapped cache ...
+    bursts = test_icache(ICache(line_words=4, lines=4), [0, 16, 0, 16])
+    assert(len(bursts) == 4)
+
+    # ... but not a 2-way one
+    bursts = test_icache(ICache(line_words=4, lines=4, ways=2), [0, 16, 0, 16, 32, 16])
+    assert(bursts == [3, 19, 35])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,514 @@
+from array import array
+from math import ceil, log2
+from .compressed import expand
+from .decoder import Opcode
+from .layouts import ROM_BASE, RAM_BASE, GPIO_BASE
+
+MASK = 0xffff_ffff
+
+
+def sext(value, bits):
+    sign = 1 << (bits - 1)
+    return ((value & ((sign << 1) - 1)) ^ sign) - sign
+
+
+class Trap(Exception):
+    pass
+
+
+class ISS:
+    def __init__(self, prog, reset_address=ROM_BASE, ram_depth=32, with_m=False, data=(),
+                 with_c=False):
+        self.reset_address = reset_address
+        self.with_m = with_m
+        self.with_c = with_c
+        # Jump targets have to be aligned to the smallest instruction
+        self.align = 1 if with_c else 3
+
+        self.x = [0] * 32
+        self.pc = reset_address
+        self.order = 0
+        self.trap = False
+
+        self.rom = array('I', prog)
+        self.ram = array('I', data)
+        self.ram.extend([0] * (ram_depth - len(data)))
+        self.leds = 0
+
+        # Like the rom in Top only the low address bits are decoded, the
+        # whole rom is decoded up front and fetches are a table lookup. With
+        # compressed instructions there is an entry for every halfword, a
+        # 32-bit instruction in the last one wraps around like the fetch.
+        self.rom_mask = (1 << ceil(log2(len(prog)))) - 1 if len(prog) > 1 else 0
+        words = [prog[i] if i < len(prog) else 0 for i in range(self.rom_mask + 1)]
+        if with_c:
+            self.shift = 1
+            self.fetch_mask = self.rom_mask << 1 | 1
+            halves = [word >> shift & 0xffff for word in words for shift in (0, 16)]
+            self.decoded = []
+            for i, half in enumerate(halves):
+                if half & 3 != 3:
+                    self.decoded.append(self.decode(expand(half), 2, half))
+                else:
+                    self.decoded.append(self.decode(half | halves[(i + 1) & self.fetch_mask] << 16))
+        else:
+            self.shift = 2
+            self.fetch_mask = self.rom_mask
+            self.decoded = [self.decode(word) for word in words]
+
+    def read(self, address):
+        index = (address - RAM_BASE) >> 2
+        if 0 <= index < len(self.ram):
+            return self.ram[index]
+        if GPIO_BASE <= address < GPIO_BASE + 8:
+            return self.leds
+        index = (address - ROM_BASE) >> 2
+        if 0 <= index < len(self.rom):
+            return self.rom[index]
+        raise ValueError('no slave at %s' % hex(address))
+
+    def write(self, address, value, sel):
+        index = (address - RAM_BASE) >> 2
+        if 0 <= index < len(self.ram):
+            mask = 0
+            for i in range(4):
+                if sel >> i & 1:
+                    mask |= 0xff << (8 * i)
+            self.ram[index] = self.ram[index] & ~mask | value & mask
+        elif GPIO_BASE <= address < GPIO_BASE + 8:
+            self.leds = value & 0xff
+        elif 0 <= (address - ROM_BASE) >> 2 < len(self.rom):
+            # The rom acknowledges writes and ignores them
+            pass
+        else:
+            raise ValueError('no slave at %s' % hex(address))
+
+    def decode(self, inst, size=4, insn=None):
+        # Returns (execute, inst, rd, rs1, rs2, imm, funct3, insn) where
+        # execute takes the pc and returns the next one, inst is the
+        # expansion of a compressed insn. Unused register fields are 0, like
+        # the rvfi fields of the cores.
+        if insn is None:
+            insn = inst
+        opcode = inst & 0x7f
+        rd = inst >> 7 & 0x1f
+        funct3 = inst >> 12 & 0x7
+        rs1 = inst >> 15 & 0x1f
+        rs2 = inst >> 20 & 0x1f
+        funct7 = inst >> 25
+        decoder = DECODERS.get(opcode)
+        if decoder is not None:
+            decoded = decoder(self, inst, rd, funct3, rs1, rs2, funct7, size)
+            if decoded is not None:
+                return decoded + (insn,)
+        # Everything else, including fence.i, ecall and ebreak, traps like it
+        # does in the cores.
+        return (illegal, inst, 0, 0, 0, 0, 0, insn)
+
+    def run(self, count):
+        # Executes up to count instructions without recording them and
+        # returns how many retired, a trap stops the simulation.
+        decoded = self.decoded
+        shift = self.shift
+        mask = self.fetch_mask
+        pc = self.pc
+        retired = 0
+        try:
+            while retired < count:
+                pc = decoded[pc >> shift & mask][0](pc)
+                retired += 1
+        except Trap:
+            self.trap = True
+        self.pc = pc
+        self.order += retired
+        return retired
+
+    def step(self):
+        # Executes a single instruction and returns it in the shape of rvfi
+        pc = self.pc
+        execute, inst, rd, rs1, rs2, imm, funct3, insn = self.decoded[pc >> self.shift &
+                                                                      self.fetch_mask]
+        x = self.x
+        rvfi = {
+            'valid': 1,
+            'order': self.order,
+            'insn': insn,
+            'trap': 0,
+            'pc_rdata': pc,
+            'pc_wdata': pc,
+            'rs1_addr': rs1,
+            'rs1_rdata': x[rs1],
+            'rs2_addr': rs2,
+            'rs2_rdata': x[rs2],
+            'rd_addr': rd,
+            'rd_wdata': 0,
+            'mem_addr': 0,
+            'mem_rmask': 0,
+            'mem_wmask': 0,
+            'mem_rdata': 0,
+            'mem_wdata': 0,
+        }
+        opcode = inst & 0x7f
+        try:
+            if opcode == Opcode.LOAD or opcode == Opcode.STORE:
+                address = (x[rs1] + imm) & MASK
+                shift = 8 * (address & 3)
+                sel = (0b1, 0b11, 0b1111)[funct3 & 3] << (address & 3)
+                rvfi['mem_addr'] = address & ~3
+                if opcode == Opcode.LOAD:
+                    rvfi['mem_rmask'] = sel
+                    if not misaligned(address, funct3):
+                        rvfi['mem_rdata'] = self.read(address & ~3)
+                else:
+                    rvfi['mem_wmask'] = sel
+                    rvfi['mem_wdata'] = (x[rs2] & (0xff, 0xffff, MASK)[funct3 & 3]) << shift
+            self.pc = execute(pc)
+        except Trap:
+            self.trap = True
+            rvfi.update(valid=0, trap=1, rd_addr=0, mem_addr=0, mem_rmask=0, mem_wmask=0,
+                        mem_rdata=0, mem_wdata=0)
+            return rvfi
+        rvfi['pc_wdata'] = self.pc
+        rvfi['rd_wdata'] = x[rd]
+        self.order += 1
+        return rvfi
+
+
+def illegal(pc):
+    raise Trap()
+
+
+def misaligned(address, funct3):
+    return address & (0, 1, 3)[funct3 & 3] != 0
+
+
+def jump(pc, target, align):
+    if target & align:
+        raise Trap()
+    return target
+
+
+# Each decoder returns the decoded instruction or None if it is illegal.
+# Instructions writing x0 are executed, but their result is dropped.
+
+def decode_lui(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    x = iss.x
+    imm = inst & 0xffff_f000
+    if rd == 0:
+        def execute(pc):
+            return pc + size
+    else:
+        def execute(pc):
+            x[rd] = imm
+            return pc + size
+    return (execute, inst, rd, 0, 0, imm, 0)
+
+
+def decode_auipc(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    x = iss.x
+    imm = inst & 0xffff_f000
+    if rd == 0:
+        def execute(pc):
+            return pc + size
+    else:
+        def execute(pc):
+            x[rd] = (pc + imm) & MASK
+            return pc + size
+    return (execute, inst, rd, 0, 0, imm, 0)
+
+
+def decode_jal(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    x = iss.x
+    align = iss.align
+    imm = sext((inst >> 31) << 20 | (inst >> 12 & 0xff) << 12 |
+               (inst >> 20 & 1) << 11 | (inst >> 21 & 0x3ff) << 1, 21)
+    def execute(pc):
+        target = jump(pc, (pc + imm) & MASK, align)
+        if rd:
+            x[rd] = pc + size
+        return target
+    return (execute, inst, rd, 0, 0, imm, 0)
+
+
+def decode_jalr(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    if funct3 != 0:
+        return None
+    x = iss.x
+    align = iss.align
+    imm = sext(inst >> 20, 12)
+    def execute(pc):
+        target = jump(pc, (x[rs1] + imm) & MASK & ~1, align)
+        if rd:
+            x[rd] = pc + size
+        return target
+    return (execute, inst, rd, rs1, 0, imm, 0)
+
+
+BRANCHES = {
+    0b000: lambda a, b: a == b,
+    0b001: lambda a, b: a != b,
+    0b100: lambda a, b: a ^ 0x8000_0000 < b ^ 0x8000_0000,
+    0b101: lambda a, b: a ^ 0x8000_0000 >= b ^ 0x8000_0000,
+    0b110: lambda a, b: a < b,
+    0b111: lambda a, b: a >= b,
+}
+
+def decode_branch(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    taken = BRANCHES.get(funct3)
+    if taken is None:
+        return None
+    x = iss.x
+    align = iss.align
+    imm = sext((inst >> 31) << 12 | (inst >> 7 & 1) << 11 |
+               (inst >> 25 & 0x3f) << 5 | (inst >> 8 & 0xf) << 1, 13)
+    def execute(pc):
+        if taken(x[rs1], x[rs2]):
+            return jump(pc, (pc + imm) & MASK, align)
+        return pc + size
+    return (execute, inst, 0, rs1, rs2, imm, funct3)
+
+
+def decode_load(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    if funct3 not in (0b000, 0b001, 0b010, 0b100, 0b101):
+        return None
+    x = iss.x
+    read = iss.read
+    imm = sext(inst >> 20, 12)
+    width = 8 << (funct3 & 3)
+    mask = (1 << width) - 1
+    signed = funct3 < 0b100
+    def execute(pc):
+        address = (x[rs1] + imm) & MASK
+        if misaligned(address, funct3):
+            raise Trap()
+        value = read(address & ~3) >> (8 * (address & 3)) & mask
+        if signed:
+            value = sext(value, width) & MASK
+        if rd:
+            x[rd] = value
+        return pc + size
+    return (execute, inst, rd, rs1, 0, imm, funct3)
+
+
+def decode_store(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    if funct3 > 0b010:
+        return None
+    x = iss.x
+    write = iss.write
+    imm = sext(funct7 << 5 | rd, 12)
+    mask = (0xff, 0xffff, MASK)[funct3]
+    sel = (0b1, 0b11, 0b1111)[funct3]
+    def execute(pc):
+        address = (x[rs1] + imm) & MASK
+        if misaligned(address, funct3):
+            raise Trap()
+        shift = address & 3
+        write(address & ~3, (x[rs2] & mask) << (8 * shift), sel << shift)
+        return pc + size
+    return (execute, inst, 0, rs1, rs2, imm, funct3)
+
+
+def sra(a, b):
+    return (sext(a, 32) >> (b & 0x1f)) & MASK
+
+# Keyed by (funct7, funct3), immediate forms use the register form
+ALU_OPS = {
+    (0b0000000, 0b000): lambda a, b: (a + b) & MASK,
+    (0b0100000, 0b000): lambda a, b: (a - b) & MASK,
+    (0b0000000, 0b001): lambda a, b: (a << (b & 0x1f)) & MASK,
+    (0b0000000, 0b010): lambda a, b: int(a ^ 0x8000_0000 < b ^ 0x8000_0000),
+    (0b0000000, 0b011): lambda a, b: int(a < b),
+    (0b0000000, 0b100): lambda a, b: a ^ b,
+    (0b0000000, 0b101): lambda a, b: a >> (b & 0x1f),
+    (0b0100000, 0b101): sra,
+    (0b0000000, 0b110): lambda a, b: a | b,
+    (0b0000000, 0b111): lambda a, b: a & b,
+}
+
+
+def div(a, b):
+    if b == 0:
+        return MASK
+    a = sext(a, 32)
+    b = sext(b, 32)
+    q = abs(a) // abs(b)
+    return (-q if (a < 0) != (b < 0) else q) & MASK
+
+def rem(a, b):
+    if b == 0:
+        return a
+    a = sext(a, 32)
+    b = sext(b, 32)
+    r = abs(a) % abs(b)
+    return (-r if a < 0 else r) & MASK
+
+MULDIV_OPS = {
+    (0b0000001, 0b000): lambda a, b: (a * b) & MASK,
+    (0b0000001, 0b001): lambda a, b: (sext(a, 32) * sext(b, 32) >> 32) & MASK,
+    (0b0000001, 0b010): lambda a, b: (sext(a, 32) * b >> 32) & MASK,
+    (0b0000001, 0b011): lambda a, b: a * b >> 32,
+    (0b0000001, 0b100): div,
+    (0b0000001, 0b101): lambda a, b: a // b if b else MASK,
+    (0b0000001, 0b110): rem,
+    (0b0000001, 0b111): lambda a, b: a % b if b else a,
+}
+
+
+def decode_imm(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    if funct3 == 0b001 or funct3 == 0b101:
+        op = ALU_OPS.get((funct7, funct3))
+        imm = rs2
+    else:
+        op = ALU_OPS.get((0, funct3))
+        imm = sext(inst >> 20, 12) & MASK
+    if op is None:
+        return None
+    x = iss.x
+    if rd == 0:
+        def execute(pc):
+            return pc + size
+    else:
+        def execute(pc):
+            x[rd] = op(x[rs1], imm)
+            return pc + size
+    return (execute, inst, rd, rs1, 0, imm, funct3)
+
+
+def decode_reg(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    op = ALU_OPS.get((funct7, funct3))
+    if op is None and iss.with_m:
+        op = MULDIV_OPS.get((funct7, funct3))
+    if op is None:
+        return None
+    x = iss.x
+    if rd == 0:
+        def execute(pc):
+            return pc + size
+    else:
+        def execute(pc):
+            x[rd] = op(x[rs1], x[rs2])
+            return pc + size
+    return (execute, inst, rd, rs1, rs2, 0, funct3)
+
+
+def decode_misc_mem(iss, inst, rd, funct3, rs1, rs2, funct7, size):
+    # fence only orders memory accesses, which the simulator does in order
+    if funct3 != 0:
+        return None
+    def execute(pc):
+        return pc + size
+    return (execute, inst, 0, 0, 0, 0, 0)
+
+
+DECODERS = {
+    Opcode.LUI:      decode_lui,
+    Opcode.AUIPC:    decode_auipc,
+    Opcode.JAL:      decode_jal,
+    Opcode.JALR:     decode_jalr,
+    Opcode.BRANCH:   decode_branch,
+    Opcode.LOAD:     decode_load,
+    Opcode.STORE:    decode_store,
+    Opcode.IMM:      decode_imm,
+    Opcode.REG:      decode_reg,
+    Opcode.MISC_MEM: decode_misc_mem,
+}
+
+
+def test_iss(prog, expected, with_m=False, with_c=False):
+    iss = ISS(prog, with_m=with_m, with_c=with_c)
+    trace = []
+    while not iss.trap and len(trace) < 100:
+        rvfi = iss.step()
+        if rvfi['valid']:
+            trace.append((rvfi['pc_rdata'], rvfi['rd_addr'], rvfi['rd_wdata']))
+    if trace != expected:
+        raise ValueError('expected %s but got %s' % (expected, trace))
+
+def test():
+    import time
+
+    prog = [
+        0xdead_c0b7, # lui   x1, 0xdeadc
+        0xeef0_8093, # addi  x1, x1,-273
+        0x8000_4197, # auipc x3,0x80004
+        0xfe11_ac23, # sw    x1,-8(x3) # 0x4000
+        0x8000_4117, # auipc x2,0x80004
+        0xff01_2103, # lw    x2,-16(x2) # 0x4000
+        0x0011_0463, # beq   x2,x1,80000020
+        0x0000_0073, # ecall
+        0x0000_0013, # addi x0,x0,0
+        0x0000_0073, # ecall
+    ]
+    test_iss(prog, [
+        (0x8000_0000, 1, 0xdeadc000),
+        (0x8000_0004, 1, 0xdeadbeef),
+        (0x8000_0008, 3, 0x0000_4008),
+        (0x8000_000c, 0, 0),
+        (0x8000_0010, 2, 0x0000_4010),
+        (0x8000_0014, 2, 0xdeadbeef),
+        (0x8000_0018, 0, 0),
+        (0x8000_0020, 0, 0),
+    ])
+    print('ok')
+
+    prog = [
+        0x0400_0093, # addi  x1, x0, 64
+        0x0000_4137, # lui   x2, 0x4
+        0xfff0_0193, # addi  x3, x0, -1
+        0x0031_00a3, # sb    x3, 1(x2)
+        0x0011_1123, # sh    x1, 2(x2)
+        0x0001_2203, # lw    x4, 0(x2)
+        0x0011_4283, # lbu   x5, 1(x2)
+        0x0011_0303, # lb    x6, 1(x2)
+        0x0230_c3b3, # div   x7, x1, x3
+        0x0200_e433, # rem   x8, x1, x0
+        0x0000_0073, # ecall
+    ]
+    test_iss(prog, [
+        (0x8000_0000, 1, 64),
+        (0x8000_0004, 2, 0x4000),
+        (0x8000_0008, 3, 0xffff_ffff),
+        (0x8000_000c, 0, 0),
+        (0x8000_0010, 0, 0),
+        (0x8000_0014, 4, 0x0040_ff00),
+        (0x8000_0018, 5, 0xff),
+        (0x8000_001c, 6, 0xffff_ffff),
+        (0x8000_0020, 7, 0xffff_ffc0),
+        (0x8000_0024, 8, 64),
+    ], with_m=True)
+    print('ok')
+
+    # Compressed instructions advance the pc by 2 and may jump to a halfword
+    prog = [
+        0x147d_4415, # c.li  x8,5            c.addi x8,-1
+        0x8513_84a2, # c.mv  x9,x8           addi  x10,x9,16 ...
+        0x2011_0104, # ...                   c.jal .+4
+        0x9526_4501, # c.li  x10,0           c.add x10,x9
+        0x0000_0073, # ecall
+    ]
+    test_iss(prog, [
+        (0x8000_0000, 8, 5),
+        (0x8000_0002, 8, 4),
+        (0x8000_0004, 9, 4),
+        (0x8000_0006, 10, 20),
+        (0x8000_000a, 1, 0x8000_000c),
+        (0x8000_000e, 10, 24),
+    ], with_c=True)
+    print('ok')
+
+    # A countdown loop from 1000000
+    prog = [
+        0x000f_40b7, # lui   x1, 0xf4
+        0x2400_8093, # addi  x1, x1, 576
+        0xfff0_8093, # addi  x1, x1, -1
+        0xfe00_9ee3, # bne   x1, x0, 80000008
+        0x0000_0073, # ecall
+    ]
+    iss = ISS(prog)
+    start = time.time()
+    retired = iss.run(10_000_000)
+    assert(iss.trap and retired == 2_000_002)
+    print('ok: %d instructions per second' % (retired / (time.time() - start)))
+
+if __name__ == '__main__':
+    test()
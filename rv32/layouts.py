@@ -0,0 +1,60 @@
+from nmigen.hdl.rec import *
+
+# Memory map of Top: the rom answers every fetch, the data bus decodes the
+# rom, ram and gpio windows.
+ROM_BASE  = 0x8000_0000
+RAM_BASE  = 0x4000
+GPIO_BASE = 0x5000
+GPIO_SIZE = 0x1000
+
+wishbone_layout = [
+    ("adr",   30, DIR_FANOUT),
+    ("dat_w", 32, DIR_FANOUT),
+    ("dat_r", 32, DIR_FANIN),
+    ("sel",    4, DIR_FANOUT),
+    ("cyc",    1, DIR_FANOUT),
+    ("stb",    1, DIR_FANOUT),
+    ("ack",    1, DIR_FANIN),
+    ("we",     1, DIR_FANOUT),
+    ("cti",    3, DIR_FANOUT),
+    ("bte",    2, DIR_FANOUT),
+    ("err",    1, DIR_FANIN),
+    ("stall",  1, DIR_FANIN)
+]
+
+# RISC-V Formal Interface
+# https://github.com/SymbioticEDA/riscv-formal/blob/master/docs/rvfi.md
+
+rvfi_layout = [
+    ("valid",      1, DIR_FANOUT),
+    ("order",     64, DIR_FANOUT),
+    ("insn",      32, DIR_FANOUT),
+    ("trap",       1, DIR_FANOUT),
+    ("halt",       1, DIR_FANOUT),
+    ("intr",       1, DIR_FANOUT),
+    ("mode",       2, DIR_FANOUT),
+    ("ixl",        2, DIR_FANOUT),
+
+    ("rs1_addr",   5, DIR_FANOUT),
+    ("rs2_addr",   5, DIR_FANOUT),
+    ("rs1_rdata", 32, DIR_FANOUT),
+    ("rs2_rdata", 32, DIR_FANOUT),
+    ("rd_addr",    5, DIR_FANOUT),
+    ("rd_wdata",  32, DIR_FANOUT),
+
+    ("pc_rdata",  32, DIR_FANOUT),
+    ("pc_wdata",  32, DIR_FANOUT),
+
+    ("mem_addr",  32, DIR_FANOUT),
+    ("mem_rmask",  4, DIR_FANOUT),
+    ("mem_wmask",  4, DIR_FANOUT),
+    ("mem_rdata", 32, DIR_FANOUT),
+    ("mem_wdata", 32, DIR_FANOUT)
+]
+
+# Branch predictor statistics, next to RVFI
+
+predictor_layout = [
+    ("hits",      32, DIR_FANOUT),
+    ("misses",    32, DIR_FANOUT),
+]
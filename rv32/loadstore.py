@@ -47,7 +47,8 @@ class LoadStore(Elaboratable):
         with m.Else():
             m.d.comb += value.eq((self.value_in & mask) << (self.address << 3))
 
-        with m.If(self.funct3[2] | ~sign):
+        # Only loads are sign extended, a store leaves the other lanes 0
+        with m.If(~self.load | self.funct3[2] | ~sign):
             m.d.comb += self.value_out.eq(value)
         with m.Else():
             m.d.comb += self.value_out.eq(value | ~mask)
@@ -0,0 +1,261 @@
+from math import log2
+from nmigen import *
+from nmigen.sim import *
+from .trace import trace
+
+
+class MulDivFunct3:
+    MUL    = 0b000
+    MULH   = 0b001
+    MULHSU = 0b010
+    MULHU  = 0b011
+    DIV    = 0b100
+    DIVU   = 0b101
+    REM    = 0b110
+    REMU   = 0b111
+
+
+class MulDiv(Elaboratable):
+    def __init__(self, single_cycle_mul=True, radix=4, altops=False):
+        if radix not in (2, 4):
+            raise ValueError('expected a radix of 2 or 4 but got %s' % radix)
+        self.single_cycle_mul = single_cycle_mul
+        self.radix = radix
+        # riscv-formal's alternative ops, which keep the M checks tractable
+        self.altops = altops
+
+        self.funct3 = Signal(3)
+        self.in1 = Signal(32)
+        self.in2 = Signal(32)
+        self.out = Signal(32)
+
+        # en is held while the instruction waits in execute, ready stays up
+        # until the result is taken with ack.
+        self.en = Signal()
+        self.ready = Signal()
+        self.ack = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        funct3 = self.funct3
+        div = funct3[2]
+        in1_signed = Signal()
+        in2_signed = Signal()
+        with m.Switch(funct3):
+            with m.Case(MulDivFunct3.MULH, MulDivFunct3.DIV, MulDivFunct3.REM):
+                m.d.comb += [
+                    in1_signed.eq(1),
+                    in2_signed.eq(1),
+                ]
+            with m.Case(MulDivFunct3.MULHSU):
+                m.d.comb += in1_signed.eq(1)
+        in1_neg = Signal()
+        in2_neg = Signal()
+        m.d.comb += [
+            in1_neg.eq(in1_signed & self.in1[31]),
+            in2_neg.eq(in2_signed & self.in2[31]),
+        ]
+
+        # Everything not handled in a single cycle iterates on the operand
+        # magnitudes and fixes the sign of the result at the end.
+        iterative = Signal()
+        if self.single_cycle_mul:
+            m.d.comb += iterative.eq(div)
+        else:
+            m.d.comb += iterative.eq(1)
+
+        steps = int(log2(self.radix))
+        busy = Signal()
+        done = Signal()
+        count = Signal(range(32 // steps))
+        operand = Signal(32)
+        hi = Signal(33)
+        lo = Signal(32)
+        negate_hi = Signal()
+        negate_lo = Signal()
+
+        # Shift-add multiplication, {hi, lo} starts out as {0, multiplier}
+        mul_hi = hi
+        mul_lo = lo
+        for _ in range(steps):
+            add = Mux(mul_lo[0], mul_hi[:32] + operand, mul_hi[:32])
+            mul_hi, mul_lo = add[1:], Cat(mul_lo[1:], add[0])
+
+        # Restoring division, lo starts out as the dividend and shifts into
+        # the remainder in hi while the quotient shifts in from the bottom.
+        div_hi = hi
+        div_lo = lo
+        for _ in range(steps):
+            shifted = Cat(div_lo[31], div_hi[:32])
+            diff = shifted - operand
+            fits = ~diff[33]
+            div_hi = Mux(fits, diff[:33], shifted)
+            div_lo = Cat(fits, div_lo[:31])
+
+        abs1 = Mux(in1_neg, -self.in1, self.in1)[:32]
+        abs2 = Mux(in2_neg, -self.in2, self.in2)[:32]
+
+        with m.If(~self.en):
+            m.d.sync += [
+                busy.eq(0),
+                done.eq(0),
+            ]
+        with m.Elif(done):
+            with m.If(self.ack):
+                m.d.sync += done.eq(0)
+        with m.Elif(~busy & iterative):
+            m.d.sync += [
+                busy.eq(1),
+                count.eq(0),
+                operand.eq(Mux(div, abs2, abs1)),
+                hi.eq(0),
+                lo.eq(Mux(div, abs1, abs2)),
+            ]
+            with m.If(div):
+                # Division by zero leaves the quotient at -1 and the remainder
+                # at the dividend, which the unsigned algorithm already does.
+                m.d.sync += [
+                    negate_lo.eq((in1_neg ^ in2_neg) & (self.in2 != 0)),
+                    negate_hi.eq(in1_neg),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    negate_lo.eq(in1_neg ^ in2_neg),
+                    negate_hi.eq(in1_neg ^ in2_neg),
+                ]
+        with m.Elif(busy):
+            m.d.sync += count.eq(count + 1)
+            with m.If(div):
+                m.d.sync += [
+                    hi.eq(div_hi),
+                    lo.eq(div_lo),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    hi.eq(mul_hi),
+                    lo.eq(mul_lo),
+                ]
+            with m.If(count == 32 // steps - 1):
+                m.d.sync += [
+                    busy.eq(0),
+                    done.eq(1),
+                ]
+
+        iter_out = Signal(32)
+        with m.If(div):
+            with m.If(funct3[1]):
+                m.d.comb += iter_out.eq(Mux(negate_hi, -hi[:32], hi[:32]))
+            with m.Else():
+                m.d.comb += iter_out.eq(Mux(negate_lo, -lo, lo))
+        with m.Else():
+            product = Signal(64)
+            m.d.comb += product.eq(Mux(negate_lo, -Cat(lo, hi[:32]), Cat(lo, hi[:32])))
+            with m.If(funct3 == MulDivFunct3.MUL):
+                m.d.comb += iter_out.eq(product[:32])
+            with m.Else():
+                m.d.comb += iter_out.eq(product[32:])
+
+        # A single signed 33x33 multiply covers all four variants and maps
+        # onto the DSP blocks.
+        comb_out = Signal(32)
+        if self.single_cycle_mul:
+            a = Signal(signed(33))
+            b = Signal(signed(33))
+            product = Signal(signed(66))
+            m.d.comb += [
+                a.eq(Cat(self.in1, in1_neg)),
+                b.eq(Cat(self.in2, in2_neg)),
+                product.eq(a * b),
+            ]
+            with m.If(funct3 == MulDivFunct3.MUL):
+                m.d.comb += comb_out.eq(product[:32])
+            with m.Else():
+                m.d.comb += comb_out.eq(product[32:64])
+
+        m.d.comb += [
+            self.ready.eq(Mux(iterative, done, self.en)),
+            self.out.eq(Mux(iterative, iter_out, comb_out)),
+        ]
+
+        if self.altops:
+            with m.Switch(funct3):
+                with m.Case(MulDivFunct3.MUL):
+                    m.d.comb += self.out.eq((self.in1 + self.in2) ^ 0x5876063e)
+                with m.Case(MulDivFunct3.MULH):
+                    m.d.comb += self.out.eq((self.in1 + self.in2) ^ 0xf6583fb7)
+                with m.Case(MulDivFunct3.MULHSU):
+                    m.d.comb += self.out.eq((self.in1 - self.in2) ^ 0xecfbe137)
+                with m.Case(MulDivFunct3.MULHU):
+                    m.d.comb += self.out.eq((self.in1 + self.in2) ^ 0x949ce5e8)
+                with m.Case(MulDivFunct3.DIV):
+                    m.d.comb += self.out.eq((self.in1 - self.in2) ^ 0x7f8529ec)
+                with m.Case(MulDivFunct3.DIVU):
+                    m.d.comb += self.out.eq((self.in1 - self.in2) ^ 0x10e8fd70)
+                with m.Case(MulDivFunct3.REM):
+                    m.d.comb += self.out.eq((self.in1 - self.in2) ^ 0x8da68fa5)
+                with m.Case(MulDivFunct3.REMU):
+                    m.d.comb += self.out.eq((self.in1 - self.in2) ^ 0x3138d0e1)
+
+        return m
+
+
+def test_muldiv(dut, funct3, in1, in2, expected):
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    cycles = []
+
+    def proc():
+        yield dut.funct3.eq(funct3)
+        yield dut.in1.eq(in1)
+        yield dut.in2.eq(in2)
+        yield dut.en.eq(1)
+        yield Settle()
+        cycle = 0
+        while not (yield dut.ready):
+            yield Tick()
+            yield Settle()
+            cycle += 1
+        out = yield dut.out
+        if out != expected & 0xffff_ffff:
+            raise ValueError('expected %s but got %s' % (expected & 0xffff_ffff, out))
+        cycles.append(cycle)
+
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    with trace(sim, fragment, 'muldiv'):
+        sim.run()
+    return cycles[0]
+
+def test():
+    cases = [
+        (MulDivFunct3.MUL,    7, -3, -21),
+        (MulDivFunct3.MUL,    0x8000_0000, 0x8000_0000, 0),
+        (MulDivFunct3.MULH,   -1, -1, 0),
+        (MulDivFunct3.MULH,   0x8000_0000, 0x8000_0000, 0x4000_0000),
+        (MulDivFunct3.MULHSU, -1, 0xffff_ffff, -1),
+        (MulDivFunct3.MULHU,  0xffff_ffff, 0xffff_ffff, 0xffff_fffe),
+        (MulDivFunct3.DIV,    -21, 4, -5),
+        (MulDivFunct3.DIV,    7, 0, -1),
+        (MulDivFunct3.DIV,    -7, 0, -1),
+        (MulDivFunct3.DIV,    0x8000_0000, -1, 0x8000_0000),
+        (MulDivFunct3.DIVU,   0xffff_fffe, 3, 0x5555_5554),
+        (MulDivFunct3.REM,    -21, 4, -1),
+        (MulDivFunct3.REM,    -7, 0, -7),
+        (MulDivFunct3.REM,    0x8000_0000, -1, 0),
+        (MulDivFunct3.REMU,   0xffff_fffe, 3, 2),
+    ]
+    for single_cycle_mul in (True, False):
+        for radix in (2, 4):
+            for funct3, in1, in2, expected in cases:
+                cycles = test_muldiv(MulDiv(single_cycle_mul, radix), funct3,
+                                     in1 & 0xffff_ffff, in2 & 0xffff_ffff, expected)
+                if single_cycle_mul and funct3 < MulDivFunct3.DIV:
+                    assert(cycles == 0)
+                else:
+                    assert(cycles == 32 * 2 // radix + 1)
+    test_muldiv(MulDiv(altops=True), MulDivFunct3.MUL, 1, 2, 3 ^ 0x5876063e)
+    print('ok')
+
+if __name__ == '__main__':
+    test()
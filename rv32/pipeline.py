@@ -0,0 +1,693 @@
+from nmigen import *
+from nmigen.hdl.rec import *
+from nmigen.sim import *
+from .alu import ALU
+from .branch import Branch
+from .bus import bus_request, bus_started
+from .csr import CSRFile, Event
+from .decoder import Decoder, PcOp
+from .layouts import wishbone_layout, rvfi_layout, predictor_layout
+from .loadstore import LoadStore
+from .regs import Registers
+from .trace import trace
+
+# Pipeline registers between the IF/ID/EX/MEM/WB stages. Every stage carries
+# the fields needed to drive RVFI once the instruction retires in WB.
+
+if_id_layout = [
+    ("valid",         1),
+    ("pc",           32),
+    ("pred",         32),
+    ("insn",         32),
+]
+
+id_ex_layout = [
+    ("valid",         1),
+    ("pc",           32),
+    ("pred",         32),
+    ("insn",         32),
+    ("rs1",           5),
+    ("rs1_en",        1),
+    ("rs1_data",     32),
+    ("rs2",           5),
+    ("rs2_en",        1),
+    ("rs2_data",     32),
+    ("rd",            5),
+    ("pc_op",         2),
+    ("mem_op_en",     1),
+    ("mem_op_store",  1),
+    ("muldiv_op_en",  1),
+    ("csr_op_en",     1),
+    ("fence_op_en",   1),
+    ("funct3",        3),
+    ("funct1",        1),
+    ("imm",          32),
+    ("trap",          1),
+]
+
+ex_mem_layout = [
+    ("valid",         1),
+    ("trap",          1),
+    ("pc",           32),
+    ("pc_next",      32),
+    ("insn",         32),
+    ("rs1",           5),
+    ("rs1_data",     32),
+    ("rs2",           5),
+    ("rs2_data",     32),
+    ("rd",            5),
+    ("result",       32),
+    ("mem_op_en",     1),
+    ("mem_op_store",  1),
+    ("fence_op_en",   1),
+    ("funct3",        3),
+    ("mem_addr",     32),
+    ("sel",           4),
+    ("dat_w",        32),
+]
+
+mem_wb_layout = [
+    ("valid",         1),
+    ("trap",          1),
+    ("pc",           32),
+    ("pc_next",      32),
+    ("insn",         32),
+    ("rs1",           5),
+    ("rs1_data",     32),
+    ("rs2",           5),
+    ("rs2_data",     32),
+    ("rd",            5),
+    ("result",       32),
+    ("mem_op_en",     1),
+    ("mem_op_store",  1),
+    ("mem_addr",     32),
+    ("sel",           4),
+    ("dat_r",        32),
+    ("dat_w",        32),
+]
+
+
+class RV32Pipelined(Elaboratable):
+    def __init__(self, reset_address=0x8000_0000, with_rvfi=False, predictor=None, muldiv=None,
+                 pipelined_bus=False, with_csr=False):
+        self.reset_address = reset_address
+        self.with_rvfi = with_rvfi
+        self.predictor = predictor
+        self.muldiv = muldiv
+        self.pipelined_bus = pipelined_bus
+        self.csr = CSRFile() if with_csr else None
+
+        self.ibus = Record(wishbone_layout)
+        self.dbus = Record(wishbone_layout)
+        # A fence asks the data cache to write back and drop its lines, and
+        # leaves MEM once it isn't busy anymore
+        self.flush = Signal()
+        self.flush_busy = Signal()
+        if with_rvfi:
+            self.rvfi = Record(rvfi_layout)
+            if predictor is not None:
+                self.bp = Record(predictor_layout)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        decoder   = m.submodules.decoder   = Decoder(with_m = self.muldiv is not None,
+                                                     with_csr = self.csr is not None)
+        regs      = m.submodules.regs      = Registers()
+        alu       = m.submodules.alu       = ALU()
+        branch    = m.submodules.branch    = Branch()
+        store     = m.submodules.store     = LoadStore()
+        load      = m.submodules.load      = LoadStore()
+        predictor = self.predictor
+        if predictor is not None:
+            m.submodules.predictor = predictor
+        muldiv = self.muldiv
+        if muldiv is not None:
+            m.submodules.muldiv = muldiv
+        csr = self.csr
+        if csr is not None:
+            m.submodules.csr = csr
+
+        if_id  = Record(if_id_layout)
+        id_ex  = Record(id_ex_layout)
+        ex_mem = Record(ex_mem_layout)
+        mem_wb = Record(mem_wb_layout)
+
+        mem_stall = Signal()
+        ex_stall = Signal()
+        stall = Signal()
+        load_use = Signal()
+        id_advance = Signal()
+        redirect = Signal()
+        redirect_pc = Signal(32)
+        id_redirect = Signal()
+        id_target = Signal(32)
+
+        # IF: one outstanding classic wishbone request. The request address is
+        # latched on issue, so a redirect can retarget fetch_pc while the
+        # request is in flight; its response is then dropped.
+        fetch_pc = Signal(32, reset=self.reset_address)
+        fetch_next = Signal(32)
+        fetch_redirect = Signal()
+        req_pc = Signal(32)
+        req_pred = Signal(32)
+        fetch_busy = Signal()
+        fetch_kill = Signal()
+        fetch_issue = Signal()
+        fetch_done = Signal()
+        fetch_deliver = Signal()
+        id_inst = Signal(32)
+
+        m.d.comb += [
+            fetch_next.eq(fetch_pc + 4),
+            fetch_redirect.eq(redirect | id_redirect),
+        ]
+        if predictor is not None:
+            m.d.comb += predictor.fetch_pc.eq(fetch_pc)
+            with m.If(predictor.fetch_hit):
+                m.d.comb += fetch_next.eq(predictor.fetch_target)
+
+        with m.If(fetch_issue):
+            m.d.sync += [
+                req_pc.eq(fetch_pc),
+                req_pred.eq(fetch_next),
+                fetch_pc.eq(fetch_next),
+            ]
+
+        if self.pipelined_bus:
+            # The next request is issued while the previous one is being
+            # acknowledged, a response that finds if_id occupied waits in the
+            # skid buffer. Responses arrive a cycle after the request was
+            # accepted at the earliest, so they always belong to req_pc.
+            fetch_hold = Signal()
+            fetch_accept = Signal()
+            fetch_take = Signal()
+            skid = Record(if_id_layout)
+
+            m.d.comb += [
+                fetch_take.eq(~if_id.valid | id_advance),
+                fetch_issue.eq(~fetch_hold & (~fetch_busy | self.ibus.ack) & ~skid.valid &
+                               ~(self.ibus.ack & ~fetch_take) & bus_started(m)),
+                self.ibus.cyc.eq(self.ibus.stb | fetch_busy),
+                self.ibus.stb.eq(fetch_issue | fetch_hold),
+                self.ibus.adr.eq(Mux(fetch_hold, req_pc, fetch_pc)[2:]),
+                fetch_accept.eq(self.ibus.stb & ~self.ibus.stall),
+                fetch_done.eq(self.ibus.ack),
+            ]
+            m.d.sync += [
+                fetch_hold.eq(self.ibus.stb & self.ibus.stall),
+                fetch_busy.eq(fetch_accept | (fetch_busy & ~self.ibus.ack)),
+            ]
+            with m.If(fetch_done):
+                m.d.sync += fetch_kill.eq(0)
+            with m.If(fetch_redirect):
+                m.d.sync += [
+                    fetch_pc.eq(Mux(redirect, redirect_pc, id_target)),
+                    fetch_kill.eq(self.ibus.stb | (fetch_busy & ~self.ibus.ack)),
+                ]
+
+            m.d.comb += fetch_deliver.eq(fetch_done & ~fetch_kill & ~fetch_redirect)
+
+            with m.If(fetch_redirect):
+                m.d.sync += [
+                    if_id.valid.eq(0),
+                    skid.valid.eq(0),
+                ]
+            with m.Elif(fetch_take):
+                with m.If(skid.valid):
+                    m.d.sync += [
+                        if_id.eq(skid),
+                        skid.valid.eq(fetch_deliver),
+                    ]
+                with m.Else():
+                    m.d.sync += if_id.valid.eq(fetch_deliver)
+                    with m.If(fetch_deliver):
+                        m.d.sync += [
+                            if_id.pc.eq(req_pc),
+                            if_id.pred.eq(req_pred),
+                            if_id.insn.eq(self.ibus.dat_r),
+                        ]
+            with m.Elif(fetch_deliver):
+                m.d.sync += skid.valid.eq(1)
+            with m.If(fetch_deliver & (skid.valid | ~fetch_take)):
+                m.d.sync += [
+                    skid.pc.eq(req_pc),
+                    skid.pred.eq(req_pred),
+                    skid.insn.eq(self.ibus.dat_r),
+                ]
+
+            with m.If(fetch_take & skid.valid):
+                m.d.comb += id_inst.eq(skid.insn)
+            with m.Elif(fetch_take & fetch_deliver):
+                m.d.comb += id_inst.eq(self.ibus.dat_r)
+            with m.Else():
+                m.d.comb += id_inst.eq(if_id.insn)
+        else:
+            m.d.comb += [
+                fetch_issue.eq(~fetch_busy & (~if_id.valid | id_advance)),
+                self.ibus.cyc.eq(1),
+                self.ibus.stb.eq(fetch_busy | fetch_issue),
+                self.ibus.adr.eq(Mux(fetch_busy, req_pc, fetch_pc)[2:]),
+                fetch_done.eq(self.ibus.stb & self.ibus.ack),
+            ]
+            with m.If(self.ibus.stb):
+                m.d.sync += fetch_busy.eq(~self.ibus.ack)
+            with m.If(fetch_done):
+                m.d.sync += fetch_kill.eq(0)
+            with m.If(fetch_redirect):
+                m.d.sync += [
+                    fetch_pc.eq(Mux(redirect, redirect_pc, id_target)),
+                    fetch_kill.eq(self.ibus.stb & ~self.ibus.ack),
+                ]
+
+            m.d.comb += fetch_deliver.eq(fetch_done & ~fetch_kill & ~fetch_redirect)
+
+            with m.If(fetch_redirect):
+                m.d.sync += if_id.valid.eq(0)
+            with m.Elif(fetch_deliver):
+                m.d.sync += [
+                    if_id.valid.eq(1),
+                    if_id.pc.eq(Mux(fetch_busy, req_pc, fetch_pc)),
+                    if_id.pred.eq(Mux(fetch_busy, req_pred, fetch_next)),
+                    if_id.insn.eq(self.ibus.dat_r),
+                ]
+            with m.Elif(id_advance):
+                m.d.sync += if_id.valid.eq(0)
+
+            m.d.comb += id_inst.eq(Mux(fetch_deliver, self.ibus.dat_r, if_id.insn))
+
+        # ID: the register file reads synchronously, so it is addressed with
+        # the instruction entering ID. A value written back while the
+        # instruction sits in ID is bypassed.
+        id_rs1_data = Signal(32)
+        id_rs2_data = Signal(32)
+
+        m.d.comb += [
+            regs.rs1_addr.eq(id_inst[15:20]),
+            regs.rs2_addr.eq(id_inst[20:25]),
+            decoder.inst.eq(if_id.insn),
+            id_rs1_data.eq(Mux(decoder.rs1 != 0, regs.rs1_data, 0)),
+            id_rs2_data.eq(Mux(decoder.rs2 != 0, regs.rs2_data, 0)),
+        ]
+        with m.If(mem_wb.valid & ~mem_wb.trap & (mem_wb.rd != 0)):
+            with m.If(mem_wb.rd == decoder.rs1):
+                m.d.comb += id_rs1_data.eq(mem_wb.result)
+            with m.If(mem_wb.rd == decoder.rs2):
+                m.d.comb += id_rs2_data.eq(mem_wb.result)
+
+        # A load in EX can't forward to the instruction in ID, so hold ID for
+        # one cycle and let a bubble into EX.
+        m.d.comb += [
+            load_use.eq(if_id.valid & id_ex.valid & ~id_ex.trap &
+                        id_ex.mem_op_en & ~id_ex.mem_op_store & (id_ex.rd != 0) &
+                        ((id_ex.rd == decoder.rs1) | (id_ex.rd == decoder.rs2))),
+            id_advance.eq(~stall & ~load_use),
+        ]
+
+        # Jumps and branches predicted taken that fetch didn't follow are
+        # redirected from ID, one cycle earlier than EX would.
+        id_pred = Signal(32)
+        m.d.comb += id_pred.eq(if_id.pred)
+        if predictor is not None:
+            id_taken = Signal()
+            m.d.comb += [
+                predictor.pc.eq(if_id.pc),
+                predictor.imm.eq(decoder.imm),
+                id_target.eq(if_id.pc + decoder.imm),
+                id_taken.eq((decoder.pc_op == PcOp.JAL) |
+                            ((decoder.pc_op == PcOp.BRANCH) & predictor.taken)),
+                id_redirect.eq(if_id.valid & id_advance & ~redirect & ~decoder.trap &
+                               id_taken & (if_id.pred != id_target)),
+            ]
+            with m.If(id_redirect):
+                m.d.comb += id_pred.eq(id_target)
+
+        with m.If(~stall):
+            with m.If(redirect | load_use | ~if_id.valid):
+                m.d.sync += id_ex.valid.eq(0)
+            with m.Else():
+                m.d.sync += [
+                    id_ex.valid.eq(1),
+                    id_ex.pc.eq(if_id.pc),
+                    id_ex.pred.eq(id_pred),
+                    id_ex.insn.eq(if_id.insn),
+                    id_ex.rs1.eq(decoder.rs1),
+                    id_ex.rs1_en.eq(decoder.rs1_en),
+                    id_ex.rs1_data.eq(id_rs1_data),
+                    id_ex.rs2.eq(decoder.rs2),
+                    id_ex.rs2_en.eq(decoder.rs2_en),
+                    id_ex.rs2_data.eq(id_rs2_data),
+                    id_ex.rd.eq(decoder.rd),
+                    id_ex.pc_op.eq(decoder.pc_op),
+                    id_ex.mem_op_en.eq(decoder.mem_op_en),
+                    id_ex.mem_op_store.eq(decoder.mem_op_store),
+                    id_ex.muldiv_op_en.eq(decoder.muldiv_op_en),
+                    id_ex.csr_op_en.eq(decoder.csr_op_en),
+                    id_ex.fence_op_en.eq(decoder.fence_op_en),
+                    id_ex.funct3.eq(decoder.funct3),
+                    id_ex.funct1.eq(decoder.funct1),
+                    id_ex.imm.eq(decoder.imm),
+                    id_ex.trap.eq(decoder.trap),
+                ]
+
+        # EX: operands are forwarded from MEM and WB. While EX is held by a
+        # stall the forwarded values are captured, since the producer in WB
+        # retires before EX moves on.
+        ex_rs1 = Signal(32)
+        ex_rs2 = Signal(32)
+        rs1_en = Signal()
+        rs2_en = Signal()
+        pc_4 = Signal(32)
+        pc_next = Signal(32)
+        pc_next_temp = Signal(32)
+        result = Signal(32)
+        trap = Signal()
+        csr_trap = Signal()
+
+        forward(m, id_ex.rs1, id_ex.rs1_data, ex_mem, mem_wb, ex_rs1)
+        forward(m, id_ex.rs2, id_ex.rs2_data, ex_mem, mem_wb, ex_rs2)
+
+        with m.If(stall):
+            m.d.sync += [
+                id_ex.rs1_data.eq(ex_rs1),
+                id_ex.rs2_data.eq(ex_rs2),
+            ]
+
+        m.d.comb += [
+            pc_4.eq(id_ex.pc + 4),
+            alu.in1.eq(Mux(rs1_en, ex_rs1, id_ex.pc)),
+            alu.in2.eq(Mux(rs2_en, ex_rs2, id_ex.imm)),
+            branch.funct3.eq(id_ex.funct3),
+            branch.in1.eq(ex_rs1),
+            branch.in2.eq(ex_rs2),
+            store.funct3.eq(id_ex.funct3),
+            store.address.eq(alu.out[:2]),
+            store.value_in.eq(ex_rs2),
+            store.load.eq(0),
+            trap.eq(id_ex.trap | pc_next_temp[0] | pc_next_temp[1] |
+                    (id_ex.mem_op_en & store.trap) | csr_trap),
+            pc_next.eq(Mux(trap, id_ex.pc, pc_next_temp)),
+            stall.eq(mem_stall | ex_stall),
+        ]
+
+        # Multiplies and divides that take more than a cycle hold EX and let
+        # bubbles into MEM.
+        if muldiv is not None:
+            m.d.comb += [
+                muldiv.funct3.eq(id_ex.funct3),
+                muldiv.in1.eq(ex_rs1),
+                muldiv.in2.eq(ex_rs2),
+                muldiv.en.eq(id_ex.valid & ~id_ex.trap & id_ex.muldiv_op_en),
+                muldiv.ack.eq(~mem_stall),
+                ex_stall.eq(muldiv.en & ~muldiv.ready),
+            ]
+
+        # CSRs are accessed in EX. An instruction leaving EX without a trap is
+        # certain to retire, so minstret counts it there already.
+        if csr is not None:
+            m.d.comb += [
+                csr.funct3.eq(id_ex.funct3),
+                csr.addr.eq(id_ex.imm[:12]),
+                csr.rs1.eq(id_ex.insn[15:20]),
+                csr.in1.eq(ex_rs1),
+                csr_trap.eq(id_ex.csr_op_en & csr.illegal),
+                csr.en.eq(id_ex.valid & ~stall & ~trap & id_ex.csr_op_en),
+                csr.retire.eq(id_ex.valid & ~stall & ~trap),
+                csr.events[Event.FETCH_STALL].eq(~if_id.valid & ~stall),
+                csr.events[Event.MEM_STALL].eq(mem_stall),
+                csr.events[Event.BRANCH_TAKEN].eq(id_ex.valid & ~stall & ~trap &
+                                                  (id_ex.pc_op == PcOp.BRANCH) & branch.out),
+                csr.events[Event.TRAP].eq(id_ex.valid & ~stall & trap),
+            ]
+
+        with m.Switch(id_ex.pc_op):
+            with m.Case(PcOp.NEXT):
+                m.d.comb += [
+                    alu.funct4.eq(Cat(id_ex.funct1, id_ex.funct3)),
+                    rs1_en.eq(id_ex.rs1_en),
+                    rs2_en.eq(id_ex.rs2_en),
+                    pc_next_temp.eq(pc_4),
+                    result.eq(alu.out),
+                ]
+                with m.If(id_ex.mem_op_en):
+                    m.d.comb += [
+                        alu.funct4.eq(0),
+                        rs2_en.eq(0),
+                    ]
+                if muldiv is not None:
+                    with m.If(id_ex.muldiv_op_en):
+                        m.d.comb += result.eq(muldiv.out)
+                if csr is not None:
+                    with m.If(id_ex.csr_op_en):
+                        m.d.comb += result.eq(csr.out)
+            with m.Case(PcOp.JAL):
+                m.d.comb += [
+                    rs1_en.eq(0),
+                    rs2_en.eq(0),
+                    pc_next_temp.eq(alu.out),
+                    result.eq(pc_4),
+                ]
+            with m.Case(PcOp.JALR):
+                m.d.comb += [
+                    rs1_en.eq(1),
+                    rs2_en.eq(0),
+                    pc_next_temp.eq(alu.out),
+                    result.eq(pc_4),
+                ]
+            with m.Case(PcOp.BRANCH):
+                m.d.comb += [
+                    alu.funct4.eq(0),
+                    rs1_en.eq(0),
+                    rs2_en.eq(0),
+                    pc_next_temp.eq(Mux(branch.out, alu.out, pc_4)),
+                ]
+
+        # Fetch followed the predicted pc, anything else is a redirect.
+        # Traps redirect to the trapping instruction, like the FSM core.
+        m.d.comb += [
+            redirect.eq(id_ex.valid & ~stall & (pc_next != id_ex.pred)),
+            redirect_pc.eq(pc_next),
+        ]
+
+        if predictor is not None:
+            update = Signal()
+            m.d.comb += [
+                update.eq(id_ex.valid & ~stall & ~trap & (id_ex.pc_op != PcOp.NEXT)),
+                predictor.update.eq(update),
+                predictor.update_pc.eq(id_ex.pc),
+                predictor.update_branch.eq(id_ex.pc_op == PcOp.BRANCH),
+                predictor.update_taken.eq(pc_next != pc_4),
+                predictor.update_target.eq(pc_next),
+            ]
+            if hasattr(self, 'bp'):
+                with m.If(update & redirect):
+                    m.d.sync += self.bp.misses.eq(self.bp.misses + 1)
+                with m.If(update & ~redirect):
+                    m.d.sync += self.bp.hits.eq(self.bp.hits + 1)
+
+        with m.If(~mem_stall):
+            m.d.sync += [
+                ex_mem.valid.eq(id_ex.valid & ~ex_stall),
+                ex_mem.trap.eq(trap),
+                ex_mem.pc.eq(id_ex.pc),
+                ex_mem.pc_next.eq(pc_next),
+                ex_mem.insn.eq(id_ex.insn),
+                ex_mem.rs1.eq(id_ex.rs1),
+                ex_mem.rs1_data.eq(ex_rs1),
+                ex_mem.rs2.eq(id_ex.rs2),
+                ex_mem.rs2_data.eq(ex_rs2),
+                ex_mem.rd.eq(id_ex.rd),
+                ex_mem.result.eq(result),
+                ex_mem.mem_op_en.eq(id_ex.mem_op_en),
+                ex_mem.mem_op_store.eq(id_ex.mem_op_store),
+                ex_mem.fence_op_en.eq(id_ex.fence_op_en),
+                ex_mem.funct3.eq(id_ex.funct3),
+                ex_mem.mem_addr.eq(alu.out),
+                ex_mem.sel.eq(store.sel),
+                ex_mem.dat_w.eq(store.value_out),
+            ]
+
+        # MEM: hold the whole pipeline until the data bus acknowledges, or
+        # until the data cache is done with the flush of a fence. The flush
+        # is requested once, the cache raises busy the cycle after.
+        mem_load = Signal()
+        mem_req = Signal()
+        mem_result = Signal(32)
+        fence_req = Signal()
+        flushed = Signal()
+
+        m.d.comb += [
+            mem_load.eq(ex_mem.mem_op_en & ~ex_mem.mem_op_store),
+            mem_req.eq(ex_mem.valid & ~ex_mem.trap & ex_mem.mem_op_en),
+            self.dbus.we.eq(mem_req & ex_mem.mem_op_store),
+            self.dbus.adr.eq(ex_mem.mem_addr[2:]),
+            self.dbus.sel.eq(ex_mem.sel),
+            self.dbus.dat_w.eq(ex_mem.dat_w),
+            fence_req.eq(ex_mem.valid & ~ex_mem.trap & ex_mem.fence_op_en),
+            self.flush.eq(fence_req & ~flushed),
+            mem_stall.eq(mem_req & ~self.dbus.ack | fence_req & (~flushed | self.flush_busy)),
+            load.funct3.eq(ex_mem.funct3),
+            load.address.eq(ex_mem.mem_addr[:2]),
+            load.value_in.eq(self.dbus.dat_r),
+            load.load.eq(1),
+            mem_result.eq(Mux(mem_load, load.value_out, ex_mem.result)),
+        ]
+        bus_request(m, self.dbus, mem_req, self.pipelined_bus)
+        m.d.sync += flushed.eq(fence_req & mem_stall)
+
+        m.d.sync += [
+            mem_wb.valid.eq(ex_mem.valid & ~mem_stall),
+            mem_wb.trap.eq(ex_mem.trap),
+            mem_wb.pc.eq(ex_mem.pc),
+            mem_wb.pc_next.eq(ex_mem.pc_next),
+            mem_wb.insn.eq(ex_mem.insn),
+            mem_wb.rs1.eq(ex_mem.rs1),
+            mem_wb.rs1_data.eq(ex_mem.rs1_data),
+            mem_wb.rs2.eq(ex_mem.rs2),
+            mem_wb.rs2_data.eq(ex_mem.rs2_data),
+            mem_wb.rd.eq(ex_mem.rd),
+            mem_wb.result.eq(mem_result),
+            mem_wb.mem_op_en.eq(ex_mem.mem_op_en),
+            mem_wb.mem_op_store.eq(ex_mem.mem_op_store),
+            mem_wb.mem_addr.eq(ex_mem.mem_addr),
+            mem_wb.sel.eq(ex_mem.sel),
+            mem_wb.dat_r.eq(self.dbus.dat_r),
+            mem_wb.dat_w.eq(ex_mem.dat_w),
+        ]
+
+        # WB
+        m.d.comb += [
+            regs.rd_addr.eq(mem_wb.rd),
+            regs.rd_data.eq(mem_wb.result),
+            regs.rd_we.eq(mem_wb.valid & ~mem_wb.trap),
+        ]
+
+        if hasattr(self, 'rvfi'):
+            mem_read = Signal()
+            mem_write = Signal()
+            m.d.comb += [
+                mem_read.eq(mem_wb.mem_op_en & ~mem_wb.mem_op_store),
+                mem_write.eq(mem_wb.mem_op_en & mem_wb.mem_op_store),
+
+                self.rvfi.halt.eq(0),
+                self.rvfi.mode.eq(Const(3)), # M-mode
+                self.rvfi.ixl.eq(Const(1)), # XLEN=32
+                self.rvfi.intr.eq(0),
+                self.rvfi.valid.eq(mem_wb.valid & ~mem_wb.trap),
+                self.rvfi.trap.eq(mem_wb.valid & mem_wb.trap),
+
+                self.rvfi.pc_rdata.eq(mem_wb.pc),
+                self.rvfi.pc_wdata.eq(mem_wb.pc_next),
+                self.rvfi.insn.eq(mem_wb.insn),
+                self.rvfi.rs1_addr.eq(mem_wb.rs1),
+                self.rvfi.rs1_rdata.eq(mem_wb.rs1_data),
+                self.rvfi.rs2_addr.eq(mem_wb.rs2),
+                self.rvfi.rs2_rdata.eq(mem_wb.rs2_data),
+                self.rvfi.rd_addr.eq(mem_wb.rd),
+                self.rvfi.rd_wdata.eq(Mux(mem_wb.rd != 0, mem_wb.result, 0)),
+
+                # Memory Access
+                self.rvfi.mem_addr.eq(Mux(mem_wb.mem_op_en, Cat(0, 0, mem_wb.mem_addr[2:]), 0)),
+                self.rvfi.mem_rmask.eq(Mux(mem_read, mem_wb.sel, 0)),
+                self.rvfi.mem_wmask.eq(Mux(mem_write, mem_wb.sel, 0)),
+                self.rvfi.mem_rdata.eq(Mux(mem_read, mem_wb.dat_r, 0)),
+                self.rvfi.mem_wdata.eq(Mux(mem_write, mem_wb.dat_w, 0)),
+            ]
+            with m.If(self.rvfi.valid):
+                m.d.sync += self.rvfi.order.eq(self.rvfi.order + 1)
+
+        return m
+
+
+def forward(m, rs, data, ex_mem, mem_wb, out):
+    # Loads in MEM never match here, load_use keeps their consumers in ID.
+    with m.If((rs != 0) & ex_mem.valid & ~ex_mem.trap & (ex_mem.rd == rs)):
+        m.d.comb += out.eq(ex_mem.result)
+    with m.Elif((rs != 0) & mem_wb.valid & ~mem_wb.trap & (mem_wb.rd == rs)):
+        m.d.comb += out.eq(mem_wb.result)
+    with m.Else():
+        m.d.comb += out.eq(data)
+
+
+def test_pipeline(prog, expected, predictor=None, pipelined_bus=False, mem_latency=1,
+                  with_csr=False):
+    from .core import Top
+
+    dut = Top(prog, with_rvfi=True, pipeline=True, predictor=predictor, pipelined_bus=pipelined_bus,
+              mem_latency=mem_latency, with_csr=with_csr)
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    rvfi = dut.cpu.rvfi
+    def proc():
+        clock = 0
+        retired = []
+        while len(retired) < len(expected) and clock < 100:
+            yield Tick()
+            yield Settle()
+            clock += 1
+            assert(not (yield rvfi.trap))
+            if (yield rvfi.valid):
+                retired.append(((yield rvfi.pc_rdata),
+                                (yield rvfi.rd_addr),
+                                (yield rvfi.rd_wdata)))
+        if retired != expected:
+            raise ValueError('expected %s but got %s' % (expected, retired))
+        print('ok: %d instructions in %d cycles' % (len(retired), clock))
+
+    sim.add_clock(1e-6, domain='sync')
+    sim.add_sync_process(proc)
+    with trace(sim, fragment, 'pipeline'):
+        sim.run()
+
+def test():
+    from .predictor import StaticPredictor, BHTPredictor, BTBPredictor
+
+    prog = [
+        0xdead_c0b7, # lui   x1, 0xdeadc
+        0xeef0_8093, # addi  x1, x1,-273
+        0x8000_4197, # auipc x3,0x80004
+        0xfe11_ac23, # sw    x1,-8(x3) # 0x4000
+        0x8000_4117, # auipc x2,0x80004
+        0xff01_2103, # lw    x2,-16(x2) # 0x4000
+        0x0011_0463, # beq   x2,x1,80000020
+        0x0000_0073, # ecall
+        0x0000_0013, # addi x0,x0,0
+    ]
+
+    # (pc, rd, rd_wdata) of every retired instruction
+    expected = [
+        (0x8000_0000, 1, 0xdeadc000),
+        (0x8000_0004, 1, 0xdeadbeef),
+        (0x8000_0008, 3, 0x0000_4008),
+        (0x8000_000c, 0, 0),
+        (0x8000_0010, 2, 0x0000_4010),
+        (0x8000_0014, 2, 0xdeadbeef),
+        (0x8000_0018, 0, 0),
+        (0x8000_0020, 0, 0),
+    ]
+
+    test_pipeline(prog, expected)
+    test_pipeline(prog, expected, StaticPredictor())
+    test_pipeline(prog, expected, BHTPredictor())
+    test_pipeline(prog, expected, BTBPredictor())
+    test_pipeline(prog, expected, pipelined_bus=True)
+    test_pipeline(prog, expected, BTBPredictor(), pipelined_bus=True)
+    test_pipeline(prog, expected, mem_latency=0)
+
+    prog = [
+        0x0010_0093, # addi  x1, x0, 1
+        0x0000_0463, # beq   x0, x0, 80000008
+        0x0000_0073, # ecall
+        0xb020_2173, # csrrs x2, minstret, x0
+        0xb050_21f3, # csrrs x3, mhpmcounter5, x0 # taken branches
+    ]
+    expected = [
+        (0x8000_0000, 1, 1),
+        (0x8000_0004, 0, 0),
+        (0x8000_000c, 2, 2),
+        (0x8000_0010, 3, 1),
+    ]
+    test_pipeline(prog, expected, with_csr=True)
+
+if __name__ == '__main__':
+    test()
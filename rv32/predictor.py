@@ -0,0 +1,145 @@
+from math import ceil, log2
+from nmigen import *
+from nmigen.sim import *
+from .trace import trace
+
+
+class Predictor(Elaboratable):
+    def __init__(self):
+        # Fetch: predict the next fetch address from the pc alone
+        self.fetch_pc = Signal(32)
+        self.fetch_hit = Signal()
+        self.fetch_target = Signal(32)
+
+        # Decode: predict the direction of a conditional branch
+        self.pc = Signal(32)
+        self.imm = Signal(32)
+        self.taken = Signal()
+
+        # Execute: train on the resolved control transfer
+        self.update = Signal()
+        self.update_pc = Signal(32)
+        self.update_branch = Signal()
+        self.update_taken = Signal()
+        self.update_target = Signal(32)
+
+
+class StaticPredictor(Predictor):
+    # Backward taken, forward not taken
+    def elaborate(self, platform):
+        m = Module()
+        m.d.comb += self.taken.eq(self.imm[31])
+        return m
+
+
+class BHTPredictor(Predictor):
+    def __init__(self, entries=64):
+        super().__init__()
+        self.entries = entries
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # 2-bit saturating counters, reset to weakly not taken
+        bht = Memory(width = 2, depth = self.entries, init = [0b01] * self.entries)
+        r = m.submodules.r = bht.read_port(domain = "comb")
+        u = m.submodules.u = bht.read_port(domain = "comb")
+        w = m.submodules.w = bht.write_port()
+
+        index_bits = ceil(log2(self.entries))
+        m.d.comb += [
+            r.addr.eq(self.pc[2:2 + index_bits]),
+            self.taken.eq(r.data[1]),
+            u.addr.eq(self.update_pc[2:2 + index_bits]),
+            w.addr.eq(u.addr),
+            w.en.eq(self.update & self.update_branch),
+            w.data.eq(u.data),
+        ]
+        with m.If(self.update_taken & (u.data != 0b11)):
+            m.d.comb += w.data.eq(u.data + 1)
+        with m.If(~self.update_taken & (u.data != 0b00)):
+            m.d.comb += w.data.eq(u.data - 1)
+
+        return m
+
+
+class BTBPredictor(Predictor):
+    def __init__(self, entries=8):
+        super().__init__()
+        self.entries = entries
+
+    def elaborate(self, platform):
+        m = Module()
+
+        index_bits = ceil(log2(self.entries))
+        tag_bits = 30 - index_bits
+
+        # Direct mapped: valid, tag, target[2:]
+        btb = Memory(width = 1 + tag_bits + 30, depth = self.entries)
+        r = m.submodules.r = btb.read_port(domain = "comb")
+        w = m.submodules.w = btb.write_port()
+
+        fetch_index = self.fetch_pc[2:2 + index_bits]
+        fetch_tag = self.fetch_pc[2 + index_bits:]
+        update_index = self.update_pc[2:2 + index_bits]
+        update_tag = self.update_pc[2 + index_bits:]
+
+        m.d.comb += [
+            r.addr.eq(fetch_index),
+            self.fetch_hit.eq(r.data[0] & (r.data[1:1 + tag_bits] == fetch_tag)),
+            self.fetch_target.eq(Cat(Const(0, 2), r.data[1 + tag_bits:])),
+
+            # Taken transfers are allocated, not taken branches are evicted
+            w.addr.eq(update_index),
+            w.en.eq(self.update),
+            w.data.eq(Cat(self.update_taken, update_tag, self.update_target[2:])),
+
+            # Branches missing in the BTB fall back to backward taken
+            self.taken.eq(self.imm[31]),
+        ]
+
+        return m
+
+
+def test_predictor(dut, updates, pc, imm, taken):
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+
+    def proc():
+        for update_pc, update_taken in updates:
+            yield dut.update.eq(1)
+            yield dut.update_branch.eq(1)
+            yield dut.update_pc.eq(update_pc)
+            yield dut.update_taken.eq(update_taken)
+            yield dut.update_target.eq(update_pc + imm)
+            yield Tick()
+        yield dut.update.eq(0)
+        yield dut.pc.eq(pc)
+        yield dut.imm.eq(imm)
+        yield dut.fetch_pc.eq(pc)
+        yield Settle()
+        out = yield dut.taken | dut.fetch_hit
+        if out != taken:
+            raise ValueError('expected %s but got %s' % (taken, out))
+
+    if updates:
+        sim.add_clock(1e-6)
+    sim.add_process(proc)
+    with trace(sim, fragment, 'predictor'):
+        sim.run()
+
+def test():
+    test_predictor(StaticPredictor(), [], 0x100, -8, 1)
+    test_predictor(StaticPredictor(), [], 0x100, 8, 0)
+    test_predictor(BHTPredictor(), [], 0x100, 8, 0)
+    test_predictor(BHTPredictor(), [(0x100, 1)], 0x100, 8, 1)
+    test_predictor(BHTPredictor(), [(0x100, 1), (0x100, 0)], 0x100, -8, 0)
+    test_predictor(BHTPredictor(), [(0x100, 1), (0x104, 0)], 0x100, 8, 1)
+    test_predictor(BTBPredictor(), [], 0x100, 8, 0)
+    test_predictor(BTBPredictor(), [(0x100, 1)], 0x100, 8, 1)
+    test_predictor(BTBPredictor(), [(0x100, 1), (0x100, 0)], 0x100, 8, 0)
+    test_predictor(BTBPredictor(), [(0x100, 1)], 0x120, 8, 0)
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,205 @@
+from nmigen import *
+from nmigen.hdl.rec import *
+from nmigen.sim import *
+from .bus import bus_started
+from .layouts import wishbone_layout
+from .trace import trace
+
+
+class Prefetch(Elaboratable):
+    def __init__(self, reset_address=0x8000_0000, depth=2, pipelined=False):
+        if depth not in range(1, 5):
+            raise ValueError('expected a depth of 1 to 4 but got %s' % depth)
+        self.reset_address = reset_address
+        self.depth = depth
+        self.pipelined = pipelined
+
+        self.ibus = Record(wishbone_layout)
+
+        # Head of the queue
+        self.valid = Signal()
+        self.ready = Signal()
+        self.inst = Signal(32)
+        self.pc = Signal(32, reset=reset_address)
+
+        # Discard the queue and restart fetching at flush_pc
+        self.flush = Signal()
+        self.flush_pc = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        entries = Array(Signal(32, name='entry%d' % i) for i in range(self.depth))
+        rd_ptr = Signal(range(self.depth))
+        wr_ptr = Signal(range(self.depth))
+        level = Signal(range(self.depth + 1))
+
+        fetch_pc = Signal(32, reset=self.reset_address)
+        req_pc = Signal(32)
+        busy = Signal()
+        kill = Signal()
+        issue = Signal()
+        push = Signal()
+        pop = Signal()
+
+        m.d.comb += [
+            pop.eq(self.valid & self.ready),
+            self.valid.eq(level != 0),
+            self.inst.eq(entries[rd_ptr]),
+        ]
+
+        if self.pipelined:
+            # Every request in flight has an entry reserved for its response.
+            # A stalled request stays on the bus unchanged until accepted.
+            pending = Signal(range(self.depth + 1))
+            dropping = Signal(range(self.depth + 1))
+            accept = Signal()
+            m.d.comb += [
+                self.ibus.cyc.eq(self.ibus.stb | (pending != 0)),
+                self.ibus.stb.eq(busy | ((level + pending != self.depth) & bus_started(m))),
+                self.ibus.adr.eq(Mux(busy, req_pc, fetch_pc)[2:]),
+                accept.eq(self.ibus.stb & ~self.ibus.stall),
+                push.eq(self.ibus.ack & (dropping == 0)),
+            ]
+            with m.If(self.ibus.stb & ~busy):
+                m.d.sync += [
+                    req_pc.eq(fetch_pc),
+                    fetch_pc.eq(fetch_pc + 4),
+                ]
+            m.d.sync += [
+                busy.eq(self.ibus.stb & self.ibus.stall),
+                pending.eq(pending + accept - self.ibus.ack),
+            ]
+            with m.If(self.ibus.ack & (dropping != 0)):
+                m.d.sync += dropping.eq(dropping - 1)
+        else:
+            m.d.comb += [
+                issue.eq(~busy & (level != self.depth)),
+                self.ibus.cyc.eq(1),
+                self.ibus.stb.eq(busy | issue),
+                self.ibus.adr.eq(Mux(busy, req_pc, fetch_pc)[2:]),
+                push.eq(self.ibus.stb & self.ibus.ack & ~kill),
+            ]
+            with m.If(issue):
+                m.d.sync += [
+                    req_pc.eq(fetch_pc),
+                    fetch_pc.eq(fetch_pc + 4),
+                ]
+            with m.If(self.ibus.stb):
+                m.d.sync += busy.eq(~self.ibus.ack)
+            with m.If(self.ibus.ack):
+                m.d.sync += kill.eq(0)
+
+        with m.If(push):
+            m.d.sync += [
+                entries[wr_ptr].eq(self.ibus.dat_r),
+                wr_ptr.eq(Mux(wr_ptr == self.depth - 1, 0, wr_ptr + 1)),
+            ]
+        with m.If(pop):
+            m.d.sync += [
+                rd_ptr.eq(Mux(rd_ptr == self.depth - 1, 0, rd_ptr + 1)),
+                self.pc.eq(self.pc + 4),
+            ]
+        with m.If(push & ~pop):
+            m.d.sync += level.eq(level + 1)
+        with m.If(~push & pop):
+            m.d.sync += level.eq(level - 1)
+
+        # A request can't be withdrawn once it is on the bus, so a flush lets
+        # it finish and drops the response.
+        with m.If(self.flush):
+            m.d.sync += [
+                rd_ptr.eq(0),
+                wr_ptr.eq(0),
+                level.eq(0),
+                fetch_pc.eq(self.flush_pc),
+                self.pc.eq(self.flush_pc),
+            ]
+            if self.pipelined:
+                m.d.sync += dropping.eq(pending + accept - self.ibus.ack +
+                                        (self.ibus.stb & self.ibus.stall))
+            else:
+                m.d.sync += kill.eq(self.ibus.stb & ~self.ibus.ack)
+
+        return m
+
+
+def test_prefetch(depth, latency, flush_at=None, flush_pc=0, pipelined=False):
+    dut = Prefetch(reset_address=0, depth=depth, pipelined=pipelined)
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    fetched = []
+
+    def memory():
+        yield Passive()
+        while True:
+            yield Settle()
+            if (yield dut.ibus.stb):
+                for _ in range(latency):
+                    yield Tick()
+                # Each word holds its own byte address
+                yield dut.ibus.dat_r.eq((yield dut.ibus.adr) << 2)
+                yield dut.ibus.ack.eq(1)
+                yield Tick()
+                yield dut.ibus.ack.eq(0)
+            else:
+                yield Tick()
+
+    def pipelined_memory():
+        yield Passive()
+        responses = []
+        clock = 0
+        while True:
+            # Stall now and then once requests are slow anyway
+            stall = latency > 1 and clock % 3 == 0
+            yield dut.ibus.stall.eq(stall)
+            yield Settle()
+            if (yield dut.ibus.stb) and not stall:
+                responses.append((clock + 1 + latency, (yield dut.ibus.adr) << 2))
+            yield Tick()
+            clock += 1
+            if responses and responses[0][0] <= clock:
+                yield dut.ibus.dat_r.eq(responses.pop(0)[1])
+                yield dut.ibus.ack.eq(1)
+            else:
+                yield dut.ibus.ack.eq(0)
+
+    def proc():
+        clock = 0
+        yield dut.ready.eq(1)
+        while len(fetched) < 8:
+            yield Settle()
+            if clock == flush_at:
+                yield dut.flush.eq(1)
+                yield dut.flush_pc.eq(flush_pc)
+            elif (yield dut.valid):
+                pc = yield dut.pc
+                inst = yield dut.inst
+                if pc != inst:
+                    raise ValueError('expected %s but got %s' % (pc, inst))
+                fetched.append(pc)
+            yield Tick()
+            yield dut.flush.eq(0)
+            clock += 1
+
+    sim.add_clock(1e-6)
+    sim.add_process(pipelined_memory if pipelined else memory)
+    sim.add_sync_process(proc)
+    with trace(sim, fragment, 'prefetch'):
+        sim.run()
+    return fetched
+
+def test():
+    for pipelined in (False, True):
+        for depth in range(1, 5):
+            for latency in range(3):
+                fetched = test_prefetch(depth, latency, pipelined=pipelined)
+                assert(fetched == [4 * i for i in range(8)])
+                for flush_at in (2, 4):
+                    fetched = test_prefetch(depth, latency, flush_at, 0x100, pipelined)
+                    i = fetched.index(0x100)
+                    assert(fetched == [4 * k for k in range(i)] + [0x100 + 4 * k for k in range(8 - i)])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
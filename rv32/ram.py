@@ -3,40 +3,109 @@ from nmigen import *
 from nmigen.sim import *
 from nmigen_soc.memory import *
 from nmigen_soc.wishbone import *
+from .trace import trace
 
-class RAM(Elaboratable, Interface):
-    def __init__(self, depth):
-        self.depth = depth
-        self.data = Memory(width = 32, depth = depth)
-        self.r = self.data.read_port()
-        self.w = self.data.write_port()
+# An iCE40UP SB_SPRAM256KA holds 16K halfwords, a pair of them side by side
+# makes a bank of 16K words, and the UP5K has room for two banks.
+SPRAM_ADDR_WIDTH = 14
+SPRAM_DEPTH = 1 << SPRAM_ADDR_WIDTH
+SPRAM_BANKS = 2
 
-        Interface.__init__(self, data_width = 32, addr_width = ceil(log2(self.depth)))
-        self.memory_map = MemoryMap(data_width = self.data_width,
-                                    addr_width = self.addr_width,
+class RAM(Elaboratable, Interface):
+    def __init__(self, depth, pipelined=False, latency=1, init=None, spram=False):
+        Interface.__init__(self, data_width = 32, granularity = 8,
+                           addr_width = ceil(log2(depth)),
+                           features = {"stall"} if pipelined else frozenset())
+        self.memory_map = MemoryMap(data_width = 8,
+                                    addr_width = self.addr_width + 2,
                                     alignment = 0)
+        if latency not in (0, 1):
+            raise ValueError('expected a latency of 0 or 1 but got %s' % latency)
+        if pipelined and latency == 0:
+            raise ValueError('pipelined cycles need a latency of 1')
+        if spram:
+            if depth % SPRAM_DEPTH or not 0 < depth <= SPRAM_DEPTH * SPRAM_BANKS:
+                raise ValueError('expected a multiple of %d words up to %d but got %d'
+                                 % (SPRAM_DEPTH, SPRAM_DEPTH * SPRAM_BANKS, depth))
+            if latency == 0:
+                raise ValueError('the spram has a read latency of 1')
+            if init:
+                raise ValueError('the spram can\'t be initialized')
+        self.pipelined = pipelined
+        self.latency = latency
+        self.depth = depth
+        self.spram = spram
+        if not spram:
+            self.data = Memory(width = 32, depth = depth, init = init)
+            # See ROM, an asynchronous read port trades fmax for a cycle per load
+            self.r = self.data.read_port(domain = "sync" if latency else "comb")
+            self.w = self.data.write_port(granularity = 8)
 
     def elaborate(self, platform):
         m = Module()
-        m.submodules.r = self.r
-        m.submodules.w = self.w
-        m.d.sync += self.ack.eq(0)
-        with m.If(self.cyc):
-            m.d.sync += self.ack.eq(self.stb)
-        m.d.comb += [
-            self.r.addr.eq(self.adr),
-            self.w.addr.eq(self.adr),
-            self.dat_r.eq(self.r.data),
-            self.w.data.eq(self.dat_w),
-            self.w.en.eq(self.we),
-        ]
+        # One write enable per byte lane, so sb and sh leave the other bytes alone
+        we = Signal(4)
+        m.d.comb += we.eq(Repl(self.cyc & self.stb & self.we, 4) & self.sel)
+        if self.spram:
+            self.elaborate_spram(m, we)
+        else:
+            m.submodules.r = self.r
+            m.submodules.w = self.w
+            m.d.comb += [
+                self.r.addr.eq(self.adr),
+                self.w.addr.eq(self.adr),
+                self.dat_r.eq(self.r.data),
+                self.w.data.eq(self.dat_w),
+                self.w.en.eq(we),
+            ]
+        if self.pipelined:
+            # Every request is accepted right away and answered a cycle later,
+            # so a write may only happen on the cycle it is issued.
+            m.d.comb += self.stall.eq(0)
+            m.d.sync += self.ack.eq(self.cyc & self.stb)
+        elif self.latency == 0:
+            m.d.comb += self.ack.eq(self.cyc & self.stb)
+        else:
+            m.d.sync += self.ack.eq(0)
+            with m.If(self.cyc):
+                m.d.sync += self.ack.eq(self.stb & ~self.ack)
         return m
 
+    def elaborate_spram(self, m, we):
+        banks = self.depth // SPRAM_DEPTH
+        address = self.adr[:SPRAM_ADDR_WIDTH]
+        bank = self.adr[SPRAM_ADDR_WIDTH:]
+        # The read data shows up a cycle later, so does the bank it's from
+        read_bank = Signal.like(bank)
+        m.d.sync += read_bank.eq(bank)
+        dat_r = Array(Signal(32, name='bank%d_dat_r' % i) for i in range(banks))
+        m.d.comb += self.dat_r.eq(dat_r[read_bank])
+        for i in range(banks):
+            for half in range(2):
+                lanes = we[2 * half:2 * half + 2] & Repl(bank == i, 2)
+                m.submodules['spram%d_%d' % (i, half)] = Instance("SB_SPRAM256KA",
+                    i_ADDRESS = address,
+                    i_DATAIN = self.dat_w[16 * half:16 * half + 16],
+                    # The write mask is per nibble
+                    i_MASKWREN = Cat(lanes[0], lanes[0], lanes[1], lanes[1]),
+                    i_WREN = lanes.any(),
+                    i_CHIPSELECT = 1,
+                    i_CLOCK = ClockSignal(),
+                    i_STANDBY = 0,
+                    i_SLEEP = 0,
+                    i_POWEROFF = 1,
+                    o_DATAOUT = dat_r[i][16 * half:16 * half + 16],
+                )
+
 def wishbone_cycle(ram):
     yield ram.stb.eq(1)
+    yield Settle()
     while (yield ram.ack) == 0:
         yield Tick()
         yield Settle()
+    if ram.latency == 0:
+        # The cycle ends on the clock edge that samples the ack
+        yield Tick()
     yield ram.stb.eq(0)
     yield Tick()
     yield Settle()
@@ -48,23 +117,45 @@ def ram_read_ut(ram, address, expected):
     yield from wishbone_cycle(ram)
     assert_mem(address, expected, (yield ram.dat_r))
 
-def ram_write_ut(ram, address, value):
+def ram_write_ut(ram, address, value, sel=0b1111):
     yield ram.adr.eq(address)
     yield ram.dat_w.eq(value)
+    yield ram.sel.eq(sel)
     yield ram.we.eq(1)
     yield from wishbone_cycle(ram)
 
+def ram_pipelined_ut(ram, values):
+    # A request every cycle, each one is acknowledged on the next
+    yield ram.stb.eq(1)
+    yield ram.we.eq(1)
+    yield ram.sel.eq(0b1111)
+    for address, value in enumerate(values):
+        yield ram.adr.eq(address)
+        yield ram.dat_w.eq(value)
+        yield Tick()
+        yield Settle()
+        assert((yield ram.ack))
+    yield ram.we.eq(0)
+    for address, value in enumerate(values):
+        yield ram.adr.eq(address)
+        yield Tick()
+        yield Settle()
+        assert((yield ram.ack))
+        assert_mem(address, value, (yield ram.dat_r))
+    yield ram.stb.eq(0)
+
 def assert_mem(address, expected, actual):
     if expected == actual:
         print("PASS: Memory[0x%04X] = 0x%08X" % (address, expected))
     else:
-        print("FAIL: Memory[0x%04X] = 0x%08X (got: 0x%08X)" % (address, expected, actual))
+        raise ValueError("FAIL: Memory[0x%04X] = 0x%08X (got: 0x%08X)" % (address, expected, actual))
 
 
-if __name__ == "__main__":
-    dut = RAM(32)
-    sim = Simulator(dut)
-    with sim.write_vcd('vcd/ram.vcd'):
+def test():
+    for latency in (1, 0):
+        dut = RAM(32, latency=latency)
+        fragment = Fragment.get(dut, None)
+        sim = Simulator(fragment)
         def proc():
             yield dut.cyc.eq(1)
             yield from ram_write_ut(dut, 0, 0x01234567)
@@ -73,6 +164,49 @@ if __name__ == "__main__":
             yield from ram_read_ut(dut, 0, 0x01234567)
             yield from ram_write_ut(dut, 2, 0x01234567)
             yield from ram_read_ut(dut, 1, 0x89ABCDEF)
+            # sb and sh only write their lanes
+            yield from ram_write_ut(dut, 1, 0x0000_5500, sel=0b0010)
+            yield from ram_read_ut(dut, 1, 0x89AB55EF)
+            yield from ram_write_ut(dut, 1, 0x7777_0000, sel=0b1100)
+            yield from ram_read_ut(dut, 1, 0x777755EF)
+            # Nothing is written outside of a cycle
+            yield dut.we.eq(1)
+            yield dut.dat_w.eq(0)
+            yield Tick()
+            yield dut.cyc.eq(0)
+            yield dut.stb.eq(1)
+            yield Tick()
+            yield dut.cyc.eq(1)
+            yield dut.stb.eq(0)
+            yield from ram_read_ut(dut, 1, 0x777755EF)
         sim.add_clock(1e-6)
         sim.add_sync_process(proc)
+        with trace(sim, fragment, 'ram'):
+            sim.run()
+
+    dut = RAM(32, pipelined=True)
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    def proc():
+        yield dut.cyc.eq(1)
+        yield from ram_pipelined_ut(dut, [0x01234567, 0x89ABCDEF, 0x0C0FFEE0])
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    with trace(sim, fragment, 'ram_pipelined'):
         sim.run()
+
+    # The spram can't be simulated, only its banks are checked
+    fragment = Fragment.get(RAM(2 * SPRAM_DEPTH, spram=True), None)
+    assert(sorted(name for sub, name in fragment.subfragments) ==
+           ['spram0_0', 'spram0_1', 'spram1_0', 'spram1_1'])
+    for depth, kwargs in [(SPRAM_DEPTH + 1, {}), (SPRAM_DEPTH, {'latency': 0}),
+                          (SPRAM_DEPTH, {'init': [1]})]:
+        try:
+            RAM(depth, spram=True, **kwargs)
+        except ValueError:
+            pass
+        else:
+            raise ValueError('expected %s to be rejected' % kwargs)
+
+if __name__ == "__main__":
+    test()
@@ -1,8 +1,10 @@
 from nmigen import *
 from nmigen.sim import *
+from .trace import trace
 
 class Registers(Elaboratable):
-    def __init__(self):
+    def __init__(self, transparent=True):
+        self.transparent = transparent
         self.rs1_addr = Signal(5)
         self.rs1_data = Signal(32)
         self.rs2_addr = Signal(5)
@@ -14,9 +16,13 @@ class Registers(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
+        # The read ports are synchronous, so the regfile maps to a block ram
+        # per read port. The block rams of the ice40 aren't transparent, a
+        # transparent port costs a comparator and a bypass mux, which cores
+        # that never read a register as it's written can do without.
         regfile = Memory(width = 32, depth = 32)
-        rs1 = m.submodules.rs1 = regfile.read_port()
-        rs2 = m.submodules.rs2 = regfile.read_port()
+        rs1 = m.submodules.rs1 = regfile.read_port(transparent = self.transparent)
+        rs2 = m.submodules.rs2 = regfile.read_port(transparent = self.transparent)
         rd  = m.submodules.rd  = regfile.write_port()
 
         m.d.comb += [
@@ -35,19 +41,24 @@ class Registers(Elaboratable):
 
         return m
 
-def test_regs(reg, data, res):
-    dut = Registers()
-    sim = Simulator(dut)
+def test_regs(writes, transparent=True):
+    # Every write is read back on the next cycle, all in one simulation.
+    # Without transparent reads it takes another cycle.
+    dut = Registers(transparent)
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
 
-    with sim.write_vcd('vcd/regs.vcd'):
-        def proc():
+    def proc():
+        for reg, data, res in writes:
             yield dut.rd_addr.eq(reg)
             yield dut.rd_data.eq(data)
             yield dut.rd_we.eq(1)
-            #yield Tick()
             yield dut.rs1_addr.eq(reg)
             yield dut.rs2_addr.eq(reg)
             yield Tick()
+            if not transparent:
+                yield dut.rd_we.eq(0)
+                yield Tick()
             yield Settle()
             rs1_data = yield dut.rs1_data
             rs2_data = yield dut.rs2_data
@@ -58,11 +69,34 @@ def test_regs(reg, data, res):
 
     sim.add_clock(1e-6)
     sim.add_sync_process(proc)
+    with trace(sim, fragment, 'regs'):
+        sim.run()
+
+def test():
+    # x0 stays zero, a second pass checks the first didn't leak between registers
+    writes = ([(reg, 0xffff_ffff, 0xffff_ffff if reg else 0) for reg in range(32)] +
+              [(reg, reg, reg) for reg in range(32)])
+    test_regs(writes)
+    test_regs(writes, transparent=False)
+
+    # A read on the clock edge of a write returns the old value
+    dut = Registers(transparent=False)
+    sim = Simulator(dut)
+    def proc():
+        yield dut.rd_addr.eq(1)
+        yield dut.rd_data.eq(0x1234)
+        yield dut.rd_we.eq(1)
+        yield dut.rs1_addr.eq(1)
+        yield Tick()
+        yield Settle()
+        assert((yield dut.rs1_data) == 0)
+        yield dut.rd_we.eq(0)
+        yield Tick()
+        yield Settle()
+        assert((yield dut.rs1_data) == 0x1234)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
     sim.run()
 
 if __name__ == '__main__':
-    for reg in range(32):
-        if reg == 0:
-            test_regs(reg, 0xffff_ffff, 0)
-        else:
-            test_regs(reg, 0xffff_ffff, 0xffff_ffff)
+    test()
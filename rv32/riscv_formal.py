@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatchcase
+
+# Runs the checks generated by riscv-formal's genchecks.py with sby. Every
+# check is keyed on the core, the wrapper, checks.cfg and its own .sby file,
+# and a check that passed with the same key isn't run again. The slowest
+# checks of the previous runs are started first and the report is rewritten
+# after every check, so it can be followed while the rest still run.
+
+# checks.cfg for genchecks.py, the isa and the defines follow the core
+CHECKS_CFG = """[options]
+isa {isa}
+
+[depth]
+insn            20
+reg       15    25
+pc_fwd    10    30
+pc_bwd    10    30
+#liveness  1  10 30
+unique    1  10 30
+causal    10    30
+#csrw 30
+#cover 1 15
+
+[sort]
+reg_ch0
+
+[defines]
+{defines}
+[script-sources]
+read_verilog -sv @pwd@/wrapper.sv
+read_verilog @pwd@/rv32.v
+"""
+
+
+def checks_config(with_m=False):
+    # The M extension is checked with the alternative ops of riscv-formal,
+    # which the muldiv unit computes when built with altops
+    defines = ['`define RISCV_FORMAL_ALIGNED_MEM']
+    if with_m:
+        defines.append('`define RISCV_FORMAL_ALTOPS')
+    return CHECKS_CFG.format(isa='rv32im' if with_m else 'rv32i',
+                             defines=''.join(define + '\n' for define in defines))
+
+
+def check_key(sby, sources):
+    hasher = hashlib.sha256()
+    for path in sources + [sby]:
+        with open(path, 'rb') as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def load_report(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_report(path, report):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def run_check(checks_dir, name, command):
+    start = time.perf_counter()
+    result = subprocess.run(command + [name + '.sby'], cwd=checks_dir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    status = 'PASS' if result.returncode == 0 else 'FAIL'
+    # sby leaves PASS, FAIL, ERROR or TIMEOUT in the status file
+    status_file = os.path.join(checks_dir, name, 'status')
+    if os.path.exists(status_file):
+        with open(status_file) as f:
+            words = f.read().split()
+        if words:
+            status = words[0]
+    return status, time.perf_counter() - start
+
+
+def run_checks(checks_dir, sources, report_path, pattern=None, jobs=None,
+               command=('sby', '-f')):
+    # Returns the names of the checks that didn't pass
+    report = load_report(report_path)
+    names = sorted(file[:-len('.sby')] for file in os.listdir(checks_dir) if file.endswith('.sby'))
+    if pattern is not None:
+        names = [name for name in names if fnmatchcase(name, pattern)]
+
+    pending = []
+    for name in names:
+        key = check_key(os.path.join(checks_dir, name + '.sby'), list(sources))
+        previous = report.get(name)
+        if previous is not None and previous['key'] == key and previous['status'] == 'PASS':
+            print('cached %-40s PASS' % name)
+            continue
+        # Checks that never ran go first, they might be the slow ones
+        estimate = previous['time'] if previous is not None else float('inf')
+        pending.append((estimate, name, key))
+    pending.sort(key=lambda check: (-check[0], check[1]))
+
+    failed = []
+    with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+        futures = {pool.submit(run_check, checks_dir, name, list(command)): (name, key)
+                   for estimate, name, key in pending}
+        for future in as_completed(futures):
+            name, key = futures[future]
+            status, seconds = future.result()
+            report[name] = {'key': key, 'status': status, 'time': seconds}
+            write_report(report_path, report)
+            print('%-6s %-40s %8.1fs' % (status, name, seconds), flush=True)
+            if status != 'PASS':
+                failed.append(name)
+    return sorted(failed)
+
+
+def test():
+    import sys
+    import tempfile
+
+    config = checks_config()
+    assert('isa rv32i\n' in config and 'ALTOPS' not in config)
+    config = checks_config(with_m=True)
+    assert('isa rv32im\n' in config and '`define RISCV_FORMAL_ALTOPS\n' in config)
+    assert('`define RISCV_FORMAL_ALIGNED_MEM\n`define' in config)
+
+    # A stand in for sby that passes or fails as the .sby file says
+    fake_sby = """
+import os, sys, time
+name = sys.argv[1][:-len('.sby')]
+with open(sys.argv[1]) as f:
+    status, seconds = f.read().split()
+time.sleep(float(seconds))
+os.makedirs(name, exist_ok=True)
+with open(os.path.join(name, 'status'), 'w') as f:
+    f.write(status + ' 0\\n')
+sys.exit(status != 'PASS')
+"""
+    with tempfile.TemporaryDirectory() as directory:
+        checks = os.path.join(directory, 'checks')
+        os.mkdir(checks)
+        with open(os.path.join(directory, 'sby.py'), 'w') as f:
+            f.write(fake_sby)
+        core = os.path.join(directory, 'rv32.v')
+        with open(core, 'w') as f:
+            f.write('module rv32_cpu; endmodule\n')
+        for name, contents in [('insn_add_ch0', 'PASS 0.2'), ('insn_sub_ch0', 'PASS 0'),
+                               ('reg_ch0', 'FAIL 0')]:
+            with open(os.path.join(checks, name + '.sby'), 'w') as f:
+                f.write(contents)
+        report = os.path.join(directory, 'report.json')
+        command = (sys.executable, os.path.join(directory, 'sby.py'))
+
+        assert(run_checks(checks, [core], report, command=command) == ['reg_ch0'])
+        results = load_report(report)
+        assert(results['insn_add_ch0']['status'] == 'PASS')
+        assert(results['insn_add_ch0']['time'] >= 0.2)
+
+        # Only the failed check runs again ...
+        with open(os.path.join(checks, 'reg_ch0.sby'), 'w') as f:
+            f.write('PASS 0')
+        assert(run_checks(checks, [core], report, command=command) == [])
+        assert(load_report(report)['insn_add_ch0'] == results['insn_add_ch0'])
+
+        # ... until the core changes, and a pattern picks the checks to run
+        with open(core, 'a') as f:
+            f.write('// changed\n')
+        assert(run_checks(checks, [core], report, 'insn_sub_*', command=command) == [])
+        assert(load_report(report)['insn_add_ch0'] == results['insn_add_ch0'])
+        assert(load_report(report)['insn_sub_ch0']['key'] != results['insn_sub_ch0']['key'])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
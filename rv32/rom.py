@@ -3,55 +3,129 @@ from nmigen import *
 from nmigen.sim import *
 from nmigen_soc.memory import *
 from nmigen_soc.wishbone import *
+from .trace import trace
 
 class ROM(Elaboratable, Interface):
-    def __init__(self, data):
+    def __init__(self, data, pipelined=False, latency=1, dual_port=False):
+        if latency not in (0, 1):
+            raise ValueError('expected a latency of 0 or 1 but got %s' % latency)
+        if pipelined and latency == 0:
+            raise ValueError('pipelined cycles need a latency of 1')
+        self.pipelined = pipelined
+        self.latency = latency
         self.size = len(data)
         self.data = Memory(width = 32, depth = self.size, init = data)
-        self.r = self.data.read_port()
+        # Without latency the memory is read asynchronously, which block rams
+        # don't support, so it ends up in logic and lengthens the path from
+        # the address to the core.
+        self.r = self.data.read_port(domain = "sync" if latency else "comb")
 
-        Interface.__init__(self, data_width = 32, addr_width = ceil(log2(self.size)))
-        self.memory_map = MemoryMap(data_width = self.data_width,
-                                    addr_width = self.addr_width,
+        Interface.__init__(self, data_width = 32, granularity = 8,
+                           addr_width = ceil(log2(self.size)),
+                           features = {"stall"} if pipelined else frozenset())
+        self.memory_map = MemoryMap(data_width = 8,
+                                    addr_width = self.addr_width + 2,
                                     alignment = 0)
 
+        # A second port for loads. The block rams have a single read port, so
+        # it's a second copy of the rom.
+        self.port_b = None
+        if dual_port:
+            self.r_b = self.data.read_port(domain = "sync" if latency else "comb")
+            self.port_b = Interface(data_width = 32, granularity = 8,
+                                    addr_width = self.addr_width,
+                                    features = self.features, name = 'port_b')
+            self.port_b.memory_map = MemoryMap(data_width = 8,
+                                               addr_width = self.addr_width + 2,
+                                               alignment = 0)
+
     def elaborate(self, platform):
         m = Module()
         m.submodules.r = self.r
-        m.d.sync += self.ack.eq(0)
-        with m.If(self.cyc):
-            m.d.sync += self.ack.eq(self.stb)
+        self.elaborate_port(m, self, self.r)
+        if self.port_b is not None:
+            m.submodules.r_b = self.r_b
+            self.elaborate_port(m, self.port_b, self.r_b)
+        return m
+
+    def elaborate_port(self, m, bus, r):
+        # Writes are acknowledged and ignored
+        if self.pipelined:
+            # Every request is accepted right away and answered a cycle later
+            m.d.comb += bus.stall.eq(0)
+            m.d.sync += bus.ack.eq(bus.cyc & bus.stb)
+        elif self.latency == 0:
+            m.d.comb += bus.ack.eq(bus.cyc & bus.stb)
+        else:
+            m.d.sync += bus.ack.eq(0)
+            with m.If(bus.cyc):
+                m.d.sync += bus.ack.eq(bus.stb & ~bus.ack)
         m.d.comb += [
-            self.r.addr.eq(self.adr),
-            self.dat_r.eq(self.r.data)
+            r.addr.eq(bus.adr),
+            bus.dat_r.eq(r.data)
         ]
-        return m
 
 def rom_read_ut(rom, address, expected):
+    yield rom.stb.eq(1)
     yield rom.adr.eq(address)
-    yield Tick()
+    if rom.latency:
+        yield Tick()
     yield Settle()
     assert(yield rom.ack)
     actual = yield rom.dat_r
     if expected == actual:
         print("PASS: Memory[0x%04X] = 0x%08X" % (address, expected))
     else:
-        print("FAIL: Memory[0x%04X] = 0x%08X (got: 0x%08X)" % (address, expected, actual))
+        raise ValueError("FAIL: Memory[0x%04X] = 0x%08X (got: 0x%08X)" % (address, expected, actual))
+    if rom.latency and not rom.pipelined:
+        # A classic cycle has to end before the next one starts
+        yield rom.stb.eq(0)
+        yield Tick()
 
-if __name__ == "__main__":
-    dut = ROM([0x01234567, 0x89ABCDEF,
-               0x0C0FFEE0, 0xDEC0FFEE,
-               0xFEEBEEDE])
-    sim = Simulator(dut)
-    with sim.write_vcd('vcd/rom.vcd'):
-        def proc():
-            yield dut.cyc.eq(1)
-            yield dut.stb.eq(1)
-            yield from rom_read_ut(dut, 0, 0x01234567)
-            yield from rom_read_ut(dut, 1, 0x89ABCDEF)
-            yield from rom_read_ut(dut, 2, 0x0C0FFEE0)
-            yield from rom_read_ut(dut, 3, 0xDEC0FFEE)
-            yield from rom_read_ut(dut, 4, 0xFEEBEEDE)
+def test_rom(dut):
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+    def proc():
+        yield dut.cyc.eq(1)
+        yield from rom_read_ut(dut, 0, 0x01234567)
+        yield from rom_read_ut(dut, 1, 0x89ABCDEF)
+        yield from rom_read_ut(dut, 2, 0x0C0FFEE0)
+        yield from rom_read_ut(dut, 3, 0xDEC0FFEE)
+        yield from rom_read_ut(dut, 4, 0xFEEBEEDE)
+    # Without latency the rom has no clocked logic at all
+    if dut.latency:
         sim.add_clock(1e-6)
         sim.add_sync_process(proc)
+    else:
+        sim.add_process(proc)
+    with trace(sim, fragment, 'rom'):
         sim.run()
+
+def test():
+    data = [0x01234567, 0x89ABCDEF,
+            0x0C0FFEE0, 0xDEC0FFEE,
+            0xFEEBEEDE]
+    # Back-to-back reads are only acknowledged every cycle when pipelined
+    test_rom(ROM(data, pipelined=True))
+    test_rom(ROM(data))
+    test_rom(ROM(data, latency=0))
+
+    # Both ports read at once
+    dut = ROM(data, dual_port=True)
+    sim = Simulator(dut)
+    def proc():
+        for bus, address in [(dut, 1), (dut.port_b, 3)]:
+            yield bus.cyc.eq(1)
+            yield bus.stb.eq(1)
+            yield bus.adr.eq(address)
+        yield Tick()
+        yield Settle()
+        assert((yield dut.ack) and (yield dut.port_b.ack))
+        assert((yield dut.dat_r) == data[1])
+        assert((yield dut.port_b.dat_r) == data[3])
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+if __name__ == "__main__":
+    test()
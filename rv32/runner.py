@@ -0,0 +1,121 @@
+import importlib
+import inspect
+import io
+import json
+import multiprocessing
+import os
+import pkgutil
+import time
+import traceback
+from contextlib import redirect_stdout
+from fnmatch import fnmatchcase
+from xml.etree import ElementTree
+
+# Runs the module tests in a pool of worker processes. A test is a module
+# level function whose name starts with test and that can be called without
+# arguments, the ones with a backend argument are passed the simulator to
+# use. The modules are imported once in the parent before the workers are
+# forked, so nmigen isn't imported and set up again for every test.
+
+
+def discover(package='rv32', pattern=None):
+    tests = []
+    path = importlib.import_module(package).__path__
+    for info in sorted(pkgutil.iter_modules(path), key=lambda info: info.name):
+        module = importlib.import_module('%s.%s' % (package, info.name))
+        for name, function in inspect.getmembers(module, inspect.isfunction):
+            if function.__module__ != module.__name__ or not name.startswith('test'):
+                continue
+            parameters = inspect.signature(function).parameters.values()
+            if any(p.default is inspect.Parameter.empty for p in parameters):
+                continue
+            test = '%s.%s' % (module.__name__, name)
+            if pattern is None or fnmatchcase(test, pattern):
+                tests.append(test)
+    return tests
+
+
+def run_test(test, backend='pysim'):
+    module, name = test.rsplit('.', 1)
+    function = getattr(importlib.import_module(module), name)
+    kwargs = {}
+    if 'backend' in inspect.signature(function).parameters:
+        kwargs['backend'] = backend
+    output = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    try:
+        with redirect_stdout(output):
+            function(**kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    return {
+        'name': test,
+        'time': time.perf_counter() - start,
+        'output': output.getvalue(),
+        'error': error,
+    }
+
+
+def _run_test(args):
+    return run_test(*args)
+
+
+def run_tests(tests, backend='pysim', jobs=None):
+    # Yields the results in the order the tests finish
+    jobs = jobs or os.cpu_count() or 1
+    args = [(test, backend) for test in tests]
+    if jobs == 1:
+        yield from map(_run_test, args)
+        return
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        yield from pool.imap_unordered(_run_test, args)
+
+
+def write_junit(results, path):
+    suite = ElementTree.Element('testsuite', name='rv32', tests=str(len(results)),
+                                failures=str(sum(r['error'] is not None for r in results)),
+                                time='%.3f' % sum(r['time'] for r in results))
+    for result in results:
+        classname, name = result['name'].rsplit('.', 1)
+        case = ElementTree.SubElement(suite, 'testcase', classname=classname, name=name,
+                                      time='%.3f' % result['time'])
+        if result['error'] is not None:
+            failure = ElementTree.SubElement(case, 'failure',
+                                             message=result['error'].strip().splitlines()[-1])
+            failure.text = result['error']
+        if result['output']:
+            ElementTree.SubElement(case, 'system-out').text = result['output']
+    ElementTree.ElementTree(suite).write(path, encoding='unicode', xml_declaration=True)
+
+
+def write_json(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def main(pattern=None, backend='pysim', jobs=None, junit_path=None, json_path=None):
+    # Returns the exit status, 1 if any test failed
+    tests = discover(pattern=pattern)
+    results = []
+    start = time.perf_counter()
+    for result in run_tests(tests, backend, jobs):
+        results.append(result)
+        status = 'ok' if result['error'] is None else 'FAIL'
+        print('%-4s %-40s %7.2fs' % (status, result['name'], result['time']), flush=True)
+    results.sort(key=lambda result: result['name'])
+
+    failed = [result for result in results if result['error'] is not None]
+    for result in failed:
+        print('\n==== %s\n%s%s' % (result['name'], result['output'], result['error']))
+    print('%d passed, %d failed in %.2fs' % (len(results) - len(failed), len(failed),
+                                             time.perf_counter() - start))
+    if junit_path is not None:
+        write_junit(results, junit_path)
+    if json_path is not None:
+        write_json(results, json_path)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(*sys.argv[1:2]))
@@ -0,0 +1,168 @@
+import json
+import os
+import re
+
+# Area and fmax of an ice40 build, read from the logs the build leaves
+# behind: the statistics yosys prints at the end of synth_ice40 in
+# <name>.rpt and the timing nextpnr reports in <name>.tim. A build is
+# compared against a baseline of the same configuration, so a change to
+# the core can be judged on its size and speed too.
+
+# Older yosys prints "SB_LUT4  123", newer "123  SB_LUT4"
+CELL = re.compile(r'^\s*(?:(?P<name>SB_\w+)\s+(?P<count>\d+)|(?P<count2>\d+)\s+(?P<name2>SB_\w+))\s*$')
+FMAX = re.compile(r"Max frequency for clock\s+'(?P<clock>[^']+)':\s+(?P<mhz>[\d.]+) MHz")
+
+# Tolerated change before a build counts as a regression
+TOLERANCE = 0.02
+
+
+def parse_stat(lines):
+    # Returns the cell counts of the last statistics in a yosys log
+    cells = {}
+    for line in lines:
+        if 'Printing statistics' in line:
+            cells = {}
+            continue
+        match = CELL.match(line)
+        if match:
+            name = match.group('name') or match.group('name2')
+            cells[name] = int(match.group('count') or match.group('count2'))
+    return cells
+
+
+def parse_timing(lines):
+    # nextpnr estimates fmax after placement and reports it again after
+    # routing, the last report of every clock counts
+    fmax = {}
+    for line in lines:
+        match = FMAX.search(line)
+        if match:
+            fmax[match.group('clock')] = float(match.group('mhz'))
+    return fmax
+
+
+def summarize(cells, fmax):
+    return {
+        'luts': cells.get('SB_LUT4', 0),
+        'dffs': sum(count for name, count in cells.items() if name.startswith('SB_DFF')),
+        'carries': cells.get('SB_CARRY', 0),
+        'brams': cells.get('SB_RAM40_4K', 0),
+        'sprams': cells.get('SB_SPRAM256KA', 0),
+        'cells': cells,
+        'fmax': fmax,
+    }
+
+
+def read_report(directory, name='top'):
+    with open(os.path.join(directory, name + '.rpt')) as f:
+        cells = parse_stat(f)
+    with open(os.path.join(directory, name + '.tim')) as f:
+        fmax = parse_timing(f)
+    return summarize(cells, fmax)
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    # Returns a message for every resource that grew and every clock that
+    # got slower by more than the tolerance
+    regressions = []
+    for resource in ('luts', 'dffs', 'carries', 'brams', 'sprams'):
+        old, new = baseline.get(resource, 0), report[resource]
+        if new > old * (1 + tolerance):
+            regressions.append('%s: %d -> %d (%+.1f%%)' % (resource, old, new,
+                                                          100 * (new - old) / max(old, 1)))
+    for clock, old in sorted(baseline.get('fmax', {}).items()):
+        new = report['fmax'].get(clock)
+        if new is None:
+            regressions.append('fmax %s: %.2f MHz -> missing' % (clock, old))
+        elif new < old * (1 - tolerance):
+            regressions.append('fmax %s: %.2f -> %.2f MHz (%+.1f%%)' % (clock, old, new,
+                                                                     100 * (new - old) / old))
+    return regressions
+
+
+def check_baseline(report, config, path, update=False, tolerance=TOLERANCE):
+    # The baseline holds a report per configuration. A configuration without
+    # one, or an update, stores the report. Returns the regressions.
+    baselines = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baselines = json.load(f)
+    if config in baselines and not update:
+        return compare(report, baselines[config], tolerance)
+    baselines[config] = report
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return []
+
+
+def format_report(report):
+    lines = ['luts %d  dffs %d  carries %d  brams %d  sprams %d' % (
+        report['luts'], report['dffs'], report['carries'], report['brams'], report['sprams'])]
+    for clock, mhz in sorted(report['fmax'].items()):
+        lines.append('fmax %s: %.2f MHz' % (clock, mhz))
+    return '\n'.join(lines)
+
+
+def test():
+    import tempfile
+
+    # synth_ice40 prints statistics more than once, only the last are kept
+    rpt = """
+2.47. Printing statistics.
+
+=== top ===
+
+   Number of cells:               9999
+     SB_LUT4                      9999
+
+3.50. Printing statistics.
+
+=== top ===
+
+   Number of wires:               1234
+   Number of cells:               2107
+     SB_CARRY                      120
+     SB_DFF                         64
+     SB_DFFE                       300
+     SB_DFFESR                      36
+     SB_LUT4                      1583
+     SB_RAM40_4K                     4
+""".splitlines()
+    cells = parse_stat(rpt)
+    assert(cells == {'SB_CARRY': 120, 'SB_DFF': 64, 'SB_DFFE': 300, 'SB_DFFESR': 36,
+                     'SB_LUT4': 1583, 'SB_RAM40_4K': 4})
+    assert(parse_stat(['Printing statistics.', '       1583   SB_LUT4']) == {'SB_LUT4': 1583})
+
+    tim = """
+Info: Max frequency for clock 'clk12_0__io': 38.10 MHz (PASS at 12.00 MHz)
+Info: Device utilisation:
+Info: Max frequency for clock 'clk12_0__io': 41.53 MHz (PASS at 12.00 MHz)
+""".splitlines()
+    report = summarize(cells, parse_timing(tim))
+    assert(report['luts'] == 1583 and report['dffs'] == 400 and report['brams'] == 4)
+    assert(report['fmax'] == {'clk12_0__io': 41.53})
+
+    # Within the tolerance nothing is reported
+    baseline = dict(report, luts=1560, fmax={'clk12_0__io': 41.0})
+    assert(compare(report, baseline) == [])
+    baseline = dict(report, luts=1400, brams=2, fmax={'clk12_0__io': 45.0})
+    regressions = compare(report, baseline)
+    assert([message.split(':')[0] for message in regressions] ==
+           ['luts', 'brams', 'fmax clk12_0__io'])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'baseline.json')
+        # The first build of a configuration becomes its baseline
+        assert(check_baseline(baseline, 'default', path) == [])
+        assert(check_baseline(report, 'default', path) == regressions)
+        assert(check_baseline(report, 'pipeline', path) == [])
+        assert(check_baseline(report, 'default', path, update=True) == [])
+        assert(check_baseline(report, 'default', path) == [])
+    print(format_report(report))
+
+if __name__ == '__main__':
+    test()
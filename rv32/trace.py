@@ -0,0 +1,252 @@
+import gzip
+import os
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from fnmatch import fnmatchcase
+from nmigen import Fragment
+from nmigen.hdl.ast import SignalDict, SignalSet
+from nmigen.hdl.xfrm import ValueTransformer, StatementTransformer
+from nmigen.sim import *
+from vcd import VCDWriter
+
+# Waveforms are only written when RV32_TRACE is set, either to 1 or to the
+# output directory. Without any of the options below every signal is dumped
+# at full resolution, with them the traced signals are sampled once per
+# clock cycle:
+#
+#   RV32_TRACE_SIGNALS  comma separated patterns of dotted names, cpu.rvfi__*
+#   RV32_TRACE_TRIGGER  pattern of the signal that starts the window when high
+#   RV32_TRACE_WINDOW   first:last cycle, relative to the trigger if there is
+#                       one, a negative first keeps cycles before the trigger
+#   RV32_TRACE_COMPRESS gzip the output
+
+
+class TraceConfig:
+    def __init__(self, directory='vcd', signals=None, trigger=None, window=None, compress=False):
+        self.directory = directory
+        self.signals = signals
+        self.trigger = trigger
+        self.window = window
+        self.compress = compress
+
+    @staticmethod
+    def from_env():
+        enabled = os.environ.get('RV32_TRACE', '')
+        if enabled in ('', '0'):
+            return None
+        signals = os.environ.get('RV32_TRACE_SIGNALS')
+        window = os.environ.get('RV32_TRACE_WINDOW')
+        if window is not None:
+            first, last = window.split(':')
+            window = (int(first) if first else None, int(last) if last else None)
+        return TraceConfig(directory='vcd' if enabled == '1' else enabled,
+                           signals=signals.split(',') if signals else None,
+                           trigger=os.environ.get('RV32_TRACE_TRIGGER'),
+                           window=window,
+                           compress=os.environ.get('RV32_TRACE_COMPRESS', '') not in ('', '0'))
+
+    def sampled(self):
+        return self.signals is not None or self.trigger is not None or self.window is not None
+
+    def selects(self, name):
+        return self.signals is None or any(fnmatchcase(name, p) for p in self.signals)
+
+
+class SignalCollector(ValueTransformer, StatementTransformer):
+    def __init__(self):
+        self.signals = SignalSet()
+
+    def on_Signal(self, value):
+        self.signals.add(value)
+        return value
+
+
+def fragment_signals(fragment):
+    # The signals the fragment drives or reads, which includes the inputs
+    # only a testbench drives. It isn't prepared yet, so it has no clock
+    # domain signals.
+    collector = SignalCollector()
+    collector.on_statements(fragment.statements)
+    for value in fragment.ports:
+        collector.on_value(value)
+    for value, kind in getattr(fragment, 'named_ports', {}).values():
+        collector.on_value(value)
+    signals = [signal for domain, signal in fragment.iter_drivers()]
+    return signals + sorted(collector.signals - SignalSet(signals), key=lambda s: s.duid)
+
+
+def signal_names(fragment, hierarchy=()):
+    names = SignalDict()
+    for signal in fragment_signals(fragment):
+        names.setdefault(signal, '.'.join(hierarchy + (signal.name,)))
+    for i, (subfragment, name) in enumerate(fragment.subfragments):
+        for signal, path in signal_names(subfragment, hierarchy + (name or 'U$%d' % i,)).items():
+            names.setdefault(signal, path)
+    return names
+
+
+def clock_domains(fragment):
+    domains = set(fragment.domains)
+    domains.update(domain for domain in fragment.drivers if domain is not None)
+    for subfragment, name in fragment.subfragments:
+        domains |= clock_domains(subfragment)
+    return domains
+
+
+def open_vcd(config, name):
+    os.makedirs(config.directory, exist_ok=True)
+    path = os.path.join(config.directory, name + '.vcd')
+    if config.compress:
+        return gzip.open(path + '.gz', 'wt')
+    return open(path, 'w')
+
+
+def trace(sim, fragment, name, domain='sync', config=None):
+    # Returns the context to run the simulation in, which costs nothing
+    # unless tracing is enabled. fragment is the design the simulator was
+    # built from, elaborated once with Fragment.get so that the signals
+    # created inside elaborate are the simulated ones. The configuration
+    # comes from the environment unless one is passed.
+    if not isinstance(fragment, Fragment):
+        raise TypeError('trace needs the fragment the simulator was built from, not %r'
+                        % (fragment,))
+    config = config or TraceConfig.from_env()
+    if config is None:
+        return nullcontext()
+    # Designs without a clock to sample on are always dumped in full
+    if not config.sampled() or domain not in clock_domains(fragment):
+        return sim.write_vcd(open_vcd(config, name))
+    return sampled_trace(sim, fragment, name, config, domain)
+
+
+@contextmanager
+def sampled_trace(sim, fragment, name, config, domain):
+    names = signal_names(fragment)
+    traced = sorted(((path, signal) for signal, path in names.items() if config.selects(path)),
+                    key=lambda item: item[0])
+    if config.trigger is not None:
+        triggers = [signal for signal, path in names.items() if fnmatchcase(path, config.trigger)]
+        if not triggers:
+            raise ValueError('no signal matches the trigger %s' % config.trigger)
+    first, last = config.window or (None, None)
+    if first is None:
+        first = 0
+
+    # Opened once the options are known to be good, so a bad trigger leaves
+    # no empty waveform behind
+    vcd_file = open_vcd(config, name)
+    writer = None
+    try:
+        writer = VCDWriter(vcd_file, timescale='1 us', comment='one step per clock cycle')
+        variables = []
+        for path, signal in traced:
+            *scope, var_name = path.split('.')
+            suffix = 0
+            while True:
+                try:
+                    variables.append(writer.register_var(
+                        scope or 'top', var_name + ('$%d' % suffix if suffix else ''), 'wire',
+                        size=len(signal), init=signal.reset))
+                    break
+                except KeyError:
+                    suffix += 1
+        signals = [signal for path, signal in traced]
+        previous = [signal.reset for signal in signals]
+
+        def dump(cycle, values):
+            for i, value in enumerate(values):
+                if value != previous[i]:
+                    writer.change(variables[i], cycle, value)
+                    previous[i] = value
+
+        def sample():
+            values = []
+            for signal in signals:
+                values.append((yield signal))
+            return values
+
+        def sampler():
+            yield Passive()
+            cycle = 0
+            start = None if config.trigger is not None else 0
+            before = deque(maxlen=-first) if first < 0 else None
+            while True:
+                yield Settle()
+                if start is None:
+                    for signal in triggers:
+                        if (yield signal):
+                            start = cycle
+                            for earlier, values in before or ():
+                                dump(earlier, values)
+                            break
+                offset = cycle - start if start is not None else None
+                if offset is None and before is not None:
+                    before.append((cycle, (yield from sample())))
+                elif offset is not None and offset >= first and (last is None or offset <= last):
+                    dump(cycle, (yield from sample()))
+                yield
+                cycle += 1
+
+        sim.add_sync_process(sampler, domain=domain)
+        yield
+    finally:
+        if writer is not None:
+            writer.close()
+        vcd_file.close()
+
+
+def test():
+    import tempfile
+    from nmigen import Elaboratable, Module, Signal
+
+    class Counter(Elaboratable):
+        def __init__(self):
+            self.go = Signal()
+            self.count = Signal(8)
+            self.other = Signal(8)
+
+        def elaborate(self, platform):
+            m = Module()
+            m.d.sync += self.count.eq(self.count + 1)
+            m.d.comb += self.other.eq(self.count + self.go)
+            return m
+
+    def run(config):
+        dut = Counter()
+        fragment = Fragment.get(dut, None)
+        sim = Simulator(fragment)
+
+        def proc():
+            for cycle in range(12):
+                yield dut.go.eq(cycle >= 6)
+                yield Tick()
+
+        sim.add_clock(1e-6, domain='sync')
+        sim.add_sync_process(proc)
+        with trace(sim, fragment, 'counter', config=config):
+            sim.run()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # go is only driven by the testbench, other isn't selected
+        run(TraceConfig(directory, signals=['go', 'count'], trigger='go', window=(-2, 3),
+                        compress=True))
+        with gzip.open(os.path.join(directory, 'counter.vcd.gz'), 'rt') as f:
+            lines = f.read().splitlines()
+        names = [line.split()[4] for line in lines if line.startswith('$var')]
+        assert(names == ['count', 'go'])
+        # go rises in cycle 6, the window keeps the two cycles before it
+        times = [int(line[1:]) for line in lines if line.startswith('#')]
+        assert(times == [0] + list(range(4, 10)))
+        assert(lines[lines.index('#6') + 2] == '1"')
+
+        try:
+            run(TraceConfig(directory, trigger='missing'))
+        except ValueError as e:
+            assert('missing' in str(e))
+        else:
+            raise ValueError('expected the trigger not to match')
+        assert(sorted(os.listdir(directory)) == ['counter.vcd.gz'])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,111 @@
+import numpy as np
+from nmigen import *
+from nmigen.sim import *
+from .trace import trace
+
+# Operand pairs that are always checked, every combination of these
+CORNERS = np.array([
+    0x0000_0000, 0x0000_0001, 0x0000_0002, 0x0000_001f, 0x0000_0020, 0x5555_5555,
+    0x7fff_ffff, 0x8000_0000, 0x8000_0001, 0xaaaa_aaaa, 0xffff_fffe, 0xffff_ffff,
+], dtype=np.uint32)
+
+
+class Lanes(Elaboratable):
+    # Copies of a combinational unit with funct, in1, in2 and out ports side
+    # by side. The operands of lane i are bits 32 * i to 32 * i + 31 of the
+    # wide in1 and in2, so a whole batch costs a single update in pysim.
+    def __init__(self, unit, funct, lanes=64):
+        self.units = [unit() for _ in range(lanes)]
+        self.funct_name = funct
+        self.funct = Signal(len(getattr(self.units[0], funct)))
+        self.in1 = Signal(32 * lanes)
+        self.in2 = Signal(32 * lanes)
+        self.out = Signal(32 * lanes)
+
+    def elaborate(self, platform):
+        m = Module()
+        for i, unit in enumerate(self.units):
+            m.submodules['lane%d' % i] = unit
+            m.d.comb += [
+                getattr(unit, self.funct_name).eq(self.funct),
+                unit.in1.eq(self.in1[32 * i:32 * (i + 1)]),
+                unit.in2.eq(self.in2[32 * i:32 * (i + 1)]),
+                self.out[32 * i:32 * (i + 1)].eq(unit.out),
+            ]
+        return m
+
+
+def pack(values):
+    return int.from_bytes(values.astype('<u4').tobytes(), 'little')
+
+
+def unpack(value, count):
+    # The first count lanes, the others of a partial batch are left over
+    value &= (1 << 32 * count) - 1
+    return np.frombuffer(value.to_bytes(4 * count, 'little'), dtype='<u4')
+
+
+def operands(count, rng):
+    # The corner pairs followed by random ones, a quarter of the random
+    # second operands are kept below 64 to hit every shift amount
+    in1, in2 = (x.ravel() for x in np.meshgrid(CORNERS, CORNERS))
+    n = max(count - len(in1), 0)
+    rnd1 = rng.integers(0, 1 << 32, n, dtype=np.uint32)
+    rnd2 = rng.integers(0, 1 << 32, n, dtype=np.uint32)
+    rnd2[rng.random(n) < 0.25] &= 63
+    return np.concatenate([in1, rnd1]), np.concatenate([in2, rnd2])
+
+
+def run_lanes(dut, batches, backend='pysim', name='vectors'):
+    # Returns the outputs of every (funct, in1, in2) batch
+    outputs = []
+    if backend == 'cxxrtl':
+        from .cxxsim import CxxSimulator
+
+        sim = CxxSimulator(dut, ports=[dut.funct, dut.in1, dut.in2, dut.out])
+        for funct, in1, in2 in batches:
+            sim.set(dut.funct, funct)
+            sim.set(dut.in1, pack(in1))
+            sim.set(dut.in2, pack(in2))
+            outputs.append(unpack(sim.get(dut.out), len(in1)))
+        return outputs
+    if backend != 'pysim':
+        raise ValueError('unknown backend %s' % backend)
+
+    fragment = Fragment.get(dut, None)
+    sim = Simulator(fragment)
+
+    def proc():
+        for funct, in1, in2 in batches:
+            yield dut.funct.eq(funct)
+            yield dut.in1.eq(pack(in1))
+            yield dut.in2.eq(pack(in2))
+            yield Settle()
+            outputs.append(unpack((yield dut.out), len(in1)))
+
+    sim.add_process(proc)
+    with trace(sim, fragment, name):
+        sim.run()
+    return outputs
+
+
+def check_vectors(unit, funct, references, count=4096, seed=0, backend='pysim', name='vectors'):
+    # Checks count operand pairs for every funct code against a reference
+    # that computes the expected outputs of whole uint32 arrays at once
+    rng = np.random.default_rng(seed)
+    dut = Lanes(unit, funct)
+    lanes = len(dut.units)
+    in1, in2 = operands(count, rng)
+    batches = [(code, in1[i:i + lanes], in2[i:i + lanes])
+               for code in references for i in range(0, len(in1), lanes)]
+    outputs = iter(run_lanes(dut, batches, backend, name))
+
+    for code, reference in references.items():
+        out = np.concatenate([next(outputs) for i in range(0, len(in1), lanes)])
+        expected = reference(in1, in2).astype(np.uint32)
+        wrong = np.flatnonzero(out != expected)
+        if len(wrong):
+            i = wrong[0]
+            raise ValueError('%s %s %s: expected %s but got %s, %d of %d wrong' % (
+                code, hex(in1[i]), hex(in2[i]), hex(expected[i]), hex(out[i]), len(wrong), len(out)))
+    return len(in1) * len(references)
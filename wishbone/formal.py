@@ -27,10 +27,11 @@ def wishbone_formal_layout(bmc_depth):
 
 
 class WbMasterFormal(Elaboratable):
-    def __init__(self, addr_width, data_width, bmc_depth):
+    def __init__(self, addr_width, data_width, bmc_depth, max_outstanding=None):
         self.addr_width = addr_width
         self.data_width = data_width
         self.bmc_depth = bmc_depth
+        self.max_outstanding = max_outstanding
 
         self.wb = Record(wishbone_layout(addr_width, data_width))
         self.wbf = Record(wishbone_formal_layout(bmc_depth))
@@ -42,6 +43,20 @@ class WbMasterFormal(Elaboratable):
         request = Signal(2 + self.addr_width + self.data_width + self.data_width // 8)
         m.d.comb += request.eq(Cat(self.wb.stb, self.wb.we, self.wb.adr, self.wb.dat_w, self.wb.sel))
 
+        # Count the requests accepted and acknowledged within the current bus
+        # cycle.
+        with m.If(~self.wb.cyc):
+            m.d.sync += [
+                self.wbf.nreqs.eq(0),
+                self.wbf.nacks.eq(0),
+            ]
+        with m.Else():
+            with m.If(self.wb.stb & ~self.wb.stall):
+                m.d.sync += self.wbf.nreqs.eq(self.wbf.nreqs + 1)
+            with m.If(self.wb.ack | self.wb.err):
+                m.d.sync += self.wbf.nacks.eq(self.wbf.nacks + 1)
+        m.d.comb += self.wbf.outstanding.eq(self.wbf.nreqs - self.wbf.nacks)
+
         # The bus is initialized in a reset condition - no requests are being made and
         # the reset line is high.
         with m.If(Initial()):
@@ -123,6 +138,17 @@ class WbMasterFormal(Elaboratable):
         # Ack and err may never be true on the same clock.
         m.d.comb += Assume(~self.wb.ack | ~self.wb.err)
 
+        # A slave only answers requests it has accepted on an earlier clock.
+        with m.If(self.wbf.outstanding == 0):
+            m.d.comb += [
+                Assume(~self.wb.ack),
+                Assume(~self.wb.err),
+            ]
+
+        # The master may only have so many requests in flight.
+        if self.max_outstanding is not None:
+            m.d.comb += Assert(self.wbf.outstanding <= self.max_outstanding)
+
         return m
 
 
@@ -167,7 +193,8 @@ class FaultyMaster(Elaboratable):
         return m
 
 
-def assertFormal(spec_dir, spec_name, spec, mode="bmc", solver='boolector', depth=1):
+def assertFormal(spec_dir, spec_name, spec, mode="bmc", solver='boolector', depth=1,
+                 multiclock=False):
     from nmigen.back import rtlil
     import os
     import shutil
@@ -197,6 +224,7 @@ def assertFormal(spec_dir, spec_name, spec, mode="bmc", solver='boolector', dept
     [options]
     mode {mode}
     depth {depth}
+    multiclock {multiclock}
     wait on
     [engines]
     smtbmc {solver}
@@ -209,6 +237,7 @@ def assertFormal(spec_dir, spec_name, spec, mode="bmc", solver='boolector', dept
     """).format(
         mode=mode,
         depth=depth,
+        multiclock="on" if multiclock else "off",
         solver=solver,
         script=script,
         rtlil=rtlil.convert(Fragment.get(spec, platform="formal"))